@@ -0,0 +1,68 @@
+"""Time the embedding updates with neighbors on a synthetic spatial replicate.
+
+The replicate has cells scattered uniformly over a square, with expression drawn from a random set of
+metagenes that vary along the first axis. Metagenes and spatial affinities are fitted first, then a single
+call to ``Popari.estimate_weights`` is timed. To measure a change, run the script on both revisions, e.g.::
+
+    python benchmarks/embedding_updates.py --num_cells 100000
+
+The reported nll should agree between revisions up to the tolerance of the embedding solver.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import anndata as ad
+
+from popari.model import Popari
+from popari.components import PopariDataset
+
+def make_dataset(num_cells: int, K: int, num_genes: int, seed: int) -> PopariDataset:
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(num_cells)
+    coordinates = rng.uniform(0, side, size=(num_cells, 2))
+    M = rng.gamma(1, 1, size=(num_genes, K))
+    M /= M.sum(axis=0)
+    labels = (coordinates[:, 0] // (side / K)).astype(int) % K
+    X = np.eye(K)[labels] * 10 + rng.uniform(0, 1, size=(num_cells, K))
+
+    dataset = ad.AnnData(X=rng.poisson(X @ M.T * 20).astype(np.float64))
+    dataset.obsm["spatial"] = coordinates
+    dataset = PopariDataset(dataset, "benchmark")
+    dataset.compute_spatial_neighbors()
+
+    return dataset
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the embedding updates with neighbors on a synthetic replicate.")
+    parser.add_argument("--num_cells", type=int, default=100000, help="Number of cells. Default ``100000``")
+    parser.add_argument("--K", type=int, default=10, help="Number of metagenes. Default ``10``")
+    parser.add_argument("--num_genes", type=int, default=100, help="Number of genes. Default ``100``")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data. Default ``0``")
+    parser.add_argument("--device", type=str, default="cpu", help="PyTorch device. Default ``cpu``")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    context = dict(device=args.device, dtype=torch.float64)
+    dataset = make_dataset(args.num_cells, args.K, args.num_genes, args.seed)
+    model = Popari(K=args.K, datasets=[dataset], replicate_names=[dataset.name], initialization_method="svd",
+            torch_context=context, initial_context=context)
+
+    model.estimate_parameters(update_spatial_affinities=False)
+    model.estimate_weights(use_neighbors=False)
+    model.estimate_parameters()
+
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    model.estimate_weights()
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    print(f"cells: {args.num_cells}  embedding update: {elapsed:.1f} s  nll: {model.nll().sum():.6e}")
+
+if __name__ == "__main__":
+    main()
@@ -34,7 +34,7 @@ import seaborn as sns
 
 from popari.components import PopariDataset
 from popari.util import compute_neighborhood_enrichment, chunked_downsample_on_grid, \
-                        filter_gridpoints, bin_expression
+                        assign_to_grid, bin_expression
 
 def setup_squarish_axes(num_axes, **subplots_kwargs):
     """Create matplotlib subplots as squarely as possible."""
@@ -787,14 +787,20 @@ def _spatial_binning(dataset: PopariDataset, level: int = 0, chunks: int = 16, d
             downsample_rate=downsample_rate
     )
 
-    filtered_bin_coordinates = filter_gridpoints(coordinates, bin_coordinates, num_jobs)
-    filtered_bin_expression, bin_assignments = bin_expression(dataset.X, coordinates, filtered_bin_coordinates, num_jobs)
+    # Meta-spots lie on a square lattice anchored at the lowest coordinates, so spots are binned arithmetically
+    # and only bins that receive at least one spot are kept
+    indices = assign_to_grid(coordinates, bin_coordinates, origin=coordinates.min(axis=0),
+            spacing=chunk_size / chunk_1d_density, num_jobs=num_jobs)
+    used_bins, indices = np.unique(indices, return_inverse=True)
+    filtered_bin_coordinates = bin_coordinates[used_bins]
+    filtered_bin_expression, bin_assignments = bin_expression(dataset.X, coordinates, filtered_bin_coordinates, num_jobs,
+            indices=indices)
 
     binned_dataset = ad.AnnData(X=filtered_bin_expression)
     binned_dataset_name = f"{dataset.name}_level_{level}"
     binned_dataset.var_names = dataset.var_names
     binned_dataset.obsm["spatial"] = filtered_bin_coordinates
-    binned_dataset.obs["total_transformed_counts"] = binned_dataset.X.sum(axis=1)
+    binned_dataset.obs["total_transformed_counts"] = np.asarray(binned_dataset.X.sum(axis=1)).ravel()
     binned_dataset.obsm[f"bin_assignments_{binned_dataset_name}"] = bin_assignments
 
     binned_dataset.uns["chunk_size"] = chunk_size
@@ -1,11 +1,12 @@
 from typing import Sequence
 import logging, time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm, trange
 
 import numpy as np
 import torch
 
-from popari.util import NesterovGD, IndependentSet, sample_graph_iid, project2simplex, project2simplex_, project_M, project_M_, get_datetime, convert_numpy_to_pytorch_sparse_coo
+from popari.util import DEBUG, NesterovGD, OptimizationLoop, GraphColoringScheduler, NeighborSumBuffer, SpatialTiling, SufficientStatistics, solve_simplex_qp, solve_nnls, project2simplex, project2simplex_, project_M, project_M_, get_datetime, convert_numpy_to_pytorch_sparse_coo, index_rows, squared_norm
 from popari.components import PopariDataset
 
 class EmbeddingOptimizer():
@@ -13,7 +14,7 @@ class EmbeddingOptimizer():
 
     """
 
-    def __init__(self, K, Ys, datasets, initial_context=None, context=None, use_inplace_ops=False, embedding_step_size_multiplier=1, embedding_mini_iterations=1000, embedding_acceleration_trick=True, verbose=0):
+    def __init__(self, K, Ys, datasets, initial_context=None, context=None, use_inplace_ops=False, embedding_step_size_multiplier=1, embedding_mini_iterations=1000, embedding_acceleration_trick=True, graph_coloring_method="greedy", embedding_update_alg="nesterov", embedding_nmf_update_alg="gd", embedding_contiguous_layout=False, embedding_frontier_scheduling=False, embedding_num_threads=1, embedding_tile_size=None, convergence_check_frequency=10, verbose=0):
         self.verbose = verbose
         self.use_inplace_ops = use_inplace_ops
         self.datasets = datasets
@@ -27,6 +28,18 @@ class EmbeddingOptimizer():
         self.embedding_step_size_multiplier = embedding_step_size_multiplier
         self.embedding_mini_iterations = embedding_mini_iterations
         self.embedding_acceleration_trick = embedding_acceleration_trick
+        self.graph_coloring_method = graph_coloring_method
+        self.embedding_update_alg = embedding_update_alg
+        self.embedding_nmf_update_alg = embedding_nmf_update_alg
+        self.embedding_contiguous_layout = embedding_contiguous_layout
+        self.embedding_frontier_scheduling = embedding_frontier_scheduling
+        self.embedding_num_threads = embedding_num_threads
+        self.embedding_tile_size = embedding_tile_size
+        self.convergence_check_frequency = convergence_check_frequency
+        self.tilings = {}
+        self.schedulers = {}
+        self.neighbor_sums = {}
+        self.sufficient_statistics = {dataset.name: SufficientStatistics() for dataset in self.datasets}
        
         if self.verbose:
             print(f"{get_datetime()} Initializing EmbeddingState") 
@@ -35,6 +48,64 @@ class EmbeddingOptimizer():
     def link(self, parameter_optimizer):
         self.parameter_optimizer = parameter_optimizer
 
+    def get_scheduler(self, dataset):
+        """Return the (cached) independent-set scheduler for a replicate's spatial graph.
+
+        The graph coloring is only computed the first time a replicate is visited. If
+        ``embedding_contiguous_layout`` is set, the scheduler yields slices into the color-sorted layout.
+        """
+        if dataset.name not in self.schedulers:
+            if self.verbose > 1:
+                print(f"{get_datetime()} Coloring spatial graph for replicate {dataset.name}")
+            self.schedulers[dataset.name] = GraphColoringScheduler(dataset.obsp["adjacency_matrix"],
+                    device=self.context["device"], method=self.graph_coloring_method,
+                    contiguous=self.embedding_contiguous_layout)
+
+        return self.schedulers[dataset.name]
+
+    def get_neighbor_sum(self, dataset):
+        """Return the (cached) neighbor-sum buffer ``A @ Z`` for a replicate's spatial graph.
+
+        The buffer lives in the same (possibly permuted) node order as the replicate's scheduler.
+        """
+        if dataset.name not in self.neighbor_sums:
+            self.neighbor_sums[dataset.name] = self.build_neighbor_sum(dataset.obsp["adjacency_matrix"], self.get_scheduler(dataset))
+
+        return self.neighbor_sums[dataset.name]
+
+    def build_neighbor_sum(self, adjacency_matrix, scheduler):
+        """Build a neighbor-sum buffer whose node order matches that of ``scheduler``."""
+        if scheduler.contiguous:
+            adjacency_matrix = scheduler.permute_adjacency_matrix(adjacency_matrix)
+
+        return NeighborSumBuffer(adjacency_matrix, self.context)
+
+    def get_tiling(self, dataset):
+        """Return the (cached) tiles of a replicate's spatial graph, used when ``embedding_tile_size`` is set.
+
+        Every tile is a ``(cells, num_interior, scheduler, neighbor_sum, interior_adjacency_matrix)`` tuple: the
+        host indices of its interior cells followed by its halo, the batch scheduler and neighbor-sum buffer of its
+        local graph, and the device adjacency matrix between its interior and all of its cells. All of them are
+        built the first time a replicate is visited and reused in later sweeps.
+        """
+        if dataset.name not in self.tilings:
+            if self.verbose > 1:
+                print(f"{get_datetime()} Tiling spatial graph for replicate {dataset.name}")
+            tiling = SpatialTiling(dataset.obsm["spatial"], dataset.obsp["adjacency_matrix"], tile_size=self.embedding_tile_size)
+
+            tiles = []
+            for tile_index, (cells, num_interior, adjacency_matrix) in enumerate(tiling):
+                scheduler = GraphColoringScheduler(adjacency_matrix, device=self.context["device"],
+                        contiguous=self.embedding_contiguous_layout,
+                        colors=tiling.get_colors(tile_index, method=self.graph_coloring_method))
+                neighbor_sum = self.build_neighbor_sum(adjacency_matrix, scheduler)
+                interior_adjacency_matrix = convert_numpy_to_pytorch_sparse_coo(adjacency_matrix[:num_interior].tocoo(), self.context)
+                tiles.append((torch.from_numpy(cells), num_interior, scheduler, neighbor_sum, interior_adjacency_matrix))
+
+            self.tilings[dataset.name] = tiles
+
+        return self.tilings[dataset.name]
+
     def update_embeddings(self, use_neighbors=True):
         """Update Popari embeddings according to optimization scheme.
 
@@ -45,11 +116,18 @@ class EmbeddingOptimizer():
         for dataset_index, dataset  in enumerate(self.datasets):
             is_spatial_replicate = ("adjacency_list" in dataset.obs)
             sigma_yx = self.parameter_optimizer.sigma_yxs[dataset_index]
-            Y = self.Ys[dataset_index].to(self.context["device"])
-            X = self.embedding_state[dataset.name].to(self.context["device"])
             M = self.parameter_optimizer.metagene_state[dataset.name].to(self.context["device"])
             prior_x_mode = self.parameter_optimizer.prior_x_modes[dataset_index]
             prior_x = self.parameter_optimizer.prior_xs[dataset_index]
+            if is_spatial_replicate and use_neighbors and self.embedding_tile_size is not None:
+                # Tiles are moved to the compute device one at a time
+                loss, self.embedding_state[dataset.name][:] = self.estimate_weight_wnbr_tiled(
+                    self.Ys[dataset_index], M, self.embedding_state[dataset.name], sigma_yx, prior_x_mode, prior_x, dataset)
+                loss_list.append(loss)
+                continue
+
+            Y = self.Ys[dataset_index].to(self.context["device"])
+            X = self.embedding_state[dataset.name].to(self.context["device"])
             if not is_spatial_replicate or not use_neighbors:
                 loss, self.embedding_state[dataset.name][:] = self.estimate_weight_wonbr(
                     Y, M, X, sigma_yx, prior_x_mode, prior_x, dataset)
@@ -82,7 +160,7 @@ class EmbeddingOptimizer():
         return loss_embeddings.cpu().numpy()
 
     @torch.no_grad()
-    def estimate_weight_wonbr(self, Y, M, X, sigma_yx, prior_x_mode, prior_x, dataset, n_epochs=1000, tol=1e-6, update_alg='gd'):
+    def estimate_weight_wonbr(self, Y, M, X, sigma_yx, prior_x_mode, prior_x, dataset, n_epochs=1000, tol=1e-6, update_alg=None):
         """Estimate weights without spatial information - equivalent to vanilla NMF.
    
         Optimizes the follwing objective with respect to hidden state X:
@@ -92,15 +170,21 @@ class EmbeddingOptimizer():
     
         TODO: use (projected) Nesterov GD. not urgent
 
+        With ``update_alg="nnls"`` the problem is instead solved exactly for all rows at once via block
+        principal pivoting over the shared Gram matrix MT M.
+
         Args:
             Y (torch.Tensor):
         """
+        if update_alg is None:
+            update_alg = self.embedding_nmf_update_alg
     
         # Precomputing quantities 
-        MTM = M.T @ M / (sigma_yx ** 2)
-        YM = Y @ M / (sigma_yx ** 2)
-        Ynorm = torch.linalg.norm(Y, ord='fro').item() ** 2 / (sigma_yx ** 2)
-        step_size = 1 / torch.linalg.eigvalsh(MTM).max().item()
+        statistics = self.sufficient_statistics[dataset.name]
+        MTM = statistics.MTM(M) / (sigma_yx ** 2)
+        YM = statistics.YM(Y, M) / (sigma_yx ** 2)
+        Ynorm = statistics.Y_norm(Y) / (sigma_yx ** 2)
+        step_size = (sigma_yx ** 2) / statistics.MTM_max_eigenvalue(M)
         loss_prev, loss = np.inf, np.nan
     
         def multiplicative_update(X_prev):
@@ -140,15 +224,31 @@ class EmbeddingOptimizer():
                 pass
             else:
                 raise NotImplementedError
-            loss = (quadratic_term_gradient * X).sum().item() / 2 - (linear_term_gradient * X).sum().item() + Ynorm / 2
+            loss = (quadratic_term_gradient * X).sum() / 2 - (linear_term_gradient * X).sum() + Ynorm / 2
             gradient = quadratic_term_gradient - linear_term_gradient
             X = X.sub(gradient, alpha=step_size)
             X = torch.clip(X, min=1e-10)
             
             return X, loss
             
-        progress_bar = trange(n_epochs, leave=True, disable=not self.verbose, miniters=1000)
-        for epoch in progress_bar:
+        if update_alg == 'nnls':
+            # The objective is an exact NNLS problem over the shared Gram matrix; warm start from the current support
+            linear_term = YM
+            if prior_x_mode == 'exponential shared fixed':
+                linear_term = linear_term - prior_x[0][None]
+            elif not prior_x_mode:
+                pass
+            else:
+                raise NotImplementedError
+
+            X = solve_nnls(MTM, linear_term, passive=X > 1e-10).clip(min=1e-10)
+            loss = ((X @ MTM) * X).sum().item() / 2 - (linear_term * X).sum().item() + Ynorm / 2
+
+            return loss, X
+
+        loop = OptimizationLoop(n_epochs, tol=tol, check_every=self.convergence_check_frequency, verbose=self.verbose,
+                description="Updating weight w/o nbrs")
+        for epoch in loop:
             X_prev = X.clone()
             if update_alg == 'mu':
                 # TODO: it seems like loss might not always decrease...
@@ -165,8 +265,9 @@ class EmbeddingOptimizer():
                 else:
                     raise NotImplementedError
     
-                loss = loss.item()
-                assert loss <= loss_prev * (1 + 1e-4), (loss_prev, loss, (loss_prev - loss) / loss)
+                if DEBUG:
+                    assert loss <= loss_prev * (1 + 1e-4), (loss_prev, loss, (loss_prev - loss) / loss)
+                    loss_prev = loss
                 multiplicative_factor = numerator / denominator
                 X.mul_(multiplicative_factor).clip_(min=1e-10)
     
@@ -176,34 +277,20 @@ class EmbeddingOptimizer():
             else:
                 raise NotImplementedError
     
-            dX = torch.abs((X_prev - X) / torch.linalg.norm(X, dim=1, ord=1, keepdim=True)).max().item()
-            do_stop = dX < tol
-            progress_bar.set_description(
-                f'Updating weight w/o nbrs: loss = {loss:.1e} '
-                f'%δloss = {(loss_prev - loss) / loss:.1e} '
-                f'%δX = {dX:.1e}'
-            )
-            loss_prev = loss
-            if do_stop:
-                break
-        progress_bar.close()
-        return loss, X
+            dX = torch.abs((X_prev - X) / torch.linalg.norm(X, dim=1, ord=1, keepdim=True)).max()
+            loop.record(loss, dX)
+
+        return loop.loss, X
     
     @torch.no_grad()
     def nll_weight_wonbr(self, Y, M, X, sigma_yx, prior_x_mode, prior_x, dataset):
-        # Precomputing quantities 
-        MTM = M.T @ M / (sigma_yx ** 2)
-        YM = Y @ M / (sigma_yx ** 2)
-        Ynorm = torch.linalg.norm(Y, ord='fro').item() ** 2 / (sigma_yx ** 2)
-        step_size = 1 / torch.linalg.eigvalsh(MTM).max().item()
-        loss_prev, loss = np.inf, np.nan
-    
-        loss = ((X @ MTM) * X).sum() / 2 - X.view(-1) @ YM.view(-1) + Ynorm / 2
+        loss = self.sufficient_statistics[dataset.name].squared_error(Y, X, M) / (sigma_yx ** 2) / 2
 
         return loss
     
     @torch.no_grad()
-    def estimate_weight_wnbr(self, Y, M, X, sigma_yx, prior_x_mode, prior_x, dataset, tol=1e-5, update_alg='nesterov'):
+    def estimate_weight_wnbr(self, Y, M, X, sigma_yx, prior_x_mode, prior_x, dataset, tol=1e-5, update_alg=None,
+            update_mask=None, scheduler=None, neighbor_sum=None, n_epochs=None):
         """Estimate updated weights taking neighbor-neighbor interactions into account.
     
         The optimization for all variables
@@ -217,14 +304,31 @@ class EmbeddingOptimizer():
         min 1/2σ^2 || Y - diag(S) Z MT ||_2^2 + sum_{ij in E} ziT Σx-1 zj
         grad_i = MT M z s^2 / σ^2 - MT y s / σ^2 + sum_{j in Ei} Σx-1 zj
     
+        Since MT M is shared by all cells, each per-cell subproblem for z_i is a small simplex-constrained QP
+        with quadratic form s_i^2 MT M / σ^2; ``update_alg="active set"`` solves these exactly, batch by batch.
+        ``update_alg="jacobi"`` instead updates all cells simultaneously with a monotone line-searched projected
+        gradient step on the full objective.
+
         TODO: Try projected Newton's method.
         TM: Inverse is precomputed once, and projection is cheap. Not sure if it works theoretically
+
+        Args:
+            update_mask: if given, only cells where the mask is set are updated; the others are held fixed
+            scheduler: batch scheduler for ``dataset``'s graph. Default: the cached scheduler of ``dataset``
+            neighbor_sum: neighbor-sum buffer matching ``scheduler``. Default: the cached buffer of ``dataset``
+            n_epochs: maximum number of epochs. Default: ``embedding_mini_iterations``
         """
+        if update_alg is None:
+            update_alg = self.embedding_update_alg
+        if n_epochs is None:
+            n_epochs = self.embedding_mini_iterations
+
         # Precomputing quantities
-        MTM = M.T @ M / (sigma_yx ** 2)
-        YM = Y.to(M.device) @ M / (sigma_yx ** 2)
-        Ynorm = torch.linalg.norm(Y, ord='fro').item() ** 2 / (sigma_yx ** 2)
-        base_step_size = self.embedding_step_size_multiplier / torch.linalg.eigvalsh(MTM).max().item()
+        statistics = self.sufficient_statistics[dataset.name]
+        MTM = statistics.MTM(M) / (sigma_yx ** 2)
+        YM = statistics.YM(Y, M) / (sigma_yx ** 2)
+        Ynorm = statistics.Y_norm(Y) / (sigma_yx ** 2)
+        base_step_size = self.embedding_step_size_multiplier * (sigma_yx ** 2) / statistics.MTM_max_eigenvalue(M)
         S = torch.linalg.norm(X, dim=1, ord=1, keepdim=True)
 
         if self.verbose > 3:
@@ -234,23 +338,32 @@ class EmbeddingOptimizer():
         Z = X / S
         N = len(Z)
         
-        E_adjacency_list = self.adjacency_lists[dataset.name]
-        adjacency_matrix = self.adjacency_matrices[dataset.name].to(self.context["device"])
+        if scheduler is None:
+            scheduler = self.get_scheduler(dataset)
+            neighbor_sum = self.get_neighbor_sum(dataset)
+        executor = ThreadPoolExecutor(max_workers=self.embedding_num_threads) if self.embedding_num_threads > 1 else None
+        if scheduler.contiguous:
+            # Work in the color-sorted layout so that every batch is a contiguous row range
+            Z, S, YM = Z[scheduler.permutation], S[scheduler.permutation], YM[scheduler.permutation]
+            if update_mask is not None:
+                update_mask = update_mask[scheduler.permutation]
         Sigma_x_inv = self.parameter_optimizer.spatial_affinity_state[dataset.name].to(self.context["device"])
     
-        def update_s():
-            S[:] = (YM * Z).sum(axis=1, keepdim=True)
+        def update_s(idx=slice(None)):
+            Z_batch = Z[idx]
+            S_batch = (YM[idx] * Z_batch).sum(axis=1, keepdim=True)
             if prior_x_mode == 'exponential shared fixed':
                 # TODO: why divide by two?
-                S.sub_(prior_x[0][0] / 2)
+                S_batch.sub_(prior_x[0][0] / 2)
             elif not prior_x_mode:
                 pass
             else:
                 raise NotImplementedError
     
-            denominator = ((Z @ MTM) * Z).sum(axis=1, keepdim=True)
-            S.div_(denominator)
-            S.clip_(min=1e-5)
+            denominator = ((Z_batch @ MTM) * Z_batch).sum(axis=1, keepdim=True)
+            S_batch.div_(denominator)
+            S_batch.clip_(min=1e-5)
+            S[idx] = S_batch
     
         def calc_func_grad(Z_batch, S_batch, quad, linear):
             t = (Z_batch @ quad).mul_(S_batch ** 2)
@@ -261,16 +374,34 @@ class EmbeddingOptimizer():
             g -= t
             g.sub_(g.sum(1, keepdim=True))
             
-            return f.item(), g
+            return f, g
     
+        def map_batches(update_batch, batch_size):
+            """Apply ``update_batch`` to every scheduled batch, one color class at a time.
+
+            Batches of the same color class share no edges, so they are dispatched to the thread pool
+            (if any) together; the neighbor-sum buffer is only patched once the whole class is done, in
+            batch order, which keeps results independent of thread timing.
+            """
+            for class_batches in scheduler.class_batches(batch_size=batch_size, mask=frontier):
+                if executor is None:
+                    deltas = list(map(update_batch, class_batches))
+                else:
+                    deltas = list(executor.map(update_batch, class_batches))
+
+                for idx, delta in zip(class_batches, deltas):
+                    neighbor_sum.update(idx, delta)
+
         def update_z_gd(Z):
             step_size = base_step_size / S.square()
             pbar = tqdm(range(N), leave=False, disable=True)
-            for idx in IndependentSet(E_adjacency_list, device=self.context["device"], batch_size=128):
+
+            def update_batch(idx):
                 step_size_scale = 1
                 quad_batch = MTM
-                linear_batch = YM[idx] * S[idx] - torch.index_select(adjacency_matrix, 0, idx) @ Z @ Sigma_x_inv
+                linear_batch = YM[idx] * S[idx] - neighbor_sum.nu[idx] @ Sigma_x_inv
                 Z_batch = Z[idx].contiguous()
+                Z_batch_initial = Z_batch.clone()
                 S_batch = S[idx].contiguous()
                 step_size_batch = step_size[idx].contiguous()
                 func, grad = calc_func_grad(Z_batch, S_batch, quad_batch, linear_batch)
@@ -294,7 +425,11 @@ class EmbeddingOptimizer():
                 assert step_size_scale > .1
                 Z[idx] = Z_batch
                 pbar.set_description(f'Updating Z w/ nbrs via line search: lr={step_size_scale:.1e}')
-                pbar.update(len(idx))
+                pbar.update(len(Z_batch))
+
+                return Z_batch - Z_batch_initial
+
+            map_batches(update_batch, batch_size=128)
             pbar.close()
     
             return Z
@@ -302,24 +437,23 @@ class EmbeddingOptimizer():
         def update_z_gd_nesterov(Z):
             pbar = trange(N, leave=False, disable=True, desc='Updating Z w/ nbrs via Nesterov GD')
            
-            func, grad = calc_func_grad(Z, S, MTM, YM * S - adjacency_matrix @ Z @ Sigma_x_inv / 2)
-            for idx in IndependentSet(E_adjacency_list, device=self.context["device"], batch_size=1024):
+            def update_batch(idx):
                 quad_batch = MTM
-                linear_batch_spatial = - torch.index_select(adjacency_matrix, 0, idx) @ Z @ Sigma_x_inv
+                linear_batch_spatial = - neighbor_sum.nu[idx] @ Sigma_x_inv
                 Z_batch = Z[idx].contiguous()
+                Z_batch_initial = Z_batch.clone()
                 S_batch = S[idx].contiguous()
                     
                 optimizer = NesterovGD(Z_batch, base_step_size / S_batch.square())
-                ppbar = trange(100, leave=False, disable=not (self.verbose > 3))
-                for i_iter in ppbar:
+                loop = OptimizationLoop(100, tol=tol, check_every=self.convergence_check_frequency,
+                        verbose=self.verbose > 3, description="Updating Z w/ nbrs via Nesterov GD", leave=False)
+                for i_iter in loop:
                     if self.embedding_acceleration_trick:
-                        update_s() # TODO: update S_batch directly
+                        # Only the cells in this batch moved, so only their size factors need refreshing
+                        update_s(idx)
                     S_batch = S[idx].contiguous()
                     linear_batch = linear_batch_spatial + YM[idx] * S_batch
-                    if i_iter == 0:
-                        func, grad = calc_func_grad(Z_batch, S_batch, quad_batch, linear_batch)
-                        func, grad = calc_func_grad(Z, S, MTM, YM * S - adjacency_matrix @ Z @ Sigma_x_inv / 2)
-                    NesterovGD.step_size = base_step_size / S_batch.square() # TM: I think this converges as s converges
+                    optimizer.step_size = base_step_size / S_batch.square() # TM: I think this converges as s converges
                     func, grad = calc_func_grad(Z_batch, S_batch, quad_batch, linear_batch)
                     # grad_limit = torch.quantile(torch.abs(grad), 0.9)
                     # max_before = torch.max(torch.abs(grad))
@@ -344,25 +478,103 @@ class EmbeddingOptimizer():
 
                     optimizer.set_parameters(Z_batch)
 
-                    dZ = (Z_batch_prev - Z_batch).abs().max().item()
+                    dZ = (Z_batch_prev - Z_batch).abs().max()
                     Z[idx] = Z_batch
-                    description = (
-                        f'func={func:.1e}, dZ={dZ:.1e}'
-                    )
-                    ppbar.set_description(description)
-                    if dZ < tol:
-                        break
-                ppbar.close()
+                    loop.record(func, dZ)
                 
                 Z[idx] = Z_batch
-                func, grad = calc_func_grad(Z_batch, S_batch, quad_batch, linear_batch)
-                func, grad = calc_func_grad(Z, S, MTM, YM * S - adjacency_matrix @ Z @ Sigma_x_inv /2 )
-                pbar.update(len(idx))
+                pbar.update(len(Z_batch))
+
+                return Z_batch - Z_batch_initial
+
+            map_batches(update_batch, batch_size=1024)
             pbar.close()
-            func, grad = calc_func_grad(Z, S, MTM, YM * S - adjacency_matrix @ Z @ Sigma_x_inv / 2)
     
             return Z
     
+        def update_z_active_set(Z):
+            pbar = trange(N, leave=False, disable=True, desc='Updating Z w/ nbrs via active set')
+            max_alternations = 10 if self.embedding_acceleration_trick else 1
+
+            def update_batch(idx):
+                linear_batch_spatial = - neighbor_sum.nu[idx] @ Sigma_x_inv
+                Z_batch_initial = Z[idx].clone()
+                Z_batch = Z_batch_initial
+                # Alternate exact solves for Z_batch with closed-form updates of S_batch
+                for _ in range(max_alternations):
+                    S_batch = S[idx].contiguous()
+                    linear_batch = linear_batch_spatial + YM[idx] * S_batch
+                    Z_batch_prev = Z_batch
+                    Z_batch = solve_simplex_qp(MTM, linear_batch / S_batch.square(), Z_batch)
+                    Z[idx] = Z_batch
+                    if self.embedding_acceleration_trick:
+                        update_s(idx)
+                    dZ = (Z_batch_prev - Z_batch).abs().max().item()
+                    if dZ < tol:
+                        break
+
+                pbar.set_description(f'Updating Z w/ nbrs via active set: dZ={dZ:.1e}')
+                pbar.update(len(Z_batch))
+
+                return Z_batch - Z_batch_initial
+
+            map_batches(update_batch, batch_size=1024)
+            pbar.close()
+
+            return Z
+
+        def update_z_jacobi(Z):
+            """Update all cells at once via projected gradient descent on the full objective.
+
+            The spatial term of every cell is taken from the previous iterate, so each trial step costs a
+            single sparse matmul. Steps are only accepted if they decrease the objective. Cells outside of the
+            frontier are held fixed.
+            """
+            step_size = base_step_size / S.square()
+            quad_scale = S.square()
+            linear_nonspatial = YM * S
+
+            def calc_func(Z, nu):
+                quadratic_term = (Z @ MTM).mul_(quad_scale)
+                spatial_term = nu @ Sigma_x_inv
+                func = ((quadratic_term / 2 - linear_nonspatial + spatial_term / 2) * Z).sum().item()
+                return func, quadratic_term, spatial_term
+
+            nu = neighbor_sum.nu
+            func, quadratic_term, spatial_term = calc_func(Z, nu)
+            grad = quadratic_term - linear_nonspatial + spatial_term
+            step_size_scale = 1
+            pbar = trange(100, leave=False, disable=not (self.verbose > 3), desc='Updating Z w/ nbrs via Jacobi GD')
+            for i_iter in pbar:
+                Z_new = Z - step_size * step_size_scale * grad
+                if self.use_inplace_ops:
+                    Z_new = project2simplex_(Z_new, dim=1)
+                else:
+                    Z_new = project2simplex(Z_new, dim=1)
+
+                if frontier is not None:
+                    Z_new = torch.where(frontier[:, None], Z_new, Z)
+
+                nu_new = neighbor_sum.adjacency_matrix @ Z_new
+                func_new, quadratic_term, spatial_term = calc_func(Z_new, nu_new)
+                if func_new < func:
+                    dZ = (Z_new - Z).abs().max().item()
+                    Z, nu, func = Z_new, nu_new, func_new
+                    grad = quadratic_term - linear_nonspatial + spatial_term
+                    step_size_scale *= 1.1
+                    pbar.set_description(f'Updating Z w/ nbrs via Jacobi GD: func={func:.1e}, dZ={dZ:.1e}')
+                    if dZ < tol:
+                        break
+                else:
+                    step_size_scale *= .5
+                    if step_size_scale < 1e-4:
+                        break
+            pbar.close()
+
+            neighbor_sum.nu = nu
+
+            return Z
+
         def compute_loss():
             X = Z * S
             loss = ((X @ MTM) * X).sum() / 2 - (X * YM).sum() + Ynorm / 2
@@ -374,19 +586,25 @@ class EmbeddingOptimizer():
                 raise NotImplementedError
     
             if Sigma_x_inv is not None:
-                loss += ((adjacency_matrix @ Z) @ Sigma_x_inv).mul(Z).sum() / 2
+                loss += (neighbor_sum.nu @ Sigma_x_inv).mul(Z).sum() / 2
             loss = loss.item()
             # assert loss <= loss_prev, (loss_prev, loss)
             return loss
     
-        # TM: consider combine compute_loss and update_z to remove a call to torch.sparse.mm
-        # TM: the above idea is not practical if we update only a subset of nodes each time
+        # The neighbor-sum buffer is patched after every batch, so compute_loss and the batch
+        # linear terms never need a full sparse matmul; it is only refreshed once per epoch to
+        # keep rounding errors from accumulating.
+    
+        # With frontier scheduling, epochs after the first only visit cells that are still moving and
+        # their neighbors, whose linear terms depend on them.
     
         loss = np.inf
-        pbar = trange(self.embedding_mini_iterations, disable=not self.verbose, desc='Updating weight w/ neighbors')
+        frontier = update_mask
+        pbar = trange(n_epochs, disable=not self.verbose, desc='Updating weight w/ neighbors')
     
         for epoch in pbar:
             update_s()
+            neighbor_sum.reset(Z)
             Z_prev = Z.clone().detach()
             # We may use Nesterov first and then vanilla GD in later iterations
             # update_z_mu(Z)
@@ -395,6 +613,12 @@ class EmbeddingOptimizer():
                 Z = update_z_gd(Z)
             elif update_alg == "nesterov":
                 Z = update_z_gd_nesterov(Z)
+            elif update_alg == "active set":
+                Z = update_z_active_set(Z)
+            elif update_alg == "jacobi":
+                Z = update_z_jacobi(Z)
+            else:
+                raise NotImplementedError(f"Embedding update algorithm `{update_alg}` is not implemented.")
     
             loss_prev = loss
             loss = compute_loss()
@@ -406,16 +630,85 @@ class EmbeddingOptimizer():
                 f'δZ = {dZ:.1e}'
             )
             if dZ < tol: break
-    
+
+            if self.embedding_frontier_scheduling:
+                moved = ((Z_prev - Z).abs().amax(dim=1, keepdim=True) >= tol).to(Z.dtype)
+                frontier = (moved + neighbor_sum.adjacency_matrix @ moved).squeeze(1) > 0
+                if update_mask is not None:
+                    frontier &= update_mask
+    
+        if executor is not None:
+            executor.shutdown()
+
         X_final = Z * S
+        if scheduler.contiguous:
+            X_final = X_final[scheduler.inverse_permutation]
+
         return loss, X_final
+
+    @torch.no_grad()
+    def estimate_weight_wnbr_tiled(self, Y, M, X, sigma_yx, prior_x_mode, prior_x, dataset, tol=1e-5, update_alg=None):
+        """Estimate updated weights taking neighbor-neighbor interactions into account, one spatial tile at a time.
+
+        Every sweep visits each tile of :meth:`get_tiling` in turn: the expression and embeddings of its cells
+        and their one-hop halo are moved to the compute device, the interior cells are updated for one epoch of
+        :meth:`estimate_weight_wnbr` with the halo held fixed, and the interior results are written back before
+        the next tile is visited. Halo values are therefore exchanged between tiles as sweeps proceed.
+
+        ``Y`` is only indexed tile by tile, so if it lives on the host (as it does when ``embedding_tile_size`` is
+        set) or on disk, the device only ever holds the expression of the largest tile. The (N, K) embeddings
+        ``X`` and the per-tile graph structures stay on the device.
+        """
+        tiles = self.get_tiling(dataset)
+        device = self.context["device"]
+        MTM = self.sufficient_statistics[dataset.name].MTM(M) / (sigma_yx ** 2)
+        Sigma_x_inv = self.parameter_optimizer.spatial_affinity_state[dataset.name].to(device)
+        X = X.clone()
+
+        def load_tile(cells):
+            return index_rows(Y, cells).to(device), X[cells.to(X.device)].to(device)
+
+        def compute_loss():
+            loss = 0
+            for cells, num_interior, _, _, interior_adjacency_matrix in tiles:
+                Y_local, X_local = load_tile(cells)
+                Z_local = X_local / torch.linalg.norm(X_local, dim=1, ord=1, keepdim=True)
+                X_interior, Y_interior = X_local[:num_interior], index_rows(Y_local, slice(None, num_interior))
+
+                loss += ((X_interior @ MTM) * X_interior).sum() / 2 - (X_interior * (Y_interior @ M)).sum() / (sigma_yx ** 2) \
+                    + squared_norm(Y_interior) / (sigma_yx ** 2) / 2
+                if prior_x_mode == 'exponential shared fixed':
+                    loss += prior_x[0][0] * X_interior.sum()
+
+                loss += ((interior_adjacency_matrix @ Z_local) @ Sigma_x_inv).mul(Z_local[:num_interior]).sum() / 2
+
+            return loss.item()
+
+        pbar = trange(self.embedding_mini_iterations, disable=not self.verbose, desc='Updating weight w/ neighbors (tiled)')
+        for epoch in pbar:
+            dZ = 0
+            for cells, num_interior, scheduler, neighbor_sum, _ in tiles:
+                Y_local, X_local = load_tile(cells)
+                update_mask = torch.arange(len(cells), device=device) < num_interior
+
+                _, X_local_new = self.estimate_weight_wnbr(Y_local, M, X_local, sigma_yx, prior_x_mode, prior_x, dataset,
+                        tol=tol, update_alg=update_alg, update_mask=update_mask, scheduler=scheduler,
+                        neighbor_sum=neighbor_sum, n_epochs=1)
+
+                X_interior = X_local_new[:num_interior]
+                Z_interior_prev = X_local[:num_interior] / torch.linalg.norm(X_local[:num_interior], dim=1, ord=1, keepdim=True)
+                Z_interior = X_interior / torch.linalg.norm(X_interior, dim=1, ord=1, keepdim=True)
+                dZ = max(dZ, (Z_interior - Z_interior_prev).abs().max().item())
+                X[cells[:num_interior].to(X.device)] = X_interior.to(X.device)
+
+            pbar.set_description(f'Updating weight w/ neighbors (tiled): δZ = {dZ:.1e}')
+            if dZ < tol: break
+
+        return compute_loss(), X
     
     @torch.no_grad()
     def nll_weight_wnbr(self, Y, M, X, sigma_yx, prior_x_mode, prior_x, dataset, tol=1e-5, update_alg='nesterov'):
-        # Precomputing quantities
-        MTM = M.T @ M / (sigma_yx ** 2)
-        YM = Y.to(M.device) @ M / (sigma_yx ** 2)
-        Ynorm = torch.linalg.norm(Y, ord='fro').item() ** 2 / (sigma_yx ** 2)
+        squared_error = self.sufficient_statistics[dataset.name].squared_error(Y, X, M)
         S = torch.linalg.norm(X, dim=1, ord=1, keepdim=True)
 
         Z = X / S
@@ -426,8 +719,7 @@ class EmbeddingOptimizer():
         Sigma_x_inv = self.parameter_optimizer.spatial_affinity_state[dataset.name].to(self.context["device"])
         
         def compute_loss():
-            X = Z * S
-            loss = ((X @ MTM) * X).sum() / 2 - (X * YM).sum() + Ynorm / 2
+            loss = torch.tensor(squared_error / (sigma_yx ** 2) / 2, **self.context)
             if prior_x_mode == 'exponential shared fixed':
                 loss += prior_x[0][0] * S.sum()
             elif not prior_x_mode:
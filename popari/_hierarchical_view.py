@@ -4,13 +4,13 @@ from typing import Sequence, Optional
 from tqdm.auto import trange
 
 import numpy as np
-from scipy.sparse import csr_array
+from scipy.sparse import csr_array, issparse
 
 import torch
 
 from collections import defaultdict
 
-from popari.util import get_datetime, convert_numpy_to_pytorch_sparse_coo
+from popari.util import get_datetime, convert_numpy_to_pytorch_sparse_coo, convert_scipy_to_pytorch_sparse_csr, BackedExpression
 from popari.initialization import initialize_kmeans, initialize_svd, initialize_leiden, initialize_dummy
 from popari._dataset_utils import _spatial_binning
 
@@ -95,11 +95,25 @@ class HierarchicalView():
         parameter_optimizer_hyperparameters["spatial_affinity_groups"] = self.spatial_affinity_groups
         parameter_optimizer_hyperparameters["spatial_affinity_tags"] = self.spatial_affinity_tags
         
+        # With spatial tiling, in-memory expression is kept on the host and only moved to the device tile by tile
+        self.expression_context = self.context
+        if embedding_optimizer_hyperparameters.get("embedding_tile_size") is not None:
+            self.expression_context = {**self.context, "device": "cpu"}
+
         if binned_Ys is None:
             self.Ys = []
             for dataset in self.datasets:
-                Y = torch.tensor(dataset.X, **self.context)
-                Y *= (self.K * 1) / Y.sum(axis=1, keepdim=True).mean()
+                if BackedExpression.is_backed(dataset.X):
+                    # Expression stays on disk; Y-dependent statistics are streamed in chunks of rows
+                    Y = BackedExpression(dataset.X, self.context)
+                    Y = Y * ((self.K * 1) / (Y.sum() / len(Y)))
+                elif issparse(dataset.X):
+                    # Sparse expression stays sparse; all Y-dependent statistics use sparse kernels
+                    Y = convert_scipy_to_pytorch_sparse_csr(dataset.X, self.expression_context)
+                    Y = Y * ((self.K * 1) / dataset.X.sum(axis=1).mean())
+                else:
+                    Y = torch.tensor(dataset.X, **self.expression_context)
+                    Y *= (self.K * 1) / Y.sum(axis=1, keepdim=True).mean()
                 self.Ys.append(Y)
         else:
             self.Ys = binned_Ys
@@ -278,16 +292,17 @@ class HierarchicalView():
             prior_x = self.parameter_optimizer.prior_xs[dataset_index]
 
             # Precomputing quantities 
-            MTM = M.T @ M / (sigma_yx ** 2)
+            statistics = self.embedding_optimizer.sufficient_statistics[dataset.name]
+            MTM = statistics.MTM(M) / (sigma_yx ** 2)
             BTB = convert_numpy_to_pytorch_sparse_coo((B.T @ B).tocoo(), context=self.context)
-            YM = Y @ M / (sigma_yx ** 2)
+            YM = statistics.YM(Y, M) / (sigma_yx ** 2)
             BTX_B = torch.from_numpy(B.T @ X_B).to(self.context["device"])
 
             linear_term_gradient = YM + BTX_B
             if prior_x_mode == 'exponential shared fixed':
                 linear_term_gradient = linear_term_gradient - prior_x[0][None]
 
-            Ynorm = torch.linalg.norm(Y, ord='fro').item() ** 2 / (sigma_yx ** 2)
+            Ynorm = statistics.Y_norm(Y) / (sigma_yx ** 2)
             X_Bnorm = np.linalg.norm(X_B, ord='fro').item() ** 2
             loss_prev, loss = np.inf, np.nan
           
@@ -446,15 +461,13 @@ class HierarchicalView():
                 prior_x = self.parameter_optimizer.prior_xs[dataset_index]
                     
                 # Precomputing quantities
-                MTM = M.T @ M / (sigma_yx ** 2)
-                YM = Y.to(M.device) @ M / (sigma_yx ** 2)
-                Ynorm = torch.linalg.norm(Y, ord='fro').item() ** 2 / (sigma_yx ** 2)
+                statistics = self.embedding_optimizer.sufficient_statistics[dataset.name]
                 S = torch.linalg.norm(X, dim=1, ord=1, keepdim=True)
 
                 Z = X / S
                 N, G = Y.shape
                 
-                loss = ((X @ MTM) * X).sum() / 2 - (X * YM).sum() + Ynorm / 2
+                loss = statistics.squared_error(Y, X, M) / (sigma_yx ** 2) / 2
 
                 logZ_i_Y = torch.full((N,), G/2 * np.log((2 * np.pi * sigma_yx**2)), **self.context)
                 if not use_spatial:
@@ -533,7 +546,6 @@ def construct_hierarchy(base_view: HierarchicalView, chunks: int = 16, downsampl
 
     """
     hierarchy = {0: base_view}
-    context = base_view.context
     previous_view = base_view
     original_names = [dataset.name for dataset in previous_view.datasets]
     for level in range(1, levels):
@@ -556,7 +568,7 @@ def construct_hierarchy(base_view: HierarchicalView, chunks: int = 16, downsampl
             chunk_1d_density = binned_dataset.uns["chunk_1d_density"]
 
             binned_datasets.append(binned_dataset)
-            binned_Y = convert_numpy_to_pytorch_sparse_coo(binned_dataset.obsm[f"bin_assignments_{binned_dataset.name}"].tocoo(), context=context) @ previous_Y
+            binned_Y = convert_scipy_to_pytorch_sparse_csr(binned_dataset.obsm[f"bin_assignments_{binned_dataset.name}"], context=previous_view.expression_context) @ previous_Y
             binned_Ys.append(binned_Y)
 
         level_view = HierarchicalView(binned_datasets, superresolution_lr=superresolution_lr,
@@ -574,7 +586,6 @@ def reconstruct_hierarchy(reloaded_hierarchy: dict, superresolution_lr: float =
     """
 
     hierarchy = {}
-    context = hierarchical_view_kwargs["context"]
     binned_Ys = None
     previous_view = None
     for level in range(hierarchical_view_kwargs["hierarchical_levels"]):
@@ -585,7 +596,7 @@ def reconstruct_hierarchy(reloaded_hierarchy: dict, superresolution_lr: float =
             for dataset, previous_Y in zip(datasets, previous_view.Ys):
                 B = dataset.obsm[f"bin_assignments_{dataset.name}"]
                 dataset.obsm[f"bin_assignments_{dataset.name}"] = csr_array(B)
-                binned_Y = convert_numpy_to_pytorch_sparse_coo(dataset.obsm[f"bin_assignments_{dataset.name}"], context=context) @ previous_Y
+                binned_Y = convert_scipy_to_pytorch_sparse_csr(dataset.obsm[f"bin_assignments_{dataset.name}"], context=previous_view.expression_context) @ previous_Y
                 binned_Ys.append(binned_Y)
 
         level_view = HierarchicalView(datasets, superresolution_lr=superresolution_lr,
@@ -4,7 +4,7 @@ import numpy as np
 import torch
 
 from popari.sample_for_integral import integrate_of_exponential_over_simplex
-from popari.util import NesterovGD, IndependentSet, sample_graph_iid, project2simplex, project2simplex_, project_M, project_M_, get_datetime, convert_numpy_to_pytorch_sparse_coo
+from popari.util import DEBUG, NesterovGD, OptimizationLoop, IndependentSet, sample_graph_iid, project2simplex, project2simplex_, project_M, project_M_, get_datetime, convert_numpy_to_pytorch_sparse_coo, compress_rows, compute_log_partition_function, StochasticLogPartitionFunction, solve_projected_fista
 from popari.components import PopariDataset
 
 class ParameterOptimizer():
@@ -28,6 +28,11 @@ class ParameterOptimizer():
             lambda_M=0.5,
             lambda_Sigma_bar=0.5,
             spatial_affinity_lr=1e-3,
+            spatial_affinity_solver="adam",
+            spatial_affinity_batched=False,
+            spatial_affinity_coreset_resolution=None,
+            metagene_solver="nesterov",
+            convergence_check_frequency=10,
             M_constraint="simplex",
             sigma_yx_inv_mode="separate",
             initial_context=None,
@@ -35,6 +40,18 @@ class ParameterOptimizer():
             use_inplace_ops=False,
             verbose=0
     ):
+        if spatial_affinity_solver not in ("adam", "lbfgs"):
+            raise ValueError(f"`spatial_affinity_solver` must be one of `adam` or `lbfgs`, not `{spatial_affinity_solver}`.")
+
+        if spatial_affinity_solver == "lbfgs" and spatial_affinity_constraint is not None:
+            raise ValueError("`spatial_affinity_constraint` is not supported with the `lbfgs` spatial affinity solver.")
+
+        if spatial_affinity_batched and spatial_affinity_solver != "adam":
+            raise ValueError("`spatial_affinity_batched` is only supported with the `adam` spatial affinity solver.")
+
+        if metagene_solver not in ("nesterov", "fista"):
+            raise ValueError(f"`metagene_solver` must be one of `nesterov` or `fista`, not `{metagene_solver}`.")
+
         self.verbose = verbose
         self.use_inplace_ops = use_inplace_ops
 
@@ -51,11 +68,16 @@ class ParameterOptimizer():
         self.spatial_affinity_constraint = spatial_affinity_constraint
         self.spatial_affinity_centering = spatial_affinity_centering
         self.spatial_affinity_lr = spatial_affinity_lr
+        self.spatial_affinity_solver = spatial_affinity_solver
+        self.spatial_affinity_batched = spatial_affinity_batched
+        self.spatial_affinity_coreset_resolution = spatial_affinity_coreset_resolution
         self.spatial_affinity_scaling = spatial_affinity_scaling
         self.lambda_Sigma_x_inv = lambda_Sigma_x_inv
         self.spatial_affinity_tol=spatial_affinity_tol
         self.lambda_M = lambda_M
         self.metagene_mode = metagene_mode
+        self.metagene_solver = metagene_solver
+        self.convergence_check_frequency = convergence_check_frequency
         self.M_constraint = M_constraint
         self.prior_x_modes = prior_x_modes
         self.betas = betas
@@ -93,6 +115,7 @@ class ParameterOptimizer():
             mode=self.spatial_affinity_mode,
             initial_context=self.initial_context,
             lr=self.spatial_affinity_lr,
+            batched=self.spatial_affinity_batched,
             context=self.context
         )
         
@@ -110,6 +133,7 @@ class ParameterOptimizer():
         
         """
         self.embedding_optimizer = embedding_optimizer
+        self.sufficient_statistics = embedding_optimizer.sufficient_statistics
        
     def scale_metagenes(self):
         norm_axis = 1
@@ -142,6 +166,8 @@ class ParameterOptimizer():
         Args:
             Xs: list of latent expression embeddings for each FOV.
             Sigma_x_inv: previous estimate of Σx-1
+            subsample_rate: if set, fraction of nodes of each replicate that is sampled to estimate the
+                log-partition function in every epoch
     
         """
         datasets = [dataset for (use_replicate, dataset) in zip(replicate_mask, self.datasets) if use_replicate]
@@ -162,7 +188,7 @@ class ParameterOptimizer():
         nus = [] # sum of neighbors' z
         weighted_total_cells = 0
 
-        for Z, dataset, use_spatial, beta in zip(Zs, datasets, spatial_flags, self.betas):
+        for Z, dataset, use_spatial, beta in zip(Zs, datasets, spatial_flags, betas):
             adjacency_list = self.adjacency_lists[dataset.name]
             adjacency_matrix = self.adjacency_matrices[dataset.name]
 
@@ -175,26 +201,22 @@ class ParameterOptimizer():
             nus.append(nu)
             weighted_total_cells += beta * sum(map(len, adjacency_list))
             del Z, adjacency_matrix
+
+        # Neighbor sums stay fixed during the solve, so near-duplicate rows can be merged once up front
+        use_coreset = self.spatial_affinity_coreset_resolution is not None and subsample_rate is None
+        coreset_nus, coreset_weights = nus, None
+        if use_coreset:
+            coreset_nus, coreset_weights = zip(*[(None, None) if nu is None else compress_rows(nu, self.spatial_affinity_coreset_resolution) for nu in nus])
+            if self.verbose > 1:
+                num_rows = sum(len(nu) for nu in nus if nu is not None)
+                num_coreset_rows = sum(len(nu) for nu in coreset_nus if nu is not None)
+                print(f"Compressed {num_rows} neighbor sums into a coreset of {num_coreset_rows}")
+
         # linear_term_coefficient = (linear_term_coefficient + linear_term_coefficient.T) / 2 # should be unnecessary as long as adjacency_list is symmetric
         if self.verbose > 2:
             print(f"spatial affinity linear term coefficient range: {linear_term_coefficient.min().item():.2e} ~ {linear_term_coefficient.max().item():.2e}")
     
-        history = []
-        Sigma_x_inv.requires_grad_(True)
-   
-        loss_prev, loss = np.inf, np.nan
-        
-        verbose_bar = tqdm(disable=not (self.verbose > 2), bar_format='{desc}{postfix}')
-        progress_bar = trange(1, n_epochs+1, disable=not self.verbose, desc='Updating Σx-1')
-
-        Sigma_x_inv_best, loss_best, epoch_best = None, np.inf, -1
-        dSigma_x_inv = np.inf
-        early_stop_epoch_count = 0
-        Sigma_x_inv_prev = Sigma_x_inv.clone().detach()
-        for epoch in progress_bar:
-            optimizer.zero_grad()
-    
-            # Compute loss 
+        def compute_loss(Sigma_x_inv, exact=False, stochastic=False):
             linear_term = Sigma_x_inv.view(-1) @ linear_term_coefficient.view(-1)
             regularization = torch.zeros(1, **self.context)
             if Sigma_x_inv_bar is not None:
@@ -204,31 +226,59 @@ class ParameterOptimizer():
 
             regularization += self.lambda_Sigma_x_inv * Sigma_x_inv.abs().pow(self.spatial_affinity_regularization_power).sum() * weighted_total_cells / 2
             
-            log_partition_function = 0
-            for nu, beta in zip(nus, self.betas):
-                if subsample_rate is None:
-                    subsample_index = np.arange(len(dataset))
-                    subsample_multiplier = 1
-                else:
-                    node_limit = int(subsample_rate * len(dataset))
-                    subsample_index = np.sort(sample_graph_iid(adjacency_list, range(len(dataset)), node_limit))
-                    subsample_multiplier = 1 / subsample_rate
-                    nu = nu[subsample_index]
-
-                if nu is None:
-                    continue
-                assert torch.isfinite(nu).all()
-                assert torch.isfinite(Sigma_x_inv).all()
-                eta = nu @ Sigma_x_inv
-                logZ = integrate_of_exponential_over_simplex(eta)
-                log_partition_function += subsample_multiplier * beta * logZ.sum()
+            if exact:
+                log_partition_function = compute_log_partition_function(Sigma_x_inv, nus, betas)
+            elif stochastic:
+                log_partition_function = estimate_log_partition_function(Sigma_x_inv)
+            else:
+                log_partition_function = compute_log_partition_function(Sigma_x_inv, coreset_nus, betas, nu_weights=coreset_weights)
     
             loss = (linear_term + regularization + log_partition_function) / weighted_total_cells
+
+            return loss, linear_term, regularization, log_partition_function
+
+        # Stochastic variance-reduced (SVRG) estimate of the log-partition function from mini-batches of nodes
+        if subsample_rate is not None:
+            estimate_log_partition_function = StochasticLogPartitionFunction(nus, betas, subsample_rate)
+
+        def compute_exact_loss(Sigma_x_inv, approximate_loss):
+            """Re-evaluate the final loss on all neighbor sums if the solve used a coreset or subsampling."""
+            if not (use_coreset or subsample_rate is not None):
+                return approximate_loss
+
+            with torch.no_grad():
+                loss, *_ = compute_loss(Sigma_x_inv, exact=True)
+            loss = loss.item() * weighted_total_cells
+            if self.verbose:
+                print(f"Σx-1 approximate loss: {float(approximate_loss):.6e}; exact loss: {loss:.6e}")
+
+            return loss
+
+        if self.spatial_affinity_solver == "lbfgs":
+            # The line search needs deterministic function values, so subsampling is not used here
+            Sigma_x_inv, loss = self.estimate_Sigma_x_inv_lbfgs(Sigma_x_inv, compute_loss, weighted_total_cells, max_iterations=min(n_epochs, 100))
+            return Sigma_x_inv, compute_exact_loss(Sigma_x_inv, loss)
+
+        Sigma_x_inv.requires_grad_(True)
+        
+        verbose_bar = tqdm(disable=not (self.verbose > 2), bar_format='{desc}{postfix}')
+
+        # The best iterate is tracked on the device; losses and changes of Σx-1 are only synchronized every
+        # `check_frequency` epochs
+        loop = OptimizationLoop(n_epochs, tol=tol * check_frequency, check_every=check_frequency,
+                patience=2 * check_frequency, verbose=self.verbose, description='Updating Σx-1')
+        Sigma_x_inv_best = Sigma_x_inv.detach().clone()
+        loss_best = torch.tensor(np.inf, **self.context)
+        Sigma_x_inv_prev = Sigma_x_inv.clone().detach()
+        for epoch in loop:
+            optimizer.zero_grad()
+    
+            loss, linear_term, regularization, log_partition_function = compute_loss(Sigma_x_inv, stochastic=subsample_rate is not None)
   
-            if loss < loss_best:
-                Sigma_x_inv_best = Sigma_x_inv.clone().detach()
-                loss_best = loss.item()
-                epoch_best = epoch
+            with torch.no_grad():
+                improved = loss < loss_best
+                loss_best = torch.where(improved, loss, loss_best)
+                Sigma_x_inv_best = torch.where(improved, Sigma_x_inv, Sigma_x_inv_best)
     
             loss.backward()
             Sigma_x_inv.grad = (Sigma_x_inv.grad + Sigma_x_inv.grad.T) / 2
@@ -242,42 +292,26 @@ class ParameterOptimizer():
                 elif self.spatial_affinity_constraint == "scale":
                     Sigma_x_inv.mul_(self.spatial_affinity_state.scaling / Sigma_x_inv.abs().max())
 
-                if epoch % check_frequency == 0:
-                    loss = loss.item()
-                    dloss = loss_prev - loss
-                    loss_prev = loss
-                    regularization_prev = regularization.item()
-                    log_partition_function_prev = log_partition_function.item()
-                    linear_term_prev = linear_term.item()
-            
-                    history.append((Sigma_x_inv.detach().cpu().numpy(), loss))
-    
-    
-                    dSigma_x_inv = Sigma_x_inv_prev.sub(Sigma_x_inv).abs().max().item()
+                dSigma_x_inv = None
+                if (epoch + 1) % check_frequency == 0:
+                    dSigma_x_inv = Sigma_x_inv_prev.sub(Sigma_x_inv).abs().max()
                     Sigma_x_inv_prev = Sigma_x_inv.clone().detach()
            
-                    description = (
-                        f'Updating Σx-1: loss = {dloss:.1e} -> {loss:.1e} '
-                        f'δΣx-1 = {dSigma_x_inv:.1e} '
-                        f'Σx-1 range = {Sigma_x_inv.min().item():.1e} ~ {Sigma_x_inv.max().item():.1e}'
-                    )
-
-                    verbose_description = (
-                            f"Spatial affinity average: {Sigma_x_inv.mean().item():.1e} "
-                            f"Total spatial affinity loss: {loss:.1e} "
-                            f"spatial affinity linear term {linear_term:.6e} "
-                            f"spatial affinity regularization {regularization.item():.1e} "
-                            f"spatial affinity log_partition_function {log_partition_function:.1e} "
-                        )
-
-                    verbose_bar.set_description_str(verbose_description)
-                    progress_bar.set_description(description)
-   
-                    if dSigma_x_inv < tol * check_frequency or epoch > epoch_best + 2 * check_frequency:
-                        break
+                    if self.verbose > 2:
+                        verbose_description = (
+                                f"Spatial affinity average: {Sigma_x_inv.mean().item():.1e} "
+                                f"Σx-1 range = {Sigma_x_inv.min().item():.1e} ~ {Sigma_x_inv.max().item():.1e} "
+                                f"Total spatial affinity loss: {float(loss):.1e} "
+                                f"spatial affinity linear term {float(linear_term):.6e} "
+                                f"spatial affinity regularization {float(regularization):.1e} "
+                                f"spatial affinity log_partition_function {float(log_partition_function):.1e} "
+                            )
+                        verbose_bar.set_description_str(verbose_description)
+
+                loop.record(loss.detach(), dSigma_x_inv)
    
         verbose_bar.close()
-        progress_bar.close()
+        loss = loop.loss
 
         # with torch.no_grad():
         #     offset = -Sigma_x_inv.mean()
@@ -321,8 +355,210 @@ class ParameterOptimizer():
         Sigma_x_inv = Sigma_x_inv_best
         Sigma_x_inv.requires_grad_(False)
        
-        return Sigma_x_inv, loss * weighted_total_cells
+        return Sigma_x_inv, compute_exact_loss(Sigma_x_inv, loss * weighted_total_cells)
     
+    def estimate_Sigma_x_inv_lbfgs(self, Sigma_x_inv, compute_loss, weighted_total_cells, max_iterations=100):
+        """Optimize Sigma_x_inv parameters with L-BFGS.
+
+        The objective is smooth and has only K(K+1)/2 free parameters, so a quasi-Newton method with a strong
+        Wolfe line search typically converges in a few dozen function evaluations, each of which is a single
+        pass over the neighbor sums. Symmetry is enforced by optimizing only the upper triangle of Σx-1, and
+        centering (if set) by subtracting the mean in the parameterization, so the solver converges to the same
+        constrained optimum as Adam. Range constraints are not supported.
+
+        Args:
+            Sigma_x_inv: initial estimate of Σx-1
+            compute_loss: function mapping Σx-1 to the (normalized) loss and its components
+            weighted_total_cells: normalization constant of the loss
+            max_iterations: maximum number of L-BFGS iterations
+        """
+        K, _ = Sigma_x_inv.shape
+        row_indices, column_indices = torch.triu_indices(K, K, device=Sigma_x_inv.device)
+
+        def unpack(parameters):
+            upper_triangle = torch.zeros((K, K), **self.context).index_put((row_indices, column_indices), parameters)
+            Sigma_x_inv = upper_triangle + upper_triangle.T - torch.diag(upper_triangle.diagonal())
+            if self.spatial_affinity_centering:
+                Sigma_x_inv = Sigma_x_inv - Sigma_x_inv.mean()
+
+            return Sigma_x_inv
+
+        parameters = Sigma_x_inv.detach()[row_indices, column_indices].clone().requires_grad_(True)
+        optimizer = torch.optim.LBFGS([parameters], lr=1, max_iter=max_iterations, tolerance_grad=1e-7,
+                tolerance_change=1e-10, history_size=10, line_search_fn="strong_wolfe")
+
+        progress_bar = tqdm(disable=not self.verbose, desc='Updating Σx-1 via L-BFGS')
+        def closure():
+            optimizer.zero_grad()
+            loss, *_ = compute_loss(unpack(parameters))
+            loss.backward()
+            progress_bar.set_description(f'Updating Σx-1 via L-BFGS: loss = {loss.item():.1e}')
+            progress_bar.update(1)
+            return loss
+
+        optimizer.step(closure)
+        progress_bar.close()
+
+        with torch.no_grad():
+            Sigma_x_inv = unpack(parameters)
+            loss, *_ = compute_loss(Sigma_x_inv)
+
+        return Sigma_x_inv, loss * weighted_total_cells
+
+    def estimate_Sigma_x_invs_batched(self, Sigma_x_invs, optimizer, Sigma_x_inv_bars=None, n_epochs=1000, tol=2e-3, check_frequency=50):
+        """Jointly optimize the Sigma_x_inv parameters of all replicates in differential lookup mode.
+
+        Each replicate's objective only depends on its own slice of ``Sigma_x_invs``, so the replicates are
+        stacked into a single (R, K, K) tensor and updated by a single Adam step per epoch. Log-partition
+        functions of all active replicates are evaluated in one pass over their concatenated neighbor sums.
+        Each replicate stops independently once it meets the same convergence criterion as
+        :meth:`estimate_Sigma_x_inv`; converged replicates are frozen at their best estimate. As there, if the
+        solve used a coreset, the final losses are re-evaluated on all neighbor sums.
+
+        Only used if ``spatial_affinity_batched`` is set, which requires the ``adam`` solver and does not support
+        ``subsample_rate``; otherwise :meth:`update_spatial_affinity` optimizes the replicates one at a time with
+        :meth:`estimate_Sigma_x_inv`. The two paths keep separate Adam states, so only one of them is ever
+        created.
+
+        Args:
+            Sigma_x_invs: (R, K, K) tensor of previous estimates of Σx-1, optimized by ``optimizer``
+            optimizer: optimizer over ``Sigma_x_invs``
+            Sigma_x_inv_bars: if set, mapping from group names to group-level Σx-1 that each replicate is
+                pulled towards
+
+        Returns:
+            Tuple of the (R, K, K) best estimates and the (R,) corresponding losses.
+        """
+        num_replicates, K, _ = Sigma_x_invs.shape
+        device = Sigma_x_invs.device
+
+        nus, nu_weights, exact_nus, linear_term_coefficients, edge_counts = [], [], [], [], []
+        for dataset in self.datasets:
+            X = self.embedding_optimizer.embedding_state[dataset.name].to(self.context["device"])
+            num_edges = sum(map(len, self.adjacency_lists[dataset.name]))
+            if "adjacency_list" not in dataset.obs or num_edges == 0:
+                nus.append(None)
+                nu_weights.append(None)
+                exact_nus.append(None)
+                linear_term_coefficients.append(torch.zeros((K, K), **self.context))
+                edge_counts.append(1)
+                continue
+
+            Z = X / torch.linalg.norm(X, axis=1, ord=1, keepdim=True)
+            nu = self.adjacency_matrices[dataset.name] @ Z
+            linear_term_coefficients.append(Z.T @ nu)
+            exact_nus.append(nu)
+            weights = None
+            if self.spatial_affinity_coreset_resolution is not None:
+                nu, weights = compress_rows(nu, self.spatial_affinity_coreset_resolution)
+
+            nus.append(nu)
+            nu_weights.append(weights)
+            edge_counts.append(num_edges)
+
+        linear_term_coefficients = torch.stack(linear_term_coefficients)
+        edge_counts = torch.tensor(edge_counts, **self.context)
+
+        # Coupling of each replicate to the group-level affinities of its tags
+        if Sigma_x_inv_bars is not None:
+            group_names = list(Sigma_x_inv_bars)
+            stacked_bars = torch.stack([Sigma_x_inv_bars[group_name] for group_name in group_names])
+            tag_weights = torch.zeros((num_replicates, len(group_names)), **self.context)
+            for replicate, dataset in enumerate(self.datasets):
+                tags = self.spatial_affinity_tags[dataset.name]
+                for group_name in tags:
+                    tag_weights[replicate, group_names.index(group_name)] = 1 / len(tags)
+
+        def compute_losses(Sigma_x_invs, active, nus=nus, nu_weights=nu_weights):
+            linear_terms = (Sigma_x_invs * linear_term_coefficients).sum(dim=(1, 2))
+
+            regularization = self.lambda_Sigma_x_inv * Sigma_x_invs.abs().pow(self.spatial_affinity_regularization_power).sum(dim=(1, 2)) * edge_counts / 2
+            if Sigma_x_inv_bars is not None:
+                squared_distances = (stacked_bars[None] - Sigma_x_invs[:, None]).pow(2).sum(dim=(2, 3))
+                regularization = regularization + self.lambda_Sigma_bar * (tag_weights * squared_distances).sum(dim=1) * edge_counts / 2
+
+            etas, weights, replicate_indices = [], [], []
+            for replicate in active:
+                nu = nus[replicate]
+                etas.append(nu @ Sigma_x_invs[replicate])
+                weights.append(torch.ones(len(nu), **self.context) if nu_weights[replicate] is None else nu_weights[replicate])
+                replicate_indices.append(torch.full((len(nu),), replicate, device=device))
+
+            log_partition_functions = torch.zeros(num_replicates, **self.context)
+            if len(etas) > 0:
+                logZ = integrate_of_exponential_over_simplex(torch.cat(etas))
+                log_partition_functions = log_partition_functions.index_add(0, torch.cat(replicate_indices), logZ * torch.cat(weights))
+
+            return (linear_terms + regularization + log_partition_functions) / edge_counts
+
+        active = torch.tensor([nu is not None for nu in nus], device=device)
+        active_replicates = active.nonzero().squeeze(1).tolist()
+        Sigma_x_invs.requires_grad_(True)
+        Sigma_x_invs_best = Sigma_x_invs.detach().clone()
+        Sigma_x_invs_prev = Sigma_x_invs.detach().clone()
+        losses_best = torch.full((num_replicates,), np.inf, **self.context)
+        epochs_best = torch.zeros(num_replicates, dtype=torch.long, device=device)
+
+        progress_bar = trange(1, n_epochs+1, disable=not self.verbose, desc='Updating Σx-1 (batched)')
+        for epoch in progress_bar:
+            if len(active_replicates) == 0:
+                break
+
+            optimizer.zero_grad()
+            losses = compute_losses(Sigma_x_invs, active_replicates)
+
+            with torch.no_grad():
+                improved = active & (losses < losses_best)
+                losses_best = torch.where(improved, losses, losses_best)
+                epochs_best = torch.where(improved, epoch, epochs_best)
+                Sigma_x_invs_best = torch.where(improved[:, None, None], Sigma_x_invs, Sigma_x_invs_best)
+
+            losses.sum().backward()
+            Sigma_x_invs.grad = (Sigma_x_invs.grad + Sigma_x_invs.grad.transpose(1, 2)) / 2
+            optimizer.step()
+            with torch.no_grad():
+                if self.spatial_affinity_centering:
+                    Sigma_x_invs -= Sigma_x_invs.mean(dim=(1, 2), keepdim=True)
+
+                if self.spatial_affinity_constraint == "clamp":
+                    Sigma_x_invs.clamp_(min=-self.spatial_affinity_state.scaling, max=self.spatial_affinity_state.scaling)
+                elif self.spatial_affinity_constraint == "scale":
+                    Sigma_x_invs.mul_(self.spatial_affinity_state.scaling / Sigma_x_invs.abs().amax(dim=(1, 2), keepdim=True))
+
+                # Momentum would otherwise keep moving converged replicates
+                Sigma_x_invs[~active] = Sigma_x_invs_best[~active]
+
+                if epoch % check_frequency == 0:
+                    dSigma_x_invs = Sigma_x_invs_prev.sub(Sigma_x_invs).abs().amax(dim=(1, 2))
+                    Sigma_x_invs_prev = Sigma_x_invs.detach().clone()
+                    converged = (dSigma_x_invs < tol * check_frequency) | (epoch > epochs_best + 2 * check_frequency)
+                    active &= ~converged
+                    active_replicates = active.nonzero().squeeze(1).tolist()
+
+                    if self.verbose:
+                        progress_bar.set_description(
+                            f'Updating Σx-1 (batched): {active.sum().item()}/{num_replicates} active, '
+                            f'mean loss = {losses_best[losses_best.isfinite()].mean().item():.1e}'
+                        )
+
+        progress_bar.close()
+        with torch.no_grad():
+            Sigma_x_invs[:] = Sigma_x_invs_best
+        Sigma_x_invs.requires_grad_(False)
+
+        if self.spatial_affinity_coreset_resolution is not None:
+            # Re-evaluate the final losses on all neighbor sums, as in `estimate_Sigma_x_inv`
+            spatial_replicates = [replicate for replicate, nu in enumerate(exact_nus) if nu is not None]
+            with torch.no_grad():
+                exact_losses = compute_losses(Sigma_x_invs_best, spatial_replicates, nus=exact_nus, nu_weights=[None] * num_replicates)
+            exact_losses = torch.where(losses_best.isfinite(), exact_losses, losses_best)
+            if self.verbose:
+                for dataset, approximate_loss, exact_loss in zip(self.datasets, losses_best * edge_counts, exact_losses * edge_counts):
+                    print(f"Σx-1 approximate loss ({dataset.name}): {approximate_loss.item():.6e}; exact loss: {exact_loss.item():.6e}")
+            losses_best = exact_losses
+
+        return Sigma_x_invs_best, losses_best * edge_counts
+
     def nll_Sigma_x_inv(self, Sigma_x_inv, replicate_mask, Sigma_x_inv_bar=None):
         datasets = [dataset for (use_replicate, dataset) in zip(replicate_mask, self.datasets) if use_replicate]
         betas = [beta for (use_replicate, beta) in zip(replicate_mask, self.betas) if use_replicate]
@@ -342,7 +578,7 @@ class ParameterOptimizer():
         nus = [] # sum of neighbors' z
         weighted_total_cells = 0
 
-        for Z, dataset, use_spatial, beta in zip(Zs, datasets, spatial_flags, self.betas):
+        for Z, dataset, use_spatial, beta in zip(Zs, datasets, spatial_flags, betas):
             adjacency_list = self.adjacency_lists[dataset.name]
             adjacency_matrix = self.adjacency_matrices[dataset.name]
 
@@ -368,11 +604,12 @@ class ParameterOptimizer():
         regularization += self.lambda_Sigma_x_inv * Sigma_x_inv.pow(self.spatial_affinity_regularization_power).sum() * weighted_total_cells / 2
         
         log_partition_function = 0
-        for nu, beta in zip(nus, self.betas):
+        for nu, beta in zip(nus, betas):
             if nu is None:
                 continue
-            assert torch.isfinite(nu).all()
-            assert torch.isfinite(Sigma_x_inv).all()
+            if DEBUG:
+                assert torch.isfinite(nu).all()
+                assert torch.isfinite(Sigma_x_inv).all()
             eta = nu @ Sigma_x_inv
             logZ = integrate_of_exponential_over_simplex(eta)
             log_partition_function += beta * logZ.sum()
@@ -392,6 +629,20 @@ class ParameterOptimizer():
                 with torch.no_grad():
                    self.spatial_affinity_state[first_dataset_name][:] = Sigma_x_inv
 
+        elif self.spatial_affinity_mode == "differential lookup" and self.spatial_affinity_batched:
+            if optimization_kwargs.get("subsample_rate") is not None:
+                raise ValueError("`subsample_rate` is not supported with `spatial_affinity_batched`.")
+
+            if differentiate_spatial_affinities:
+                spatial_affinity_bars = {group_name: spatial_affinity_bar.detach() for group_name, spatial_affinity_bar in self.spatial_affinity_state.spatial_affinity_bar.items()}
+            else:
+                spatial_affinity_bars = None
+
+            Sigma_x_invs = self.spatial_affinity_state.Sigma_x_invs
+            optimizer = self.spatial_affinity_state.batched_optimizer
+            self.estimate_Sigma_x_invs_batched(Sigma_x_invs, optimizer, Sigma_x_inv_bars=spatial_affinity_bars, tol=self.spatial_affinity_tol)
+            self.spatial_affinity_state.reaverage()
+
         elif self.spatial_affinity_mode == "differential lookup":
             for dataset_index, dataset in enumerate(self.datasets):
                 if differentiate_spatial_affinities:
@@ -441,7 +692,30 @@ class ParameterOptimizer():
         return loss_spatial_affinities.cpu().numpy()
 
     def update_metagenes(self, differentiate_metagenes=True, simplex_projection_mode="exact"):
-        if self.metagene_mode == "shared":
+        if self.metagene_solver == "fista" and simplex_projection_mode == "exact":
+            if self.metagene_mode == "shared":
+                group_replicates = list(self.metagene_groups.values())
+                Ms = torch.stack([self.metagene_state[replicates[0]] for replicates in group_replicates])
+                replicate_masks = [[dataset.name in replicates for dataset in self.datasets] for replicates in group_replicates]
+                updated_Ms = self.estimate_Ms_batched(Ms, replicate_masks)
+                for replicates, updated_M in zip(group_replicates, updated_Ms):
+                    for dataset_name in replicates:
+                        self.metagene_state[dataset_name][:] = updated_M
+
+            elif self.metagene_mode == "differential":
+                Ms = torch.stack([self.metagene_state[dataset.name] for dataset in self.datasets])
+                replicate_masks = [[index == dataset_index for index in range(len(self.datasets))] for dataset_index in range(len(self.datasets))]
+                M_bars = None
+                if differentiate_metagenes:
+                    M_bars = [[self.metagene_state.M_bar[group_name] for group_name in self.metagene_tags[dataset.name]] for dataset in self.datasets]
+
+                updated_Ms = self.estimate_Ms_batched(Ms, replicate_masks, M_bars=M_bars)
+                for dataset, updated_M in zip(self.datasets, updated_Ms):
+                    self.metagene_state[dataset.name][:] = updated_M
+
+                self.metagene_state.reaverage()
+
+        elif self.metagene_mode == "shared":
             for group_name, group_replicates in self.metagene_groups.items():
                 first_dataset_name = group_replicates[0]
                 replicate_mask =  [dataset.name in group_replicates for dataset in self.datasets]
@@ -502,17 +776,19 @@ class ParameterOptimizer():
 
         scaled_betas = betas / (sigma_yxs**2)
         
+        statistics = [self.sufficient_statistics[dataset.name] for dataset in datasets]
+
         # ||Y||_2^2
-        constant_magnitude = np.array([torch.linalg.norm(Y).item()**2 for Y in Ys]).sum()
+        constant_magnitude = np.array([replicate_statistics.Y_norm(Y) for replicate_statistics, Y in zip(statistics, Ys)]).sum()
     
-        constant = (np.array([torch.linalg.norm(self.embedding_optimizer.embedding_state[dataset.name]).item()**2 for dataset in datasets]) * scaled_betas).sum()
+        constant = (np.array([replicate_statistics.XTX(X).trace().item() for replicate_statistics, X in zip(statistics, Xs)]) * scaled_betas).sum()
 
         regularization = [self.prior_xs[dataset_index] for dataset_index, dataset in enumerate(datasets)]
-        for dataset, X, Y, sigma_yx, scaled_beta in zip(datasets, Xs, Ys, sigma_yxs, scaled_betas):
+        for replicate_statistics, X, Y, sigma_yx, scaled_beta in zip(statistics, Xs, Ys, sigma_yxs, scaled_betas):
             # X_c^TX_c
-            quadratic_factor.addmm_(X.T, X, alpha=scaled_beta)
+            quadratic_factor.add_(replicate_statistics.XTX(X), alpha=scaled_beta)
             # MX_c^TY_c
-            linear_term.addmm_(Y.T, X, alpha=scaled_beta)
+            linear_term.add_(replicate_statistics.YTX(Y, X), alpha=scaled_beta)
     
         differential_regularization_quadratic_factor = torch.zeros((K, K), **self.context)
         differential_regularization_linear_term = torch.zeros(1, **self.context)
@@ -587,8 +863,10 @@ class ParameterOptimizer():
 
         scaled_betas = betas / (sigma_yxs**2)
         
+        statistics = [self.sufficient_statistics[dataset.name] for dataset in datasets]
+
         # ||Y||_2^2
-        constant = np.array([torch.linalg.norm(Y).item()**2 / (sigma_yx ** 2) for Y, sigma_yx in zip(Ys, sigma_yxs)]).sum()
+        constant = np.array([replicate_statistics.Y_norm(Y) / (sigma_yx ** 2) for replicate_statistics, Y, sigma_yx in zip(statistics, Ys, sigma_yxs)]).sum()
         # constant_magnitude = np.array([torch.linalg.norm(Y).item()**2 for Y in Ys]).sum()
     
         # constant = (np.array([torch.linalg.norm(self.embedding_optimizer.embedding_state[dataset.name]).item()**2 for dataset in datasets]) * scaled_betas).sum()
@@ -597,11 +875,11 @@ class ParameterOptimizer():
             # print(f"M constant magnitude: {constant_magnitude:.1e}")
 
         regularization = [self.prior_xs[dataset_index] for dataset_index, dataset in enumerate(datasets)]
-        for dataset, X, Y, scaled_beta in zip(datasets, Xs, Ys, scaled_betas):
+        for replicate_statistics, X, Y, scaled_beta in zip(statistics, Xs, Ys, scaled_betas):
             # X_c^TX_c
-            quadratic_factor.addmm_(X.T, X, alpha=scaled_beta)
+            quadratic_factor.add_(replicate_statistics.XTX(X), alpha=scaled_beta)
             # MX_c^TY_c
-            linear_factor.addmm_(Y.T, X, alpha=scaled_beta)
+            linear_factor.add_(replicate_statistics.YTX(Y, X), alpha=scaled_beta)
     
         # if self.lambda_M > 0 and M_bar is not None:
         #     quadratic_factor.diagonal().add_(self.lambda_M)
@@ -627,7 +905,6 @@ class ParameterOptimizer():
         loss_prev, loss = np.inf, np.nan
 
         verbose_bar = tqdm(disable=not (self.verbose > 2), bar_format='{desc}{postfix}')
-        progress_bar = trange(n_epochs, leave=True, disable=not self.verbose, desc='Updating M', miniters=1000)
     
         def compute_loss_and_gradient(M):
             quadratic_factor_grad = M @ (quadratic_factor + differential_regularization_quadratic_factor)
@@ -658,7 +935,7 @@ class ParameterOptimizer():
             if self.M_constraint == 'simplex':
                 grad.sub_(grad.sum(0, keepdim=True))
     
-            return loss.item(), grad
+            return loss, grad
         
         def estimate_M_nag(M):
             """Estimate M using Nesterov accelerated gradient descent.
@@ -666,16 +943,16 @@ class ParameterOptimizer():
             Args:
                 M (torch.Tensor) : current estimate of meteagene parameters
             """
-            loss, grad = compute_loss_and_gradient(M)
             if self.verbose > 1:
+                loss, grad = compute_loss_and_gradient(M)
                 print(f"M NAG Initial Loss: {loss}")
     
             step_size = 1 / torch.linalg.eigvalsh(quadratic_factor).max().item()
-            loss = np.inf
             
             optimizer = NesterovGD(M.clone(), step_size)
-            for epoch in progress_bar:
-                loss_prev = loss
+            loop = OptimizationLoop(n_epochs, tol=tol, check_every=self.convergence_check_frequency, min_epochs=7,
+                    verbose=self.verbose, description='Updating M')
+            for epoch in loop:
                 M_prev = M.clone()
     
                 # Update M
@@ -691,31 +968,21 @@ class ParameterOptimizer():
 
                 optimizer.set_parameters(M)
     
-                dloss = loss_prev - loss
-                dM = (M_prev - M).abs().max().item()
-                stop_criterion = dM < tol and epoch > 5
-                assert not np.isnan(loss)
-                if epoch % 5 == 0 or stop_criterion:
-                    description = (
-                        f'Updating M: loss = {loss:.1e}, '
-                        f'%δloss = {dloss / loss:.1e}, '
-                        f'δM = {dM:.1e}'
-                        # f'lr={step_size_scale:.1e}'
-                    )
-                    progress_bar.set_description(description)
-                if stop_criterion:
-                    break
+                dM = (M_prev - M).abs().max()
+                if DEBUG:
+                    assert not torch.isnan(loss)
+                loop.record(loss, dM)
             
             verbose_bar.close()
-            progress_bar.close()
             
-            loss, grad = compute_loss_and_gradient(M)
             if self.verbose > 1:
+                loss, grad = compute_loss_and_gradient(M)
                 print(f"M NAG Final Loss: {loss}")
     
             return M
         
         if backend_algorithm == 'mu':
+            progress_bar = trange(n_epochs, leave=True, disable=not self.verbose, desc='Updating M', miniters=1000)
             for epoch in progress_bar:
                 loss = (((M @ quadratic_factor) * M).sum() - 2 * (M * linear_term).sum() + constant) / 2
                 loss = loss.item()
@@ -750,6 +1017,7 @@ class ParameterOptimizer():
             step_size_scale = 1
             loss, grad = compute_loss_and_gradient(M)
             dM = dloss = np.inf
+            progress_bar = trange(n_epochs, leave=True, disable=not self.verbose, desc='Updating M', miniters=1000)
             for epoch in progress_bar:
                 M_new = M.sub(grad, alpha=step_size * step_size_scale)
                 if simplex_projection_mode == "exact":
@@ -789,19 +1057,75 @@ class ParameterOptimizer():
        
         return M
 
+    def estimate_Ms_batched(self, Ms, replicate_masks, M_bars=None, n_epochs=10000, tol=1e-3, check_frequency=10):
+        """Jointly optimize several independent sets of metagene parameters.
+
+        Each problem has the same objective as :meth:`estimate_M`, which only depends on the data through the
+        K x K Gram matrix of the embeddings and the G x K cross term with the expression. The problems are
+        therefore stacked and solved together by :func:`popari.util.solve_projected_fista`.
+
+        Args:
+            Ms: (B, G, K) tensor of current estimates of metagene parameters
+            replicate_masks: for each problem, mask of the replicates whose data it fits
+            M_bars: if set, for each problem the list of group-level metagenes it is pulled towards
+            n_epochs: maximum number of iterations
+            tol: convergence tolerance on the change of metagene parameters, relative to G
+            check_frequency: number of iterations between convergence checks
+
+        Returns:
+            (B, G, K) updated estimates of metagene parameters.
+        """
+        num_problems, G, K = Ms.shape
+        quadratic_factors = torch.zeros((num_problems, K, K), **self.context)
+        linear_factors = torch.zeros_like(Ms)
+        for problem, replicate_mask in enumerate(replicate_masks):
+            datasets = [dataset for (use_replicate, dataset) in zip(replicate_mask, self.datasets) if use_replicate]
+            Ys = [Y for (use_replicate, Y) in zip(replicate_mask, self.Ys) if use_replicate]
+
+            betas = self.betas[replicate_mask]
+            betas /= betas.sum()
+            scaled_betas = betas / (self.sigma_yxs[replicate_mask]**2)
+
+            for dataset, Y, scaled_beta in zip(datasets, Ys, scaled_betas):
+                statistics = self.sufficient_statistics[dataset.name]
+                X = self.embedding_optimizer.embedding_state[dataset.name]
+                quadratic_factors[problem].add_(statistics.XTX(X), alpha=scaled_beta)
+                linear_factors[problem].add_(statistics.YTX(Y, X), alpha=scaled_beta)
+
+            if self.lambda_M > 0 and M_bars is not None:
+                quadratic_factors[problem].diagonal().add_(self.lambda_M)
+                for group_M_bar in M_bars[problem]:
+                    linear_factors[problem].add_(group_M_bar, alpha=self.lambda_M / len(M_bars[problem]))
+
+        def project(Ms):
+            # Metagene constraints act on columns, so all problems are projected as one G x (B K) matrix
+            stacked_Ms = Ms.transpose(0, 1).reshape(G, num_problems * K)
+            if self.use_inplace_ops:
+                stacked_Ms = project_M_(stacked_Ms, self.M_constraint)
+            else:
+                stacked_Ms = project_M(stacked_Ms, self.M_constraint)
+
+            return stacked_Ms.reshape(G, num_problems, K).transpose(0, 1)
+
+        Ms, num_epochs = solve_projected_fista(quadratic_factors, linear_factors, Ms.clone(), project,
+                n_epochs=n_epochs, tol=tol / G, check_frequency=check_frequency)
+        if self.verbose > 1:
+            print(f"{get_datetime()} Updated {num_problems} metagene sets in {num_epochs} FISTA iterations")
+
+        return Ms
+
     def update_sigma_yx(self):
         """Update sigma_yx for each replicate.
 
         """
 
-        squared_terms = [torch.addmm(Y, self.embedding_optimizer.embedding_state[dataset.name], self.metagene_state[dataset.name].T, alpha=-1) for Y, dataset in zip(self.Ys, self.datasets)]
-        squared_loss = np.array([torch.linalg.norm(squared_term, ord="fro").item() ** 2 for squared_term in squared_terms])
+        squared_loss = np.array([self.sufficient_statistics[dataset.name].squared_error(Y, self.embedding_optimizer.embedding_state[dataset.name], self.metagene_state[dataset.name]) for Y, dataset in zip(self.Ys, self.datasets)])
         # squared_loss = np.array([
         #     torch.linalg.norm(, ord='fro').item() ** 2
         #     for Y, X, dataset, replicate in zip(Ys, self.Xs, self.datasets, self.repli_list)
         # ])
         num_replicates = len(self.datasets)
-        sizes = np.array([dataset.X.size for dataset in self.datasets])
+        sizes = np.array([np.prod(dataset.X.shape) for dataset in self.datasets])
         if self.sigma_yx_inv_mode == 'separate':
             self.sigma_yxs[:] = np.sqrt(squared_loss / sizes)
         elif self.sigma_yx_inv_mode == 'average':
@@ -813,8 +1137,7 @@ class ParameterOptimizer():
 
     def nll_sigma_yx(self):
         with torch.no_grad():
-            squared_terms = [torch.addmm(Y, self.embedding_optimizer.embedding_state[dataset.name], self.metagene_state[dataset.name].T, alpha=-1) for Y, dataset in zip(self.Ys, self.datasets)]
-            squared_loss = np.array([torch.linalg.norm(squared_term, ord="fro").item() ** 2 for squared_term in squared_terms])
+            squared_loss = np.array([self.sufficient_statistics[dataset.name].squared_error(Y, self.embedding_optimizer.embedding_state[dataset.name], self.metagene_state[dataset.name]) for Y, dataset in zip(self.Ys, self.datasets)])
 
         return squared_loss.sum()
 
@@ -867,7 +1190,7 @@ class MetageneState(dict):
             self.M_bar[group_name][:] = project_M(self.M_bar[group_name], self.M_constraint)
 
 class SpatialAffinityState(dict):
-    def __init__(self, K, metagene_state, datasets, groups, tags, betas, scaling=10, lr=1e-3, mode="shared lookup", initial_context=None, context=None):
+    def __init__(self, K, metagene_state, datasets, groups, tags, betas, scaling=10, lr=1e-3, mode="shared lookup", batched=False, initial_context=None, context=None):
         self.datasets = datasets
         self.groups = groups
         self.tags = tags
@@ -879,6 +1202,7 @@ class SpatialAffinityState(dict):
         self.betas = betas
         self.scaling = scaling
         self.lr = lr
+        self.batched = batched
         self.optimizers = {}
         super().__init__()
 
@@ -957,21 +1281,33 @@ class SpatialAffinityState(dict):
                 
         elif self.mode == "differential lookup":
             for group_name, group_replicates in self.groups.items():
+                self.spatial_affinity_bar[group_name].zero_()
                 for dataset_index, dataset in enumerate(self.datasets):
                     if dataset.name in group_replicates:
                         self.spatial_affinity_bar[group_name] += Sigma_x_invs[dataset_index]
 
                 self.spatial_affinity_bar[group_name].div_(len(group_replicates))
 
+            # Replicate affinities are views into a single stacked tensor, so they can also be optimized jointly.
+            # Only one kind of Adam state is created, so that the two paths can never diverge.
+            self.Sigma_x_invs = Sigma_x_invs
             for dataset_index, dataset in enumerate(self.datasets):
                 differential_affinity = Sigma_x_invs[dataset_index]
                 self.__setitem__(dataset.name, differential_affinity)
-                optimizer = torch.optim.Adam(
-                    [differential_affinity],
+                if not self.batched:
+                    optimizer = torch.optim.Adam(
+                        [differential_affinity],
+                        lr=self.lr,
+                        betas=(.5, .9),
+                    )
+                    self.optimizers[dataset.name] = optimizer
+
+            if self.batched:
+                self.batched_optimizer = torch.optim.Adam(
+                    [Sigma_x_invs],
                     lr=self.lr,
                     betas=(.5, .9),
                 )
-                self.optimizers[dataset.name] = optimizer
                 
         elif self.mode == "attention":
             #TODO: initialize with gradient descent
@@ -3,16 +3,24 @@ from typing import Sequence, Tuple
 import torch
 
 import numpy as np
+from scipy.sparse import issparse, vstack
 from sklearn.cluster import KMeans
 from sklearn.decomposition import TruncatedSVD, PCA
 
 import itertools
 from popari.components import PopariDataset
 from popari._dataset_utils import _cluster, _pca
+from popari.util import BackedExpression
+
+def _read_expression(X):
+    """Return ``X`` as a NumPy array or SciPy sparse matrix, reading it into memory if it is backed."""
+    return X[:] if BackedExpression.is_backed(X) else X
 
 def initialize_kmeans(datasets: Sequence[PopariDataset], K: int, context: dict, kwargs_kmeans:dict) -> Tuple[torch.Tensor, Sequence[torch.Tensor]]:
     """Initialize metagenes and hidden states using k-means clustering.
 
+    The expression of every replicate is read into memory as a dense array, including that of backed datasets.
+
     Args:
         datasets: input ST replicates to use for initialization
         K: dimension of latent states for cell embeddings
@@ -27,7 +35,8 @@ def initialize_kmeans(datasets: Sequence[PopariDataset], K: int, context: dict,
     """
     assert 'random_state' in kwargs_kmeans
     Ns, Gs = zip(*[dataset.X.shape for dataset in datasets])
-    Ys = [dataset.X for dataset in datasets]
+    Ys = [_read_expression(dataset.X) for dataset in datasets]
+    Ys = [Y.toarray() if issparse(Y) else Y for Y in Ys]
     Y_cat = np.concatenate(Ys, axis=0)
     pca = PCA(n_components=20)
     # pca = None
@@ -52,6 +61,8 @@ def initialize_kmeans(datasets: Sequence[PopariDataset], K: int, context: dict,
 def initialize_leiden(datasets: Sequence[PopariDataset], K: int, context: dict, kwargs_leiden:dict, n_neighbors: int = 20, n_components: int = 50, eps: float = 1e-10, verbose: bool = True) -> Tuple[torch.Tensor, Sequence[torch.Tensor]]:
     """Initialize metagenes and hidden states using k-means clustering.
 
+    The replicates are concatenated in memory for PCA, so the expression of backed datasets is read in full.
+
     Args:
         datasets: input ST replicates to use for initialization
         K: dimension of latent states for cell embeddings
@@ -86,7 +97,7 @@ def initialize_leiden(datasets: Sequence[PopariDataset], K: int, context: dict,
     unmerged_datasets = [merged_dataset[index] for index in indices]
     unmerged_labels = [unmerged_dataset.obs["leiden"].astype(int).values for unmerged_dataset in unmerged_datasets]
     
-    M = np.stack([merged_dataset[labels == cluster].X.mean(axis=0) for cluster in labels.unique()]).T
+    M = np.stack([np.asarray(merged_dataset[labels == cluster].X.mean(axis=0)).ravel() for cluster in labels.unique()]).T
 
     Xs = []
     for unmerged_label in unmerged_labels:
@@ -126,7 +137,12 @@ def initialize_svd(datasets: Sequence[PopariDataset], K: int, context: dict, M_n
     """
 
     # TODO: add check that number of genes is the same for all datasets
-    Y_cat = np.concatenate([dataset.X for dataset in datasets], axis=0)
+    Ys = [_read_expression(dataset.X) for dataset in datasets]
+    if any(issparse(Y) for Y in Ys):
+        Y_cat = vstack(Ys, format="csr")
+    else:
+        Y_cat = np.concatenate(Ys, axis=0)
+    del Ys
 
     svd = TruncatedSVD(K)
     X_cat = svd.fit_transform(Y_cat)
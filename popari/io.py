@@ -4,7 +4,7 @@ from pathlib import Path
 import numpy as np
 import anndata as ad
 import torch
-from scipy.sparse import csr_matrix, issparse
+from scipy.sparse import csr_matrix
 
 from popari.components import PopariDataset
 from popari.util import convert_numpy_to_pytorch_sparse_coo
@@ -133,9 +133,6 @@ def unmerge_anndata(merged_dataset: ad.AnnData, replicate_names: Sequence[str] =
             replicate_X = make_hdf5_compatible(dataset.obsm["X"])
             dataset.obsm["X"] = replicate_X
 
-        if issparse(dataset.X):
-            dataset.X = dataset.X.toarray()
-
     return datasets, replicate_names
 
 def merge_anndata(datasets: Sequence[PopariDataset], ignore_raw_data: bool = False):
@@ -41,6 +41,10 @@ def main():
     parser.add_argument('--lambda_Sigma_bar', type=float, default=None, help="hyperparameter to constrain spatial affinity deviation in differential case.")
     parser.add_argument('--spatial_affinity_lr', type=float, help="learning rate for optimization of ``Sigma_x_inv``")
     parser.add_argument('--spatial_affinity_tol', type=float, help="convergence tolerance during optimization of ``Sigma_x_inv``")
+    parser.add_argument('--spatial_affinity_solver', type=str, help="optimizer used for ``Sigma_x_inv``. Default ``adam``")
+    parser.add_argument('--spatial_affinity_batched', type=bool, help="if set, differential ``Sigma_x_inv`` of all replicates are optimized jointly. Default ``False``")
+    parser.add_argument('--spatial_affinity_coreset_resolution', type=float, help="grid spacing used to compress neighbor sums into a weighted coreset when optimizing ``Sigma_x_inv``")
+    parser.add_argument('--metagene_solver', type=str, help="optimizer used for metagenes. Default ``nesterov``")
     parser.add_argument('--spatial_affinity_constraint', type=str, help="method to ensure that spatial affinities lie within an appropriate range")
     parser.add_argument('--spatial_affinity_centering', type=bool, help="if set, spatial affinities are zero-centered after every optimization step")
     parser.add_argument('--spatial_affinity_scaling', type=float, help="magnitude of spatial affinities during initial scaling. Default ``10``")
@@ -48,6 +52,13 @@ def main():
     parser.add_argument('--embedding_mini_iterations', type=int, help="number of mini-iterations to use during each iteration of embedding optimization. Default ``1000``")
     parser.add_argument('--embedding_acceleration_trick', type=bool, help="if set, use trick to accelerate convergence of embedding optimization. Default ``True``")
     parser.add_argument('--embedding_step_size_multiplier', type=float, help="controls relative step size during embedding optimization. Default ``1.0``")
+    parser.add_argument('--embedding_update_alg', type=str, help="algorithm used to update embeddings of spatial replicates. Default ``nesterov``")
+    parser.add_argument('--embedding_nmf_update_alg', type=str, help="algorithm used to update embeddings without spatial information. Default ``gd``")
+    parser.add_argument('--embedding_contiguous_layout', type=bool, help="if set, cells are reordered by color class during spatial embedding updates. Default ``False``")
+    parser.add_argument('--embedding_frontier_scheduling', type=bool, help="if set, later epochs of spatial embedding updates only revisit cells that are still moving. Default ``False``")
+    parser.add_argument('--embedding_num_threads', type=int, help="number of threads used to process independent batches during spatial embedding updates. Default ``1``")
+    parser.add_argument('--embedding_tile_size', type=int, help="if set, spatial embedding updates are performed on spatial tiles of about this many cells")
+    parser.add_argument('--convergence_check_frequency', type=int, help="number of iterations between convergence checks of the inner solvers. Default ``10``")
     parser.add_argument('--use_inplace_ops', type=bool, help="if set, inplace PyTorch operations will be used to speed up computation")
     parser.add_argument('--random_state', type=int, help="seed for reproducibility of randomized computations. Default ``0``")
     parser.add_argument('--verbose', type=int, help="level of verbosity to use during optimization. Default ``0`` (no print statements)")
@@ -35,7 +35,8 @@ class Popari:
         reloaded_hierarchy: data from previous hierarchical run of Popari.
         lambda_Sigma_x_inv: hyperparameter to balance importance of spatial information. Default: ``1e-4``
         pretrained: if set, attempts to load model state from input files. Default: ``False``
-        initialization_method: algorithm to use for initializing metagenes and embeddings. Default: ``leiden``
+        initialization_method: algorithm to use for initializing metagenes and embeddings. ``kmeans``,
+            ``leiden`` and ``svd`` read the full expression matrix into memory, even for backed datasets. Default: ``leiden``
         hierarchical_levels: number of hierarchical levels to use. Default: ``1`` (non-hierarchical mode)
         metagene_groups: defines a grouping of replicates for the metagene optimization. If
             ``metagene_mode == "shared"``, then one set of metagenes will be created for each group;
@@ -67,6 +68,15 @@ class Popari:
             ``spatial_affinity_mode`` is ``shared lookup``. Default: ``0.5``
         spatial_affinity_lr: learning rate for optimization of ``Sigma_x_inv``
         spatial_affinity_tol: convergence tolerance during optimization of ``Sigma_x_inv``
+        spatial_affinity_solver: optimizer used for ``Sigma_x_inv``; one of ``adam`` or ``lbfgs``. ``lbfgs`` does not
+            support ``spatial_affinity_constraint``. Default: ``adam``
+        spatial_affinity_batched: if set, in ``differential lookup`` mode the ``Sigma_x_inv`` of all replicates are
+            optimized jointly with a single Adam state instead of one replicate at a time. Requires the ``adam``
+            solver and does not support ``edge_subsample_rate``. Default: ``False``
+        spatial_affinity_coreset_resolution: if set, neighbor sums are quantized to a grid of this spacing and
+            merged into a weighted coreset before optimizing ``Sigma_x_inv``. Default: ``None``
+        metagene_solver: optimizer used for metagenes; one of ``nesterov``, or ``fista`` to solve all metagene
+            sets at once with adaptive restart. Default: ``nesterov``
         spatial_affinity_constraint: method to ensure that spatial affinities lie within an appropriate range
         spatial_affinity_centering: if set, spatial affinities are zero-centered after every optimization step
         spatial_affinity_scaling: magnitude of spatial affinities during initial scaling. Default: ``10``
@@ -74,6 +84,21 @@ class Popari:
         embedding_mini_iterations: number of mini-iterations to use during each iteration of embedding optimization. Default: ``1000``
         embedding_acceleration_trick: if set, use trick to accelerate convergence of embedding optimization. Default: ``True``
         embedding_step_size_multiplier: controls relative step size during embedding optimization. Default: ``1.0``
+        embedding_update_alg: algorithm used to update embeddings of spatial replicates; one of ``nesterov``, ``gd``,
+            ``active set`` (exact per-cell QP solves) or ``jacobi`` (all cells updated in parallel). Default: ``nesterov``
+        embedding_nmf_update_alg: algorithm used to update embeddings without spatial information; one of ``gd``,
+            ``mu`` or ``nnls`` (exact batched non-negative least squares). Default: ``gd``
+        embedding_contiguous_layout: if set, cells are reordered by color class during spatial embedding updates so
+            that every batch is a contiguous block of rows. Default: ``False``
+        embedding_frontier_scheduling: if set, later epochs of spatial embedding updates only revisit cells that are
+            still moving, along with their neighbors. Default: ``False``
+        embedding_num_threads: number of threads used to process batches of the same color class concurrently
+            during spatial embedding updates. Default: ``1``
+        embedding_tile_size: if set, spatial embedding updates are performed tile by tile on spatial tiles of about
+            this many cells (plus a one-hop halo). In-memory expression is then kept on the host, and only the
+            expression of one tile at a time is moved to the device. Default: ``None``
+        convergence_check_frequency: number of iterations between convergence checks of the inner solvers; losses
+            and parameter changes stay on the device in between. Default: ``10``
         binning_downsample_rate: ratio of number of spots at low resolution to high resolution when
             using hierarchical mode
         superresolution_lr: learning rate for optimization of ``X`` from low-res embeddings
@@ -106,6 +131,10 @@ class Popari:
         lambda_Sigma_bar: float = 1e-3,
         spatial_affinity_lr: float = 1e-2,
         spatial_affinity_tol: float = 2e-3,
+        spatial_affinity_solver: str = "adam",
+        spatial_affinity_batched: bool = False,
+        spatial_affinity_coreset_resolution: Optional[float] = None,
+        metagene_solver: str = "nesterov",
         spatial_affinity_constraint: Optional[str] = None,
         spatial_affinity_centering: bool = False,
         spatial_affinity_scaling: int = 10,
@@ -113,6 +142,13 @@ class Popari:
         embedding_mini_iterations: int = 1000,
         embedding_acceleration_trick: bool = True,
         embedding_step_size_multiplier: float = 1.0,
+        embedding_update_alg: str = "nesterov",
+        embedding_nmf_update_alg: str = "gd",
+        embedding_contiguous_layout: bool = False,
+        embedding_frontier_scheduling: bool = False,
+        embedding_num_threads: int = 1,
+        embedding_tile_size: Optional[int] = None,
+        convergence_check_frequency: int = 10,
         binning_downsample_rate: float = 0.2,
         superresolution_lr: float = 1e-1,
         use_inplace_ops: bool = True,
@@ -147,6 +183,10 @@ class Popari:
         self.lambda_Sigma_bar = lambda_Sigma_bar
         self.spatial_affinity_lr = spatial_affinity_lr
         self.spatial_affinity_tol = spatial_affinity_tol
+        self.spatial_affinity_solver = spatial_affinity_solver
+        self.spatial_affinity_batched = spatial_affinity_batched
+        self.spatial_affinity_coreset_resolution = spatial_affinity_coreset_resolution
+        self.metagene_solver = metagene_solver
         self.spatial_affinity_constraint = spatial_affinity_constraint
         self.spatial_affinity_centering = spatial_affinity_centering
         self.spatial_affinity_scaling = spatial_affinity_scaling
@@ -165,6 +205,13 @@ class Popari:
         self.embedding_step_size_multiplier = embedding_step_size_multiplier
         self.embedding_mini_iterations = embedding_mini_iterations
         self.embedding_acceleration_trick = embedding_acceleration_trick
+        self.embedding_update_alg = embedding_update_alg
+        self.embedding_nmf_update_alg = embedding_nmf_update_alg
+        self.embedding_contiguous_layout = embedding_contiguous_layout
+        self.embedding_frontier_scheduling = embedding_frontier_scheduling
+        self.embedding_num_threads = embedding_num_threads
+        self.embedding_tile_size = embedding_tile_size
+        self.convergence_check_frequency = convergence_check_frequency
 
         self.hierarchical_levels = hierarchical_levels
         self.reloaded_hierarchy = reloaded_hierarchy
@@ -186,6 +233,10 @@ class Popari:
             "lambda_Sigma_bar": self.lambda_Sigma_bar,
             "spatial_affinity_lr": self.spatial_affinity_lr,
             "spatial_affinity_tol": self.spatial_affinity_tol,
+            "spatial_affinity_solver": self.spatial_affinity_solver,
+            "spatial_affinity_batched": self.spatial_affinity_batched,
+            "spatial_affinity_coreset_resolution": self.spatial_affinity_coreset_resolution,
+            "metagene_solver": self.metagene_solver,
             "spatial_affinity_constraint": self.spatial_affinity_constraint,
             "spatial_affinity_centering": self.spatial_affinity_centering,
             "spatial_affinity_scaling": self.spatial_affinity_scaling,
@@ -195,12 +246,20 @@ class Popari:
             "spatial_affinity_mode": self.spatial_affinity_mode,
             "lambda_M": self.lambda_M,
             "metagene_mode": self.metagene_mode,
+            "convergence_check_frequency": self.convergence_check_frequency,
         }
 
         self.embedding_optimizer_hyperparameters = {
             "embedding_step_size_multiplier": embedding_step_size_multiplier,
             "embedding_mini_iterations": embedding_mini_iterations,
             "embedding_acceleration_trick": embedding_acceleration_trick,
+            "embedding_update_alg": embedding_update_alg,
+            "embedding_nmf_update_alg": embedding_nmf_update_alg,
+            "embedding_contiguous_layout": embedding_contiguous_layout,
+            "embedding_frontier_scheduling": embedding_frontier_scheduling,
+            "embedding_num_threads": embedding_num_threads,
+            "embedding_tile_size": embedding_tile_size,
+            "convergence_check_frequency": convergence_check_frequency,
         }
 
         self._initialize(betas=betas, prior_x_modes=prior_x_modes, method=initialization_method, pretrained=pretrained)
@@ -302,8 +361,9 @@ class Popari:
         Args:
             update_spatial_affinities: If specified, spatial affinities will be updated during
                 this iteration. Default: ``True``
-            edge_subsample_rate: Fraction of adjacency matrix edges that will be included in
-                optimization of ``Sigma_x_inv``.
+            edge_subsample_rate: Fraction of nodes of each replicate that are sampled in every epoch of the
+                optimization of ``Sigma_x_inv``. Sampled estimates are variance-reduced with periodic
+                full-data snapshots.
         """
         logging.info(f'{get_datetime()}Updating model parameters')
 
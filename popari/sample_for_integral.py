@@ -5,85 +5,123 @@ import numpy as np
 import torch
 import scipy
 
-def project2simplex(y, dim=0, zero_threshold=1e-10):
-    """
-    # https://math.stackexchange.com/questions/2402504/orthogonal-projection-onto-the-unit-simplex
-    find a scalar mu such that || (y-mu)_+ ||_1 = 1
-
-    Currently uses Newton's method to optimize || y - mu ||^2
-
-    TODO: try implementing it this way instead: https://arxiv.org/pdf/1101.6081.pdf
-
-    Args:
-        y: vector to be projected to unit simplex
-    """
-    
-    num_components = y.shape[dim]
-    
-    mu = (y.sum(dim=dim, keepdim=True) - 1) / num_components
-    previous_derivative = derivative = None
-    for _ in range(num_components):
-        difference = y - mu
-        derivative = -(difference > zero_threshold).sum(dim=dim, keepdim=True).to(y.dtype)
-        assert -derivative.min() > 0, difference.clip(min=0).sum(dim).min()
-        if previous_derivative is not None and (derivative == previous_derivative).all():
-            break
-        objective_value = torch.clip(difference, min=zero_threshold).sum(dim=dim, keepdim=True) - 1
-        newton_update = objective_value / derivative
-        mu -= newton_update
-        previous_derivative = derivative
-    assert (derivative == previous_derivative).all()
-    
-    assert not torch.isnan(y).any(), y
-
-    y = (y - mu).clip(min=zero_threshold)
-    assert not torch.isnan(y).any(), (mu, derivative)
-
-    assert y.sum(dim=dim).sub_(1).abs_().max() < 1e-3, y.sum(dim=dim).sub_(1).abs_().max()
-    
-    return y
-
+# Enables (synchronizing) sanity checks in hot loops
+DEBUG = bool(os.environ.get("POPARI_DEBUG"))
 
 def test_project2simplex():
+    from popari.util import project2simplex
+
     x = torch.rand(100, 100)
     x = x * 3 - 1
     project2simplex(x, dim=0)
 
 def test_project2simplex_basic():
+    from popari.util import project2simplex
+
     x = torch.tensor([1/2, 1/4, 1/4])
     assert x.allclose(project2simplex(x.clone(), dim=0))
 
-def integrate_of_exponential_over_simplex(eta, eps=1e-30):
-    assert torch.isfinite(eta).all()
+def _log_terms(eta, eps):
+    """Compute log-magnitudes and signs of the terms of the simplex integral.
+
+    The k-th term is exp(-eta_k) / prod_{m != k} (eta_m - eta_k).
+
+    Args:
+        eta: (N, K) tensor of exponents
+        eps: offset that keeps the logarithm of tied differences finite
+
+    Returns:
+        Tuple of (N, K) log-magnitudes, (N, K) signs and the (N, K, K) pairwise differences eta_m - eta_k.
+    """
     N, K = eta.shape
-    log_abs = torch.empty_like(eta)
-    signs = torch.empty_like(log_abs)
-    for k in range(K):
-        difference = eta - eta[:, [k]]
-        difference[:, k] = 1
-        difference_sign = difference.sign()
-        signs[:, k] = difference_sign.prod(axis=1)
-        # t = t.abs().clip(min=1e10).log()
-        difference = difference.abs().add(eps).log()
-        difference[:, k] = eta[:, k]
-
-        log_abs[:, k] = difference.sum(axis=1)
-    assert torch.isfinite(log_abs).all()
-    log_abs.neg_()
-   
-    # signed logsumexp
-    maxes, _ = log_abs.max(axis=1, keepdim=True)
-    ret = log_abs.sub(maxes).exp()
-    assert torch.isfinite(ret).all()
-
-    ret = ret.mul(signs).sum(axis=-1)
-    ret = ret.clip(min=eps)
-    assert (ret > 0).all(), ret.min().item()
-
-    squeezed_maxes = maxes.squeeze(axis=-1)
-    ret = ret.log().add(squeezed_maxes)
-
-    return ret
+    differences = eta[:, None, :] - eta[:, :, None]
+    diagonal = torch.eye(K, dtype=torch.bool, device=eta.device)
+    signs = differences.sign().masked_fill_(diagonal, 1).prod(dim=2)
+    log_abs = differences.abs().add_(eps).log_().masked_fill_(diagonal, 0).add_(torch.diag_embed(eta)).sum(dim=2).neg_()
+
+    return log_abs, signs, differences
+
+def _default_chunk_size(K):
+    return max(1, 2**22 // (K * K))
+
+class IntegrateOfExponentialOverSimplex(torch.autograd.Function):
+    """Log of the integral of exp(-eta^T z) over the unit simplex, with a closed-form gradient.
+
+    The forward pass is vectorized over K and chunked over N so that only an (N_chunk, K, K) block of
+    pairwise differences exists at any time. The backward pass recomputes the scaled terms chunk by chunk
+    from eta instead of keeping them on the autograd tape.
+    """
+    @staticmethod
+    def forward(ctx, eta, eps, chunk_size):
+        N, K = eta.shape
+        output = torch.empty(N, dtype=eta.dtype, device=eta.device)
+        clipped = torch.empty(N, dtype=torch.bool, device=eta.device)
+        for start in range(0, N, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            log_abs, signs, _ = _log_terms(eta[chunk], eps)
+
+            # signed logsumexp
+            maxes, _ = log_abs.max(dim=1, keepdim=True)
+            total = log_abs.sub_(maxes).exp_().mul_(signs).sum(dim=1)
+            clipped[chunk] = total < eps
+            output[chunk] = total.clip_(min=eps).log_().add_(maxes.squeeze(1))
+
+        ctx.save_for_backward(eta, clipped)
+        ctx.eps = eps
+        ctx.chunk_size = chunk_size
+
+        return output
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        """Compute d logZ / d eta.
+
+        With signed, scaled terms T_k and D_km = 1 / (eta_m - eta_k),
+
+            d logZ / d eta_m = -(T_m + sum_k (T_k + T_m) D_km) / sum_k T_k
+        """
+        eta, clipped = ctx.saved_tensors
+        eps, chunk_size = ctx.eps, ctx.chunk_size
+        N, K = eta.shape
+
+        grad_eta = torch.empty_like(eta)
+        for start in range(0, N, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            log_abs, signs, differences = _log_terms(eta[chunk], eps)
+
+            maxes, _ = log_abs.max(dim=1, keepdim=True)
+            terms = log_abs.sub_(maxes).exp_().mul_(signs)
+
+            # Match the derivative of log(|d| + eps), which vanishes for exact ties
+            inverse_differences = differences.sign().div_(differences.abs_().add_(eps))
+            G = terms + torch.einsum("nk,nkm->nm", terms, inverse_differences) + terms * inverse_differences.sum(dim=1)
+
+            grad_eta[chunk] = G.div_(terms.sum(dim=1, keepdim=True)).neg_().mul_(grad_output[chunk, None])
+
+        grad_eta.masked_fill_(clipped[:, None], 0)
+
+        return grad_eta, None, None
+
+def integrate_of_exponential_over_simplex(eta, eps=1e-30, chunk_size=None):
+    """Compute the log of the integral of exp(-eta^T z) over the unit simplex for each row of eta.
+
+    Args:
+        eta: (N, K) tensor of exponents
+        eps: numerical floor for tied differences and for the integral itself
+        chunk_size: number of rows processed at once. By default, chosen so that each chunk holds
+            about 4M pairwise differences.
+
+    Returns:
+        (N,) tensor of log-integrals
+    """
+    if DEBUG:
+        assert torch.isfinite(eta).all()
+    _, K = eta.shape
+    if chunk_size is None:
+        chunk_size = _default_chunk_size(K)
+
+    return IntegrateOfExponentialOverSimplex.apply(eta, eps, chunk_size)
 
 if __name__ == "__main__":
     test_project2simplex_basic()
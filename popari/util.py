@@ -1,9 +1,10 @@
-from typing import Optional
+from typing import Optional, Sequence
 import os, time, pickle, sys, datetime, logging
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm, trange
 
 import numpy as np
-from scipy.sparse import csr_matrix, csr_array
+from scipy.sparse import csr_matrix, csr_array, issparse
 import pandas as pd
 
 from sklearn.preprocessing import StandardScaler
@@ -14,6 +15,11 @@ from umap import UMAP
 
 from anndata import AnnData
 import scanpy as sc
+import h5py
+try:
+    from anndata._core.sparse_dataset import BaseCompressedSparseDataset as BackedSparseDataset
+except ImportError: # anndata < 0.10
+    from anndata._core.sparse_dataset import SparseDataset as BackedSparseDataset
 
 import torch
 
@@ -27,7 +33,7 @@ import matplotlib.patches as patches
 import seaborn as sns
 from collections import defaultdict
 
-from popari.sample_for_integral import integrate_of_exponential_over_simplex
+from popari.sample_for_integral import DEBUG, integrate_of_exponential_over_simplex
 
 def create_neighbor_groups(replicate_names, covariate_values, window_size = 1):
     if window_size == None:
@@ -314,6 +320,129 @@ class NesterovGD:
 
         return self.parameters
 
+class OptimizationLoop:
+    """Iteration driver that keeps the convergence bookkeeping of an iterative solver on the device.
+
+    Solvers report per-step losses and parameter changes as (0-dim) tensors via :meth:`record`. These
+    are buffered, and only after the first step, then every ``check_every`` steps (and at the final step)
+    they are moved to the host with a single synchronization, appended to the loss and delta histories and
+    tested against the stopping criteria. A solver that converges in one step thus stops right away, while
+    later on it may run up to ``check_every - 1`` steps past the step that first met the criteria. The
+    progress bar and its description are only created if ``verbose`` is set.
+
+    Example::
+
+        loop = OptimizationLoop(n_epochs, tol=tol, check_every=10, verbose=self.verbose, description="Updating M")
+        for epoch in loop:
+            ...
+            loop.record(loss, delta)
+
+    Attributes:
+        losses: host-side history of the recorded losses
+        deltas: host-side history of the recorded parameter changes
+        epoch_best: epoch of the smallest recorded loss
+        converged: whether a stopping criterion was met
+    """
+
+    def __init__(self, n_epochs: int, tol: float = 0, check_every: int = 10, min_epochs: int = 0,
+            patience: Optional[int] = None, verbose: bool = False, description: str = "", leave: bool = True):
+        """Initialize the loop.
+
+        Args:
+            n_epochs: maximum number of steps
+            tol: stop once a recorded delta falls below this value
+            check_every: number of steps between synchronizations after the first step
+            min_epochs: number of steps before the criteria are tested
+            patience: if set, stop once the loss has not improved for this many steps
+            verbose: whether to display a progress bar
+            description: prefix of the progress bar description
+            leave: whether to keep the progress bar after the loop finishes
+        """
+        self.n_epochs = n_epochs
+        self.tol = tol
+        self.check_every = max(1, check_every)
+        self.min_epochs = min_epochs
+        self.patience = patience
+        self.verbose = verbose
+        self.description = description
+        self.leave = leave
+
+        self.losses = []
+        self.deltas = []
+        self.loss_best = np.inf
+        self.epoch_best = 0
+        self.epoch = -1
+        self.converged = False
+        self._pending = []
+
+    @property
+    def loss(self):
+        """Most recent loss on the host, or ``nan`` if none has been checked yet."""
+        return self.losses[-1] if self.losses else np.nan
+
+    @property
+    def delta(self):
+        """Most recent parameter change on the host, or ``inf`` if none has been checked yet."""
+        return self.deltas[-1] if self.deltas else np.inf
+
+    def __iter__(self):
+        progress_bar = trange(self.n_epochs, leave=self.leave) if self.verbose else None
+        try:
+            for epoch in (progress_bar if progress_bar is not None else range(self.n_epochs)):
+                self.epoch = epoch
+                yield epoch
+                if epoch == 0 or len(self._pending) >= self.check_every or epoch == self.n_epochs - 1:
+                    self.check(progress_bar)
+                if self.converged:
+                    break
+        finally:
+            if progress_bar is not None:
+                progress_bar.close()
+
+    def record(self, loss, delta=None):
+        """Buffer the loss and (optionally) the parameter change of the current step.
+
+        Args:
+            loss: objective value as a 0-dim tensor or float
+            delta: parameter change as a 0-dim tensor or float; steps without one are not tested against ``tol``
+        """
+        self._pending.append((self.epoch, loss, delta))
+
+    def check(self, progress_bar=None):
+        """Synchronize the buffered values and test the stopping criteria."""
+        if not self._pending:
+            return
+
+        values = [value for _, loss, delta in self._pending for value in (loss, delta) if torch.is_tensor(value)]
+        if values:
+            values = iter(torch.stack([value.detach().reshape(()).to(values[0].dtype) for value in values]).tolist())
+
+        pending, self._pending = self._pending, []
+        for epoch, loss, delta in pending:
+            loss = next(values) if torch.is_tensor(loss) else loss
+            delta = next(values) if torch.is_tensor(delta) else delta
+            loss_prev = self.loss
+            self.losses.append(loss)
+            if loss < self.loss_best:
+                self.loss_best, self.epoch_best = loss, epoch
+
+            if delta is not None:
+                self.deltas.append(delta)
+
+            if epoch + 1 < self.min_epochs or self.converged:
+                continue
+
+            if delta is not None and delta < self.tol:
+                self.converged = True
+            elif self.patience is not None and epoch > self.epoch_best + self.patience:
+                self.converged = True
+
+        if progress_bar is not None:
+            description = f"{self.description}: loss = {self.loss:.1e} %δloss = {(loss_prev - self.loss) / self.loss:.1e}"
+            if self.deltas:
+                description += f" δ = {self.delta:.1e}"
+            progress_bar.set_description(description)
+            progress_bar.update(0)
 
 def print_datetime():
     return datetime.datetime.now().strftime('[%Y/%m/%d %H:%M:%S]\t')
@@ -354,87 +483,264 @@ def project_M_(M, M_constraint):
         raise NotImplementedError
     return result
 
+def _simplex_threshold(y: torch.Tensor, dim: int, zero_threshold: float) -> torch.Tensor:
+    """Threshold ``theta`` such that ``max(y - theta, zero_threshold)`` sums to one along ``dim``.
+
+    Uses the sort-based algorithm of Duchi et al. (2008) (see also Condat, 2016): after sorting in
+    decreasing order, the support of the projection is the longest prefix whose entries exceed the running
+    threshold, which is read off a cumulative sum. This costs O(K log K) per vector and involves no
+    data-dependent control flow, so it never synchronizes with the host.
+
+    Entries are floored at ``zero_threshold`` instead of zero, which is equivalent to projecting
+    ``y - zero_threshold`` onto the simplex of radius ``1 - K * zero_threshold``.
+    """
+    num_components = y.shape[dim]
+    radius = 1 - num_components * zero_threshold
+
+    sorted_y = torch.sort(y - zero_threshold, dim=dim, descending=True).values
+    cumulative_sums = sorted_y.cumsum(dim=dim).sub_(radius)
+    shape = [1] * y.dim()
+    shape[dim] = num_components
+    counts = torch.arange(1, num_components + 1, dtype=y.dtype, device=y.device).view(shape)
+
+    support_size = (sorted_y * counts > cumulative_sums).sum(dim=dim, keepdim=True).clamp_(min=1)
+    theta = cumulative_sums.gather(dim, support_size - 1).div_(support_size)
+
+    return theta
+
+def _check_simplex(y: torch.Tensor, dim: int, tol: float):
+    if DEBUG:
+        assert not torch.isnan(y).any(), y
+        deviation = y.sum(dim=dim).sub_(1).abs_().max()
+        assert deviation < tol, deviation
+
 def project2simplex(y, dim: int = 0, zero_threshold: float = 1e-10) -> torch.Tensor:
     """Projects a matrix such that the columns (or rows) lie on the unit simplex.
 
-    See https://math.stackexchange.com/questions/2402504/orthogonal-projection-onto-the-unit-simplex
-    for a reference.
+    See :func:`_simplex_threshold` for the algorithm. Sanity checks on the output only run if the
+    ``POPARI_DEBUG`` environment variable is set.
 
-    The goal is to find a scalar mu such that || (y-mu)_+ ||_1 = 1
+    Args:
+        y: list of vectors to be projected to unit simplex
+        dim: dimension along which to project
+        zero_threshold: threshold to treat as zero for numerical stability purposes
+    """
+    y = (y - _simplex_threshold(y, dim, zero_threshold)).clip_(min=zero_threshold)
+    _check_simplex(y, dim, 1e-3)
+
+    return y
 
-    Currently uses Newton's method to optimize || y - mu ||^2
+def project2simplex_(y, dim: int = 0, zero_threshold: float = 1e-10) -> torch.Tensor:
+    """(In-place) Projects a matrix such that the columns (or rows) lie on the unit simplex.
 
-    TODO: try implementing it this way instead: https://arxiv.org/pdf/1101.6081.pdf
+    Same as :func:`project2simplex`, but overwrites ``y`` with the projection.
 
     Args:
         y: list of vectors to be projected to unit simplex
         dim: dimension along which to project
         zero_threshold: threshold to treat as zero for numerical stability purposes
     """
+    y.sub_(_simplex_threshold(y, dim, zero_threshold)).clip_(min=zero_threshold)
+    _check_simplex(y, dim, 1e-4)
 
-    num_components = y.shape[dim]
+    return y
 
-    mu = (y.sum(dim=dim, keepdim=True) - 1) / num_components
-    previous_derivative = derivative = None
-    for _ in range(num_components):
-        difference = y - mu
-        derivative = -(difference > zero_threshold).sum(dim=dim, keepdim=True).to(y.dtype)
-        assert -derivative.min() > 0, difference.clip(min=0).sum(dim).min()
-        if previous_derivative is not None and (derivative == previous_derivative).all():
-            break
-        objective_value = torch.clip(difference, min=zero_threshold).sum(dim=dim, keepdim=True) - 1
-        newton_update = objective_value / derivative
-        mu -= newton_update
+@torch.no_grad()
+def solve_simplex_qp(Q: torch.Tensor, c: torch.Tensor, z: torch.Tensor, max_iterations: Optional[int] = None,
+        zero_threshold: float = 1e-10, tol: float = 1e-10) -> torch.Tensor:
+    """Solve a batch of simplex-constrained quadratic programs that share the same quadratic form.
 
-        previous_derivative = derivative
-    assert (derivative == previous_derivative).all()
+    For every row ``c_i`` of ``c``, solves
 
-    assert not torch.isnan(y).any(), y
+    min_z 1/2 zT Q z - c_iT z   s.t.   z >= 0, sum(z) = 1
 
-    y = (y - mu).clip(min=zero_threshold)
-    assert not torch.isnan(y).any(), (mu, derivative)
+    with a primal active-set method. All problems are advanced in lockstep: each iteration solves one
+    batched KKT system restricted to the free variables of every problem, then either steps to the
+    first blocking constraint (dropping that variable) or, if the equality-constrained solution is
+    feasible, frees the variable with the most negative multiplier. For small K this reaches the exact
+    optimum in a handful of iterations.
 
-    assert y.sum(dim=dim).sub_(1).abs_().max() < 1e-3, y.sum(dim=dim).sub_(1).abs_().max()
+    Args:
+        Q: K x K positive definite quadratic form shared by all problems
+        c: B x K linear terms
+        z: B x K warm start; rows must lie on the unit simplex
+        max_iterations: maximum number of active-set changes. Default: ``3 * K``
+        zero_threshold: entries at or below this value are treated as constrained to zero
+        tol: relative tolerance for the optimality check on the multipliers
 
-    return y
+    Returns:
+        B x K optimal solutions
+    """
+    num_problems, K = c.shape
+    if max_iterations is None:
+        max_iterations = 3 * K
+
+    free = z > zero_threshold
+    z = torch.where(free, z, torch.zeros_like(z))
+    z = z / z.sum(dim=1, keepdim=True)
+
+    tol = tol * Q.diagonal().abs().max()
+    done = torch.zeros(num_problems, dtype=torch.bool, device=c.device)
+    batch_range = torch.arange(num_problems, device=c.device)
+
+    kkt_matrix = torch.zeros((num_problems, K+1, K+1), dtype=c.dtype, device=c.device)
+    kkt_rhs = torch.ones((num_problems, K+1), dtype=c.dtype, device=c.device)
+    for _ in range(max_iterations):
+        # Equality-constrained subproblem on the free variables; fixed variables are pinned to zero
+        mask = free.to(c.dtype)
+        kkt_matrix[:, :K, :K] = mask[:, :, None] * Q * mask[:, None, :] + torch.diag_embed(1 - mask)
+        kkt_matrix[:, :K, K] = -mask
+        kkt_matrix[:, K, :K] = mask
+        kkt_rhs[:, :K] = mask * c
+        solution = torch.linalg.solve(kkt_matrix, kkt_rhs)
+        z_subproblem, multiplier = solution[:, :K], solution[:, K:]
+
+        # Step towards the subproblem solution until the first free variable hits zero
+        blocking = free & (z_subproblem < 0)
+        is_blocked = blocking.any(dim=1) & ~done
+        ratios = torch.where(blocking, z / (z - z_subproblem), torch.full_like(z, np.inf))
+        step_length, blocking_index = ratios.min(dim=1)
+        step_length = torch.where(is_blocked, step_length.clamp(max=1), torch.ones_like(step_length))
+        step_length.masked_fill_(done, 0)
+        z = z + step_length[:, None] * (z_subproblem - z)
+
+        blocked_rows = batch_range[is_blocked]
+        free[blocked_rows, blocking_index[is_blocked]] = False
+        z[blocked_rows, blocking_index[is_blocked]] = 0
+
+        # Optimality check for problems that reached their subproblem solution
+        multipliers = z @ Q - c - multiplier
+        multipliers = torch.where(free, torch.full_like(multipliers, np.inf), multipliers)
+        min_multiplier, entering_index = multipliers.min(dim=1)
+        is_unblocked = ~is_blocked & ~done
+        enter = is_unblocked & (min_multiplier < -tol)
+        free[batch_range[enter], entering_index[enter]] = True
+        done = done | (is_unblocked & ~enter)
+
+        if done.all():
+            break
 
-def project2simplex_(y, dim: int = 0, zero_threshold: float = 1e-10) -> torch.Tensor:
-    """(In-place) Projects a matrix such that the columns (or rows) lie on the unit simplex.
+    return z.clip(min=zero_threshold)
 
-    See https://math.stackexchange.com/questions/2402504/orthogonal-projection-onto-the-unit-simplex
-    for a reference.
+@torch.no_grad()
+def solve_nnls(Q: torch.Tensor, c: torch.Tensor, passive: Optional[torch.Tensor] = None,
+        max_iterations: Optional[int] = None, batch_size: int = 8192, tol: float = 1e-10) -> torch.Tensor:
+    """Solve a batch of non-negative least squares problems that share the same Gram matrix.
 
-    The goal is to find a scalar mu such that || (y-mu)_+ ||_1 = 1
+    For every row ``c_i`` of ``c``, solves
 
-    Currently uses Newton's method to optimize || y - mu ||^2
+    min_x 1/2 xT Q x - c_iT x   s.t.   x >= 0
 
-    TODO: try implementing it this way instead: https://arxiv.org/pdf/1101.6081.pdf
+    exactly with block principal pivoting (Kim & Park, 2011). All rows are pivoted simultaneously; each pass
+    solves the unconstrained subproblems on the current passive sets with one batched linear solve, and
+    rows drop out of the working set as soon as their primal and dual variables are feasible.
 
     Args:
-        y: list of vectors to be projected to unit simplex
-        dim: dimension along which to project
-        zero_threshold: threshold to treat as zero for numerical stability purposes
+        Q: K x K positive definite Gram matrix shared by all problems
+        c: N x K linear terms
+        passive: N x K boolean warm start for the set of positive variables. Default: all variables at zero
+        max_iterations: maximum number of pivoting passes. Default: ``5 * K``
+        batch_size: maximum number of K x K systems to solve at once, to bound memory usage
+        tol: relative tolerance on primal and dual feasibility
+
+    Returns:
+        N x K optimal solutions
     """
-    y_copy = y.clone()
-    num_components = y.shape[dim]
+    num_problems, K = c.shape
+    if max_iterations is None:
+        max_iterations = 5 * K
+
+    if passive is None:
+        passive = torch.zeros_like(c, dtype=torch.bool)
+    passive = passive.clone()
+
+    x = torch.zeros_like(c)
+    remaining = torch.arange(num_problems, device=c.device)
+    best_num_infeasible = torch.full((num_problems,), K + 1, device=c.device)
+    backup_counter = torch.full((num_problems,), 3, device=c.device)
+    feature_indices = torch.arange(K, device=c.device)
+
+    for _ in range(max_iterations):
+        passive_remaining = passive[remaining]
+        c_remaining = c[remaining]
+
+        x_remaining = []
+        for mask, c_batch in zip(passive_remaining.to(c.dtype).split(batch_size), c_remaining.split(batch_size)):
+            # Restrict the system to the passive set; active variables are pinned to zero
+            system = mask[:, :, None] * Q * mask[:, None, :] + torch.diag_embed(1 - mask)
+            x_remaining.append(torch.linalg.solve(system, mask * c_batch))
+        x_remaining = torch.cat(x_remaining)
+        dual = (x_remaining @ Q - c_remaining).masked_fill_(passive_remaining, 0)
+        x[remaining] = x_remaining
+
+        primal_tol = tol * x_remaining.abs().amax(dim=1, keepdim=True)
+        dual_tol = tol * c_remaining.abs().amax(dim=1, keepdim=True)
+        infeasible = (passive_remaining & (x_remaining < -primal_tol)) | (~passive_remaining & (dual < -dual_tol))
+        num_infeasible = infeasible.sum(dim=1)
+
+        # Backup rule: exchange all infeasible variables while their number keeps decreasing (with up to
+        # three non-improving passes); otherwise fall back to exchanging a single variable
+        improved = num_infeasible < best_num_infeasible[remaining]
+        backup_remaining = torch.where(improved, 3, backup_counter[remaining] - 1)
+        full_exchange = backup_remaining >= 0
+        best_num_infeasible[remaining] = torch.minimum(best_num_infeasible[remaining], num_infeasible)
+        backup_counter[remaining] = backup_remaining.clip(min=0)
+
+        last_infeasible = torch.where(infeasible, feature_indices, -1).amax(dim=1)
+        single_exchange = feature_indices == last_infeasible[:, None]
+        exchange = torch.where(full_exchange[:, None], infeasible, single_exchange & infeasible)
+        passive[remaining] = passive_remaining ^ exchange
+
+        remaining = remaining[num_infeasible > 0]
+        if len(remaining) == 0:
+            break
 
-    y_copy.sub_(y_copy.sum(dim=dim, keepdim=True).sub_(1), alpha=1/num_components)
-    mu = y_copy.max(dim=dim, keepdim=True)[0].div_(2)
-    derivative_prev, derivative = None, None
-    for _ in range(num_components):
-        difference = y_copy.sub(mu)
-        objective_value = difference.clip_(min=zero_threshold).sum(dim, keepdim=True).sub_(1)
-        derivative = difference.gt_(zero_threshold).sum(dim, keepdim=True)
+    return x.clip(min=0)
 
-        if derivative_prev is not None and (derivative == derivative_prev).all():
-            break
+@torch.no_grad()
+def solve_projected_fista(Q: torch.Tensor, c: torch.Tensor, M: torch.Tensor, project, n_epochs: int = 10000,
+        tol: float = 1e-3, check_frequency: int = 10):
+    """Solve a batch of constrained quadratic programs with FISTA and adaptive restart.
+
+    For every b, solves
+
+    min_M 1/2 <M Q_b, M> - <c_b, M>   s.t.   M in C
+
+    by projected accelerated gradient descent with step size 1 / λ_max(Q_b). The momentum of a problem is
+    reset whenever its gradient mapping points against the momentum direction (O'Donoghue & Candès, 2015),
+    which avoids the oscillations of plain Nesterov iterations on ill-conditioned problems. Convergence is
+    only checked every ``check_frequency`` iterations, so the host synchronizes once per check rather than
+    once per iteration.
+
+    Args:
+        Q: B x K x K positive definite quadratic forms
+        c: B x G x K linear terms
+        M: B x G x K feasible warm start
+        project: maps a B x G x K tensor onto the constraint set C
+        n_epochs: maximum number of iterations
+        tol: all problems have converged once no entry moves by more than ``tol`` in one iteration
+        check_frequency: number of iterations between convergence checks
 
-        mu.addcdiv_(objective_value, derivative)
-        derivative_prev = derivative
+    Returns:
+        Tuple of the B x G x K solutions and the number of iterations performed.
+    """
+    step_sizes = 1 / torch.linalg.eigvalsh(Q)[:, -1, None, None]
+    momentum_weights = torch.ones_like(step_sizes)
+    extrapolation = M
+    for epoch in range(1, n_epochs+1):
+        M_prev = M
+        M = project(extrapolation - step_sizes * (torch.bmm(extrapolation, Q) - c))
+
+        restart = ((extrapolation - M) * (M - M_prev)).sum(dim=(1, 2), keepdim=True) > 0
+        momentum_weights_next = (1 + torch.sqrt(1 + 4 * momentum_weights ** 2)) / 2
+        momentum = torch.where(restart, 0, (momentum_weights - 1) / momentum_weights_next)
+        momentum_weights = torch.where(restart, 1, momentum_weights_next)
+        extrapolation = M + momentum * (M - M_prev)
+
+        if epoch % check_frequency == 0 and (M - M_prev).abs().amax() < tol:
+            break
 
-    y_copy.sub_(mu).clip_(min=zero_threshold)
-    assert y_copy.sum(dim=dim).sub_(1).abs_().max() < 1e-4, y_copy.sum(dim=dim).sub_(1).abs_().max()
-    return y_copy
+    return M, epoch
 
 class IndependentSet:
     """Iterator class that yields a list of batch_size independent nodes from a spatial graph.
@@ -492,6 +798,671 @@ def sample_graph_iid(adjacency_list, indices_remaining, sample_size):
 
     return valid_indices
 
+def color_graph(adjacency_matrix: csr_matrix, method: str = "greedy") -> np.ndarray:
+    """Compute a proper vertex coloring of a spatial graph.
+
+    Nodes with the same color are never neighbors, so every color class is an independent set.
+
+    Args:
+        adjacency_matrix: sparse graph representation
+        method: coloring heuristic. ``greedy`` visits nodes in order of decreasing degree
+            (Welsh-Powell); ``dsatur`` always colors the node with the most distinctly-colored
+            neighbors next, which typically uses fewer colors at a slightly higher cost.
+
+    Returns:
+        integer color for each node in the graph
+    """
+    adjacency_matrix = csr_matrix(adjacency_matrix)
+    num_nodes, _ = adjacency_matrix.shape
+    indptr, indices = adjacency_matrix.indptr, adjacency_matrix.indices
+    degrees = np.diff(indptr)
+
+    colors = np.full(num_nodes, -1, dtype=np.int64)
+
+    def smallest_available_color(node):
+        neighbor_colors = colors[indices[indptr[node]:indptr[node+1]]]
+        used = np.zeros(len(neighbor_colors) + 1, dtype=bool)
+        neighbor_colors = neighbor_colors[(neighbor_colors >= 0) & (neighbor_colors < len(used))]
+        used[neighbor_colors] = True
+
+        return np.argmin(used)
+
+    if method == "greedy":
+        for node in np.argsort(-degrees, kind="stable"):
+            colors[node] = smallest_available_color(node)
+
+    elif method == "dsatur":
+        import heapq
+
+        saturation = [set() for _ in range(num_nodes)]
+        heap = [(0, -degree, node) for node, degree in enumerate(degrees)]
+        heapq.heapify(heap)
+        while heap:
+            negative_saturation, _, node = heapq.heappop(heap)
+            if colors[node] >= 0 or -negative_saturation != len(saturation[node]):
+                continue # Stale heap entry
+
+            color = smallest_available_color(node)
+            colors[node] = color
+            for neighbor in indices[indptr[node]:indptr[node+1]]:
+                if colors[neighbor] < 0 and color not in saturation[neighbor]:
+                    saturation[neighbor].add(color)
+                    heapq.heappush(heap, (-len(saturation[neighbor]), -degrees[neighbor], neighbor))
+    else:
+        raise NotImplementedError
+
+    return colors
+
+class GraphColoringScheduler:
+    """Iterator class that yields batches of mutually non-adjacent nodes from a spatial graph.
+
+    Replaces the per-pass sampling of :class:`IndependentSet` with a graph coloring that is computed
+    once. Every pass visits each color class (an independent set) in turn, split into batches of at most
+    ``batch_size`` nodes, so that each yielded batch is a ready-made index tensor.
+
+    Attributes:
+        colors: color of each node in the graph
+        color_classes: indices of nodes belonging to each color, stored on ``device``
+        batch_size: maximum number of nodes per yielded batch
+        shuffle: if set, the order of color classes and the assignment of nodes to batches are
+            randomized on every pass, mirroring the stochasticity of :class:`IndependentSet`
+        contiguous: if set, batches are yielded as ``slice`` objects into the color-sorted layout given by
+            ``permutation``, so that every batch is a contiguous row range of permuted tensors. Nodes keep
+            a fixed batch assignment in this mode; only the order of color classes is shuffled.
+        permutation: ordering of nodes by color; ``tensor[permutation]`` converts to the contiguous layout
+        inverse_permutation: inverse of ``permutation``, used to restore the original node order
+    """
+
+    def __init__(self, adjacency_matrix: csr_matrix, device, batch_size: int = 1024, method: str = "greedy",
+            shuffle: bool = True, contiguous: bool = False, colors: Optional[np.ndarray] = None):
+        self.N, _ = adjacency_matrix.shape
+        self.device = device
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.contiguous = contiguous
+        self.colors = color_graph(adjacency_matrix, method=method) if colors is None else colors
+
+        order = np.argsort(self.colors, kind="stable")
+        class_sizes = np.bincount(self.colors)
+        self.class_boundaries = np.concatenate([[0], np.cumsum(class_sizes)])
+        self.color_classes = [
+            torch.from_numpy(class_indices).to(device)
+            for class_indices in np.split(order, self.class_boundaries[1:-1])
+        ]
+
+        self.permutation = torch.from_numpy(order).to(device)
+        self.inverse_permutation = torch.empty_like(self.permutation)
+        self.inverse_permutation[self.permutation] = torch.arange(self.N, device=device)
+
+    def permute_adjacency_matrix(self, adjacency_matrix: csr_matrix):
+        """Reorder the rows and columns of ``adjacency_matrix`` into the contiguous layout."""
+        order = self.permutation.cpu().numpy()
+
+        return adjacency_matrix[order][:, order]
+
+    @property
+    def num_colors(self):
+        return len(self.color_classes)
+
+    def class_batches(self, batch_size: Optional[int] = None, mask: Optional[torch.Tensor] = None):
+        """Yield the node batches of one pass over the graph, grouped by color class.
+
+        Batches within a group share no edges, so they may be processed concurrently.
+
+        Args:
+            batch_size: overrides ``self.batch_size`` for this pass
+            mask: boolean tensor over nodes; if given, only nodes where ``mask`` is set are visited. In the
+                contiguous layout, ``mask`` is indexed in permuted order and batches are yielded as index
+                tensors instead of slices.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        class_order = range(self.num_colors)
+        if self.shuffle:
+            class_order = torch.randperm(self.num_colors).tolist()
+
+        for color in class_order:
+            if self.contiguous:
+                start, end = self.class_boundaries[color], self.class_boundaries[color + 1]
+                if mask is not None:
+                    class_range = torch.arange(start, end, device=self.device)[mask[start:end]]
+                    if len(class_range) > 0:
+                        yield list(torch.split(class_range, batch_size))
+                    continue
+
+                yield [slice(batch_start, min(batch_start + batch_size, end)) for batch_start in range(start, end, batch_size)]
+                continue
+
+            color_class = self.color_classes[color]
+            if mask is not None:
+                color_class = color_class[mask[color_class]]
+                if len(color_class) == 0:
+                    continue
+            if self.shuffle:
+                color_class = color_class[torch.randperm(len(color_class), device=self.device)]
+
+            yield list(torch.split(color_class, batch_size))
+
+    def batches(self, batch_size: Optional[int] = None, mask: Optional[torch.Tensor] = None):
+        """Yield node batches for one pass over the graph.
+
+        See :meth:`class_batches` for a description of the arguments.
+        """
+        for class_batches in self.class_batches(batch_size=batch_size, mask=mask):
+            yield from class_batches
+
+    def __iter__(self):
+        return self.batches()
+
+class SpatialTiling:
+    """Partition of a spatial graph into tiles of nearby nodes, each padded with a one-hop halo.
+
+    Coordinates are first split into vertical strips with equal numbers of nodes, and every strip is then
+    split along the second axis, so that all tiles hold about ``tile_size`` nodes. The halo of a tile
+    consists of all neighbors of its interior nodes that belong to other tiles, so the interior can be
+    optimized exactly while the halo is held fixed.
+
+    Iterating over the tiling yields ``(cells, num_interior, adjacency_matrix)`` triples, where ``cells``
+    lists the interior nodes followed by the halo and ``adjacency_matrix`` is the graph restricted to ``cells``.
+
+    Attributes:
+        cells: node indices of each tile, interior first
+        num_interiors: number of interior nodes of each tile
+        adjacency_matrices: local graph of each tile
+    """
+
+    def __init__(self, coordinates: np.ndarray, adjacency_matrix: csr_matrix, tile_size: int):
+        adjacency_matrix = csr_matrix(adjacency_matrix)
+        num_nodes = len(coordinates)
+        num_strips = max(1, int(np.round(np.sqrt(num_nodes / tile_size))))
+
+        self.cells = []
+        self.num_interiors = []
+        self.adjacency_matrices = []
+        self.colors = {}
+
+        strip_order = np.argsort(coordinates[:, 0], kind="stable")
+        for strip in np.array_split(strip_order, num_strips):
+            strip = strip[np.argsort(coordinates[strip, 1], kind="stable")]
+            num_tiles = max(1, int(np.ceil(len(strip) / tile_size)))
+            for interior in np.array_split(strip, num_tiles):
+                interior = np.sort(interior)
+                halo = np.setdiff1d(np.unique(adjacency_matrix[interior].indices), interior)
+                cells = np.concatenate([interior, halo])
+
+                self.cells.append(cells)
+                self.num_interiors.append(len(interior))
+                self.adjacency_matrices.append(adjacency_matrix[cells][:, cells])
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __iter__(self):
+        return zip(self.cells, self.num_interiors, self.adjacency_matrices)
+
+    def get_colors(self, tile_index: int, method: str = "greedy"):
+        """Return the (cached) coloring of a tile's local graph."""
+        if (tile_index, method) not in self.colors:
+            self.colors[(tile_index, method)] = color_graph(self.adjacency_matrices[tile_index], method=method)
+
+        return self.colors[(tile_index, method)]
+
+class NeighborSumBuffer:
+    """Buffer that keeps the neighbor sums ``nu = A @ Z`` of a spatial graph up to date.
+
+    Instead of recomputing ``A @ Z`` whenever some rows of ``Z`` change, the buffer is patched in place
+    with the sparse delta ``A[:, idx] @ (Z_new[idx] - Z_old[idx])``, which only touches the edges
+    incident to the updated rows.
+
+    Attributes:
+        adjacency_matrix: PyTorch sparse version of the graph, used for full refreshes
+        nu: current value of ``A @ Z``
+    """
+
+    def __init__(self, adjacency_matrix: csr_matrix, context: dict):
+        self.context = context
+        device = context["device"]
+
+        # Column j of A lists the rows of nu that depend on z_j
+        adjacency_csc = adjacency_matrix.tocsc()
+        adjacency_csc.sort_indices()
+        self.indptr_host = adjacency_csc.indptr.astype(np.int64)
+        self.indptr = torch.from_numpy(self.indptr_host).to(device)
+        self.indices = torch.from_numpy(adjacency_csc.indices.astype(np.int64)).to(device)
+        self.columns = torch.repeat_interleave(torch.arange(adjacency_csc.shape[1], device=device), self.indptr.diff())
+        self.weights = torch.from_numpy(adjacency_csc.data).to(**context)
+        self.adjacency_matrix = convert_numpy_to_pytorch_sparse_coo(adjacency_matrix, context).coalesce()
+        self.nu = None
+
+    def reset(self, Z: torch.Tensor):
+        """Recompute the buffer from scratch."""
+        self.nu = self.adjacency_matrix @ Z
+
+        return self.nu
+
+    def update(self, idx: torch.Tensor, delta: torch.Tensor):
+        """Propagate a change of the rows ``Z[idx]`` by ``delta`` into the buffer.
+
+        Args:
+            idx: indices of updated rows, or a ``slice`` of consecutive rows
+            delta: difference between the new and old values of ``Z[idx]``
+        """
+        if isinstance(idx, slice):
+            # Edges of consecutive columns are stored contiguously, so no gathers are needed
+            edges = slice(self.indptr_host[idx.start], self.indptr_host[idx.stop])
+            batch_positions = self.columns[edges] - idx.start
+            self.nu.index_add_(0, self.indices[edges], delta[batch_positions] * self.weights[edges, None])
+            return
+
+        starts = self.indptr[idx]
+        counts = self.indptr[idx + 1] - starts
+
+        batch_positions = torch.repeat_interleave(torch.arange(len(idx), device=starts.device), counts)
+        edge_offsets = torch.arange(len(batch_positions), device=starts.device) \
+            - torch.repeat_interleave(counts.cumsum(0) - counts, counts)
+        edge_positions = starts[batch_positions] + edge_offsets
+
+        self.nu.index_add_(0, self.indices[edge_positions], delta[batch_positions] * self.weights[edge_positions, None])
+
+def compress_rows(rows: torch.Tensor, resolution: float):
+    """Compress the rows of a matrix into a weighted coreset by quantization.
+
+    Rows are snapped to a grid with the given spacing, and all rows that fall into the same grid cell are
+    replaced by their mean, weighted by the number of rows in the cell. For a convex function ``f`` of
+    the rows, ``sum_i f(row_i)`` is then approximated by ``sum_j weight_j f(representative_j)`` with an error
+    that is second order in the resolution.
+
+    Args:
+        rows: (N, K) tensor to compress
+        resolution: grid spacing used for quantization
+
+    Returns:
+        Tuple of (M, K) representative rows and their (M,) weights, with M <= N.
+    """
+    keys = torch.round(rows / resolution).to(torch.int64)
+    _, inverse, counts = torch.unique(keys, dim=0, return_inverse=True, return_counts=True)
+
+    weights = counts.to(rows.dtype)
+    representatives = torch.zeros((len(counts), rows.shape[1]), dtype=rows.dtype, device=rows.device)
+    representatives.index_add_(0, inverse, rows).div_(weights[:, None])
+
+    return representatives, weights
+
+def compute_log_partition_function(Sigma_x_inv: torch.Tensor, nus: Sequence[Optional[torch.Tensor]], betas: Sequence[float],
+        nu_weights: Optional[Sequence[torch.Tensor]] = None, samples: Optional[Sequence[torch.Tensor]] = None):
+    """Compute the weighted log-partition function of the spatial affinity objective.
+
+    Args:
+        Sigma_x_inv: (K, K) spatial affinity matrix
+        nus: (N, K) neighbor sums of each replicate, or ``None`` for replicates without spatial information
+        betas: weight of each replicate
+        nu_weights: if set, (N,) weight of each neighbor sum, e.g. the weights of a coreset
+        samples: if set, indices of the neighbor sums of each replicate to use; their sum is rescaled to an
+            unbiased estimate of the sum over all neighbor sums
+
+    Returns:
+        Sum over replicates of ``beta * sum_i log Z(nu_i @ Sigma_x_inv)``.
+    """
+    log_partition_function = 0
+    for index, (nu, beta) in enumerate(zip(nus, betas)):
+        if nu is None:
+            continue
+
+        multiplier = 1
+        if samples is not None:
+            multiplier = len(nu) / len(samples[index])
+            nu = nu[samples[index]]
+
+        if DEBUG:
+            assert torch.isfinite(nu).all()
+            assert torch.isfinite(Sigma_x_inv).all()
+        eta = nu @ Sigma_x_inv
+        logZ = integrate_of_exponential_over_simplex(eta)
+        if nu_weights is not None:
+            logZ = logZ * nu_weights[index]
+        log_partition_function += multiplier * beta * logZ.sum()
+
+    return log_partition_function
+
+class StochasticLogPartitionFunction:
+    """Stochastic variance-reduced (SVRG) estimate of :func:`compute_log_partition_function`.
+
+    Every call samples a mini-batch of neighbor sums per replicate (with replacement) and uses the deviation
+    of the mini-batch value from a full-data snapshot at ``Sigma_x_inv_snapshot`` as a control variate::
+
+        F(Σ̃) + f_B(Σ) - f_B(Σ̃) + <∇F(Σ̃) - ∇f_B(Σ̃), Σ - Σ̃>
+
+    The estimate is unbiased for ``F(Σ)``, and both its variance and that of its gradient vanish as ``Σ``
+    approaches the snapshot. The snapshot is moved to the current argument every ``snapshot_frequency`` calls.
+
+    Example::
+
+        estimate_log_partition_function = StochasticLogPartitionFunction(nus, betas, subsample_rate=0.1)
+        for epoch in loop:
+            log_partition_function = estimate_log_partition_function(Sigma_x_inv)
+            ...
+    """
+
+    def __init__(self, nus: Sequence[Optional[torch.Tensor]], betas: Sequence[float], subsample_rate: float,
+            snapshot_frequency: Optional[int] = None):
+        """Initialize the estimator.
+
+        Args:
+            nus: (N, K) neighbor sums of each replicate, or ``None`` for replicates without spatial information
+            betas: weight of each replicate
+            subsample_rate: fraction of the neighbor sums of each replicate that is sampled in every call
+            snapshot_frequency: number of calls between snapshot updates. Default: ``ceil(2 / subsample_rate)``,
+                so that the cost of the snapshots is comparable to that of the mini-batches.
+        """
+        self.nus = nus
+        self.betas = betas
+        self.subsample_rate = subsample_rate
+        self.snapshot_frequency = int(np.ceil(2 / subsample_rate)) if snapshot_frequency is None else snapshot_frequency
+
+        self.num_calls = 0
+        self.Sigma_x_inv_snapshot = None
+        self.value_snapshot = None
+        self.gradient_snapshot = None
+
+    def update_snapshot(self, Sigma_x_inv: torch.Tensor):
+        """Evaluate the full-data log-partition function and its gradient at ``Sigma_x_inv``."""
+        Sigma_x_inv_snapshot = Sigma_x_inv.detach().clone().requires_grad_(True)
+        value = compute_log_partition_function(Sigma_x_inv_snapshot, self.nus, self.betas)
+        gradient, = torch.autograd.grad(value, Sigma_x_inv_snapshot)
+
+        self.Sigma_x_inv_snapshot = Sigma_x_inv_snapshot.detach()
+        self.value_snapshot = value.detach()
+        self.gradient_snapshot = gradient
+
+    def sample(self):
+        """Draw the indices of a mini-batch of neighbor sums for each replicate."""
+        return [None if nu is None else torch.randint(len(nu), (max(1, int(self.subsample_rate * len(nu))),), device=nu.device)
+                for nu in self.nus]
+
+    def __call__(self, Sigma_x_inv: torch.Tensor):
+        if self.num_calls % self.snapshot_frequency == 0:
+            self.update_snapshot(Sigma_x_inv)
+        self.num_calls += 1
+
+        samples = self.sample()
+
+        Sigma_x_inv_snapshot = self.Sigma_x_inv_snapshot.clone().requires_grad_(True)
+        batch_value_snapshot = compute_log_partition_function(Sigma_x_inv_snapshot, self.nus, self.betas, samples=samples)
+        batch_gradient_snapshot, = torch.autograd.grad(batch_value_snapshot, Sigma_x_inv_snapshot)
+
+        batch_value = compute_log_partition_function(Sigma_x_inv, self.nus, self.betas, samples=samples)
+        correction = (self.gradient_snapshot - batch_gradient_snapshot).view(-1) @ (Sigma_x_inv - self.Sigma_x_inv_snapshot).view(-1)
+
+        return self.value_snapshot + batch_value - batch_value_snapshot.detach() + correction
+
+class SufficientStatistics:
+    """Memoized sufficient statistics of a replicate's expression ``Y``, embeddings ``X`` and metagenes ``M``.
+
+    Every statistic is computed on first access and cached together with references to the tensors it was
+    computed from and their version counters. PyTorch increments a tensor's version counter on every in-place
+    write, and ``EmbeddingState`` and ``MetageneState`` are only ever updated in place, so a cached value is
+    reused exactly until one of its inputs is written to (or a different tensor is passed in).
+
+    ``Y`` may be dense or a sparse CSR tensor, in which case all statistics are computed with sparse kernels, or a
+    :class:`BackedExpression`, in which case they are streamed from disk. In-memory ``Y`` may live on the host
+    while ``X`` and ``M`` live on the device; products are then computed on the host and only the (N, K) or (G, K)
+    results are moved.
+    Statistics are returned without the ``1 / σ_yx^2`` scaling, which changes independently of the inputs.
+    Returned tensors are shared with the cache and must not be modified in place.
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def memoize(self, name: str, inputs: Sequence[torch.Tensor], compute):
+        """Return the cached value of statistic ``name`` if ``inputs`` are unchanged, else recompute it."""
+        versions = tuple(tensor._version for tensor in inputs)
+        if name in self.cache:
+            cached_inputs, cached_versions, value = self.cache[name]
+            if cached_versions == versions and all(cached is tensor for cached, tensor in zip(cached_inputs, inputs)):
+                return value
+
+        value = compute()
+        self.cache[name] = (tuple(inputs), versions, value)
+
+        return value
+
+    def Y_norm(self, Y: torch.Tensor) -> float:
+        """Squared Frobenius norm of ``Y``."""
+        return self.memoize("Y_norm", (Y,), lambda: squared_norm(Y))
+
+    def Y_transpose(self, Y: torch.Tensor) -> torch.Tensor:
+        """``YT``; sparse CSR inputs are transposed into CSR layout, since CSC products are slow."""
+        return self.memoize("Y_transpose", (Y,), lambda: Y.t().to_sparse_csr() if Y.layout == torch.sparse_csr else Y.t())
+
+    def YM(self, Y: torch.Tensor, M: torch.Tensor) -> torch.Tensor:
+        if isinstance(Y, BackedExpression):
+            return self.memoize("YM", (Y, M), lambda: Y @ M)
+
+        return self.memoize("YM", (Y, M), lambda: (Y @ M.to(Y.device)).to(M.device))
+
+    def MTM(self, M: torch.Tensor) -> torch.Tensor:
+        return self.memoize("MTM", (M,), lambda: M.T @ M)
+
+    def MTM_max_eigenvalue(self, M: torch.Tensor) -> float:
+        return self.memoize("MTM_max_eigenvalue", (M,), lambda: torch.linalg.eigvalsh(self.MTM(M)).max().item())
+
+    def XTX(self, X: torch.Tensor) -> torch.Tensor:
+        return self.memoize("XTX", (X,), lambda: X.T @ X)
+
+    def YTX(self, Y: torch.Tensor, X: torch.Tensor) -> torch.Tensor:
+        if isinstance(Y, BackedExpression):
+            return self.memoize("YTX", (Y, X), lambda: Y.transpose_matmul(X))
+
+        return self.memoize("YTX", (Y, X), lambda: (self.Y_transpose(Y) @ X.to(Y.device)).to(X.device))
+
+    def squared_error(self, Y: torch.Tensor, X: torch.Tensor, M: torch.Tensor, chunk_size: Optional[int] = None) -> float:
+        """Squared reconstruction error ``|| Y - X MT ||_F^2``, without forming the residual.
+
+        Uses ``||Y||^2 - 2 <YT X, M> + <MT M, XT X>``, which only involves the cached (G, K) and (K, K)
+        statistics. If the result is so small relative to ``||Y||^2`` that cancellation may have destroyed
+        its accuracy, the residual is instead accumulated over chunks of rows.
+
+        Args:
+            chunk_size: number of rows per chunk in the fallback. Default: about 16M residual entries per chunk
+        """
+        def compute():
+            Y_norm = self.Y_norm(Y)
+            error = Y_norm - 2 * (self.YTX(Y, X) * M).sum().item() + (self.MTM(M) * self.XTX(X)).sum().item()
+            if error > np.sqrt(torch.finfo(X.dtype).eps) * Y_norm:
+                return error
+
+            N, G = Y.shape
+            rows_per_chunk = chunk_size if chunk_size is not None else max(1, 2**24 // G)
+            error = 0
+            for start in range(0, N, rows_per_chunk):
+                chunk = slice(start, start + rows_per_chunk)
+                Y_chunk = index_rows(Y, chunk).to(X.device)
+                if Y_chunk.layout == torch.sparse_csr:
+                    Y_chunk = Y_chunk.to_dense()
+                error += torch.linalg.norm(torch.addmm(Y_chunk, X[chunk], M.T, alpha=-1), ord='fro').item() ** 2
+
+            return error
+
+        return self.memoize("squared_error", (Y, X, M), compute)
+
+def squared_norm(Y: torch.Tensor) -> float:
+    """Squared Frobenius norm of a dense, sparse CSR or backed matrix."""
+    if isinstance(Y, BackedExpression):
+        return Y.squared_norm()
+
+    if Y.layout == torch.sparse_csr:
+        return torch.linalg.vector_norm(Y.values()).item() ** 2
+
+    return torch.linalg.norm(Y, ord='fro').item() ** 2
+
+def index_rows(Y: torch.Tensor, rows) -> torch.Tensor:
+    """Select rows of a dense, sparse CSR or backed matrix.
+
+    PyTorch does not support indexing sparse CSR tensors, so for those the selected rows are gathered from
+    the compressed representation directly.
+
+    Args:
+        Y: dense, sparse CSR or backed matrix
+        rows: slice or 1D tensor of row indices
+
+    Returns:
+        Matrix of the selected rows, with the same layout as ``Y`` (backed rows are read into memory).
+    """
+    if isinstance(Y, BackedExpression):
+        return Y.read_rows(rows)
+
+    if Y.layout != torch.sparse_csr:
+        return Y[rows]
+
+    crow_indices, col_indices, values = Y.crow_indices(), Y.col_indices(), Y.values()
+    if isinstance(rows, slice):
+        rows = torch.arange(len(crow_indices) - 1, device=crow_indices.device)[rows]
+    rows = rows.to(crow_indices.device)
+
+    starts = crow_indices[rows]
+    counts = crow_indices[rows + 1] - starts
+    selected_crow_indices = torch.zeros(len(rows) + 1, dtype=crow_indices.dtype, device=crow_indices.device)
+    torch.cumsum(counts, dim=0, out=selected_crow_indices[1:])
+    num_selected = selected_crow_indices[-1].item()
+
+    offsets = torch.arange(num_selected, device=crow_indices.device) - torch.repeat_interleave(selected_crow_indices[:-1], counts, output_size=num_selected)
+    positions = torch.repeat_interleave(starts, counts, output_size=num_selected) + offsets
+
+    return torch.sparse_csr_tensor(selected_crow_indices, col_indices[positions], values[positions], size=(len(rows), Y.shape[1]))
+
+def convert_scipy_to_pytorch_sparse_csr(matrix, context):
+    """Convert a SciPy sparse matrix (or dense array) to a PyTorch sparse CSR tensor."""
+    matrix = csr_matrix(matrix)
+    crow_indices = torch.from_numpy(matrix.indptr.astype(np.int64))
+    col_indices = torch.from_numpy(matrix.indices.astype(np.int64))
+
+    return torch.sparse_csr_tensor(crow_indices, col_indices, torch.from_numpy(matrix.data), size=matrix.shape, **context)
+
+class BackedExpression:
+    """Read-only expression matrix that stays on disk, such as the ``X`` of an AnnData opened in backed mode.
+
+    The optimizers only consume ``Y`` through reduced quantities (``Y M``, ``YT X``, ``||Y||^2`` and binned
+    expression), so these are streamed over chunks of rows instead of loading ``Y`` into memory. The next
+    chunk is read on a background thread while the current one is being processed, so that disk reads
+    overlap with compute. Chunks are converted to sparse CSR tensors if the backing array is sparse.
+
+    Attributes:
+        X: on-disk array supporting row slicing, e.g. an ``h5py.Dataset`` or AnnData's backed sparse dataset
+        shape: shape of the expression matrix
+        scale: factor applied to every entry as it is read
+        chunk_size: number of rows per chunk
+    """
+
+    # The backing array is never written to, so memoized statistics that depend on it never go stale
+    _version = 0
+
+    def __init__(self, X, context: dict, scale: float = 1, chunk_size: Optional[int] = None):
+        self.X = X
+        self.shape = tuple(X.shape)
+        self.context = context
+        self.scale = scale
+        self.chunk_size = chunk_size if chunk_size is not None else max(1, 2**22 // self.shape[1])
+
+    @staticmethod
+    def is_backed(X) -> bool:
+        """Whether ``X`` is the on-disk matrix of a backed AnnData, i.e. an ``h5py.Dataset`` or a backed sparse dataset."""
+        return isinstance(X, (h5py.Dataset, BackedSparseDataset))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __mul__(self, factor: float):
+        return BackedExpression(self.X, self.context, scale=self.scale * factor, chunk_size=self.chunk_size)
+
+    def to(self, *args, **kwargs):
+        """Backed expression stays on disk; chunks are moved to the device of the operands they meet."""
+        return self
+
+    def read(self, rows, transpose: bool = False) -> torch.Tensor:
+        if isinstance(rows, slice):
+            chunk = self.X[rows]
+        else:
+            # On-disk arrays are read fastest (and h5py only supports reads) in increasing row order
+            rows = np.asarray(rows)
+            order = np.argsort(rows)
+            chunk = self.X[rows[order]][np.argsort(order)]
+
+        if issparse(chunk):
+            chunk = csr_matrix(chunk.T if transpose else chunk)
+            chunk = convert_scipy_to_pytorch_sparse_csr(chunk, self.context)
+        else:
+            chunk = torch.tensor(chunk.T if transpose else chunk, **self.context)
+
+        return chunk * self.scale
+
+    def read_rows(self, rows) -> torch.Tensor:
+        """Read the selected rows into memory."""
+        if isinstance(rows, torch.Tensor):
+            rows = rows.cpu().numpy()
+
+        return self.read(rows)
+
+    def chunks(self, device=None, transpose: bool = False):
+        """Iterate over ``(rows, chunk)`` pairs, prefetching the next chunk on a background thread.
+
+        Args:
+            device: device to move chunks to. Default: device of ``context``
+            transpose: if set, yield the transposed chunks, with the transposition done by the reader thread
+        """
+        num_rows, _ = self.shape
+        bounds = [slice(start, min(start + self.chunk_size, num_rows)) for start in range(0, num_rows, self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_chunk = executor.submit(self.read, bounds[0], transpose) if bounds else None
+            for index, rows in enumerate(bounds):
+                chunk = next_chunk.result()
+                if index + 1 < len(bounds):
+                    next_chunk = executor.submit(self.read, bounds[index + 1], transpose)
+
+                yield rows, chunk.to(device if device is not None else self.context.get("device", "cpu"))
+
+    def __matmul__(self, M: torch.Tensor) -> torch.Tensor:
+        result = torch.empty((self.shape[0], M.shape[1]), dtype=M.dtype, device=M.device)
+        for rows, chunk in self.chunks(M.device):
+            result[rows] = chunk @ M
+
+        return result
+
+    def __rmatmul__(self, B: torch.Tensor) -> torch.Tensor:
+        """Product ``B Y``, e.g. for binning; the result is sparse CSR if ``B`` and ``Y`` are both sparse."""
+        if B.layout == torch.sparse_csr:
+            B = csr_matrix((B.values().cpu().numpy(), B.col_indices().cpu().numpy(), B.crow_indices().cpu().numpy()), shape=B.shape).tocsc()
+
+        result = None
+        for rows, chunk in self.chunks(B.device if isinstance(B, torch.Tensor) else self.context.get("device")):
+            if isinstance(B, torch.Tensor):
+                B_chunk = B[:, rows]
+            else:
+                B_chunk = convert_scipy_to_pytorch_sparse_csr(B[:, rows], {"dtype": chunk.dtype, "device": chunk.device})
+            product = B_chunk @ chunk
+            result = product if result is None else result + product
+
+        return result
+
+    def transpose_matmul(self, X: torch.Tensor) -> torch.Tensor:
+        """Product ``YT X``."""
+        result = torch.zeros((self.shape[1], X.shape[1]), dtype=X.dtype, device=X.device)
+        for rows, chunk in self.chunks(X.device, transpose=True):
+            result += chunk @ X[rows]
+
+        return result
+
+    def sum(self) -> float:
+        total = 0
+        for _, chunk in self.chunks():
+            total += (chunk.values() if chunk.layout == torch.sparse_csr else chunk).sum().item()
+
+        return total
+
+    def squared_norm(self) -> float:
+        return sum(squared_norm(chunk) for _, chunk in self.chunks())
+
 def convert_numpy_to_pytorch_sparse_coo(numpy_coo, context):
     indices = numpy_coo.nonzero()
     values = numpy_coo.data[numpy_coo.data.nonzero()]
@@ -526,19 +1497,23 @@ def compute_neighborhood_enrichment(features: np.ndarray, adjacency_matrix: csr_
 
     return np.asarray(normalized_enrichment)
 
-def chunked_coordinates(coordinates: np.ndarray, chunks: int = None, step_size: float = None):
-    """Split a list of 2D coordinates into local chunks.
-    
+def index_chunks(coordinates: np.ndarray, chunks: int = None, step_size: float = None):
+    """Assign 2D coordinates to the local chunks used by :func:`chunked_coordinates` in a single pass.
+
+    Chunk borders are found for every point with ``np.digitize`` along each axis, and chunk occupancies are
+    counted with ``np.bincount``, so the cost is linear in the number of points regardless of the number of chunks.
+    As in :func:`chunked_coordinates`, a chunk contains the points with ``low < coordinate <= high`` along both axes.
+
     Args:
+        coordinates: 2D point coordinates
         chunks: number of equal-sized chunks to split horizontal axis. Vertical chunks are constructed
             with the same chunk size determined by splitting the horizontal axis.
-            
-    Yields:
-        The next chunk of coordinates, in row-major order.
-    """
-    
-    num_points, _ = coordinates.shape
+        step_size: size of chunks; only used if ``chunks`` is not specified
 
+    Returns:
+        A tuple of (horizontal chunk borders, vertical chunk borders, chunk size, row-major index of the chunk of
+        every point or ``-1`` if it lies in none, number of points in every chunk as a 2D array)
+    """
     horizontal_base, vertical_base = np.min(coordinates, axis=0)
     horizontal_range, vertical_range = np.ptp(coordinates, axis=0)
   
@@ -547,7 +1522,7 @@ def chunked_coordinates(coordinates: np.ndarray, chunks: int = None, step_size:
 
     if step_size is None:
         horizontal_borders, step_size = np.linspace(horizontal_base, horizontal_base + horizontal_range, chunks + 1, retstep=True)
-    elif chunks is None:
+    else:
         horizontal_borders = np.arange(horizontal_base, horizontal_base + horizontal_range, step_size)
         
         # Adding endpoint
@@ -557,14 +1532,42 @@ def chunked_coordinates(coordinates: np.ndarray, chunks: int = None, step_size:
     
     # Adding endpoint
     vertical_borders = np.append(vertical_borders, vertical_borders[-1] + step_size)
+
+    num_horizontal_chunks, num_vertical_chunks = len(horizontal_borders) - 1, len(vertical_borders) - 1
+    horizontal_indices = np.digitize(coordinates[:, 0], horizontal_borders, right=True) - 1
+    vertical_indices = np.digitize(coordinates[:, 1], vertical_borders, right=True) - 1
+    inside = (horizontal_indices >= 0) & (horizontal_indices < num_horizontal_chunks) & \
+             (vertical_indices >= 0) & (vertical_indices < num_vertical_chunks)
+
+    chunk_indices = np.where(inside, horizontal_indices * num_vertical_chunks + vertical_indices, -1)
+    counts = np.bincount(chunk_indices[inside], minlength=num_horizontal_chunks * num_vertical_chunks)
+
+    return horizontal_borders, vertical_borders, step_size, chunk_indices, counts.reshape(num_horizontal_chunks, num_vertical_chunks)
+
+def chunked_coordinates(coordinates: np.ndarray, chunks: int = None, step_size: float = None):
+    """Split a list of 2D coordinates into local chunks.
+    
+    Args:
+        chunks: number of equal-sized chunks to split horizontal axis. Vertical chunks are constructed
+            with the same chunk size determined by splitting the horizontal axis.
+            
+    Yields:
+        The next chunk of coordinates, in row-major order.
+    """
+    
+    horizontal_borders, vertical_borders, step_size, chunk_indices, counts = index_chunks(coordinates, chunks=chunks, step_size=step_size)
+
+    # Group points by chunk with a stable sort, which keeps them in their original order within each chunk
+    order = np.argsort(chunk_indices, kind="stable")
+    order = order[np.count_nonzero(chunk_indices < 0):]
+    offsets = np.concatenate([[0], np.cumsum(counts.ravel())])
     
     for i in range(len(horizontal_borders)-1):
         horizontal_low, horizontal_high = horizontal_borders[i:i+2]
         for j in range(len(vertical_borders)-1):
             vertical_low, vertical_high = vertical_borders[j:j+2]
-            horizontal_mask = (coordinates[:, 0] > horizontal_low) & (coordinates[:, 0] <= horizontal_high)
-            vertical_mask = (coordinates[:, 1] > vertical_low) & (coordinates[:, 1] <= vertical_high)
-            chunk_coordinates = coordinates[horizontal_mask & vertical_mask]
+            chunk_index = i * (len(vertical_borders) - 1) + j
+            chunk_coordinates = coordinates[order[offsets[chunk_index]:offsets[chunk_index + 1]]]
             
             chunk_data = {
                 'horizontal_low': horizontal_low,
@@ -581,6 +1584,7 @@ def finetune_chunk_number(coordinates: np.ndarray, chunks: int, downsample_rate:
     
     Using a linear search, searches for a better value of the ``chunks`` value such that
     the average points-per-chunk is closer to the number of points that will be in the chunk.
+    Every candidate only requires the chunk occupancy histogram from :func:`index_chunks`.
     
     Args:
         coordinates: original spot coordinates
@@ -594,19 +1598,13 @@ def finetune_chunk_number(coordinates: np.ndarray, chunks: int, downsample_rate:
         max_nudge = chunks // 2
         
     num_points, num_dimensions = coordinates.shape
-    target_points = num_points * downsample_rate
-
-    horizontal_base, vertical_base = np.min(coordinates, axis=0)
-    horizontal_range, vertical_range = np.ptp(coordinates, axis=0)
 
     direction = 0
     for chunk_nudge in range(max_nudge):
-        valid_chunks = []
-        for chunk_data in chunked_coordinates(coordinates, chunks=chunks + direction * chunk_nudge):
-            if len(chunk_data['chunk_coordinates']) > 0:
-                valid_chunks.append(chunk_data)
+        *_, counts = index_chunks(coordinates, chunks=chunks + direction * chunk_nudge)
+        num_valid_chunks = np.count_nonzero(counts)
 
-        points_per_chunk = num_points * downsample_rate / len(valid_chunks)
+        points_per_chunk = num_points * downsample_rate / num_valid_chunks
         downsampled_1d_density = int(np.round(np.sqrt(points_per_chunk)))
         new_direction = 1 - 2 * ((downsampled_1d_density**2) > points_per_chunk)
         if direction == 0:
@@ -646,10 +1644,9 @@ def chunked_downsample_on_grid(coordinates: np.ndarray, downsample_rate: float,
     if chunks is not None:
         chunks = finetune_chunk_number(coordinates, chunks, downsample_rate)
 
-    valid_chunks = []
-    for chunk_data in chunked_coordinates(coordinates, chunks=chunks, step_size=chunk_size):
-        if len(chunk_data['chunk_coordinates']) > 0:
-            valid_chunks.append(chunk_data)
+    # Only the borders of occupied chunks are needed, so the points themselves are never gathered
+    horizontal_borders, vertical_borders, step_size, _, counts = index_chunks(coordinates, chunks=chunks, step_size=chunk_size)
+    valid_chunks = np.argwhere(counts > 0)
 
     points_per_chunk = num_points * downsample_rate / len(valid_chunks)
 
@@ -660,12 +1657,9 @@ def chunked_downsample_on_grid(coordinates: np.ndarray, downsample_rate: float,
         raise ValueError("Chunk density is < 1")
     
     all_new_coordinates = []
-    for index, chunk_data in enumerate(valid_chunks):
-        horizontal_low =  chunk_data['horizontal_low']
-        horizontal_high =  chunk_data['horizontal_high']
-        vertical_low =  chunk_data['vertical_low']
-        vertical_high =  chunk_data['vertical_high']
-        step_size =  chunk_data['step_size']
+    for i, j in valid_chunks:
+        horizontal_low, horizontal_high = horizontal_borders[i:i+2]
+        vertical_low, vertical_high = vertical_borders[j:j+2]
         
         x = np.linspace(horizontal_low, horizontal_high, downsampled_1d_density, endpoint=False)
         if np.allclose(horizontal_high, horizontal_base + horizontal_range):
@@ -679,7 +1673,7 @@ def chunked_downsample_on_grid(coordinates: np.ndarray, downsample_rate: float,
           
         xv, yv = np.meshgrid(x, y)
           
-        new_coordinates = np.array(list(zip(xv.flat, yv.flat)))
+        new_coordinates = np.column_stack([xv.ravel(), yv.ravel()])
         all_new_coordinates.append(new_coordinates)
     
     new_coordinates = np.vstack(all_new_coordinates)
@@ -711,13 +1705,65 @@ def filter_gridpoints(spot_coordinates: np.ndarray, grid_coordinates: np.ndarray
     
     return filtered_bin_coordinates
 
-def bin_expression(spot_expression: np.ndarray, spot_coordinates: np.ndarray, bin_coordinates: np.ndarray, num_jobs: int):
+def assign_to_grid(spot_coordinates: np.ndarray, grid_coordinates: np.ndarray, origin: Optional[np.ndarray] = None,
+        spacing: Optional[float] = None, num_jobs: int = 1):
+    """Assign every spot to its nearest grid point.
+
+    If ``grid_coordinates`` lie on a square lattice with the given ``origin`` and ``spacing`` (as produced by
+    :func:`chunked_downsample_on_grid`), the nearest lattice point of each spot is found by rounding its shifted
+    coordinates, in O(N). Nearest-neighbor queries are only used for spots whose lattice point is not part of
+    the grid (e.g. at the border of an empty chunk), or for all spots if the grid is irregular.
+
+    Args:
+        spot_coordinates: coordinates of original spots
+        grid_coordinates: coordinates of grid points
+        origin: coordinates of lattice point ``(0, 0)``
+        spacing: distance between neighboring lattice points
+        num_jobs: number of jobs to use for nearest neighbor computation
+
+    Returns:
+        index of the nearest grid point of every spot
+    """
+    num_spots, _ = spot_coordinates.shape
+    indices = np.full(num_spots, -1)
+
+    if origin is not None and spacing is not None:
+        grid_cells = np.round((grid_coordinates - origin) / spacing).astype(np.int64)
+        if np.allclose(grid_cells * spacing + origin, grid_coordinates, rtol=0, atol=1e-6 * spacing):
+            spot_cells = np.floor((spot_coordinates - origin) / spacing + 0.5).astype(np.int64)
+
+            # Encode cells as scalar keys and look up every spot's cell among the (unique) grid cells
+            low = np.minimum(grid_cells.min(axis=0), spot_cells.min(axis=0))
+            width = max(grid_cells[:, 1].max(), spot_cells[:, 1].max()) - low[1] + 1
+            grid_keys = (grid_cells[:, 0] - low[0]) * width + (grid_cells[:, 1] - low[1])
+            spot_keys = (spot_cells[:, 0] - low[0]) * width + (spot_cells[:, 1] - low[1])
+
+            grid_keys, grid_indices = np.unique(grid_keys, return_index=True)
+            positions = np.minimum(np.searchsorted(grid_keys, spot_keys), len(grid_keys) - 1)
+            found = grid_keys[positions] == spot_keys
+            indices[found] = grid_indices[positions[found]]
+
+    unassigned = indices < 0
+    if unassigned.any():
+        neigh = NearestNeighbors(n_neighbors=1, n_jobs=num_jobs)
+        neigh.fit(grid_coordinates)
+        indices[unassigned] = neigh.kneighbors(spot_coordinates[unassigned], return_distance=False).ravel()
+
+    return indices
+
+def bin_expression(spot_expression: np.ndarray, spot_coordinates: np.ndarray, bin_coordinates: np.ndarray, num_jobs: int,
+        indices: Optional[np.ndarray] = None):
     """Bin spot expressions into filtered coordinates.
+
+    Every spot is assigned to its nearest bin, and the assignment matrix is built directly from these
+    indices; the binned expression is then a single sparse product with the spot expression. Sparse
+    expression stays sparse, and backed expression is streamed in blocks of rows.
     
     Args:
         spot_expression: expression of original spots
         spot_coordinates: coordinates of original spots
         bin_coordinates: coordinates of downsampled bin spots
+        indices: if set, precomputed bin of every spot (e.g. from :func:`assign_to_grid`)
         
     Returns:
         A tuple of (binned expression for metaspots, assignment matrix of bins to spots)
@@ -726,21 +1772,23 @@ def bin_expression(spot_expression: np.ndarray, spot_coordinates: np.ndarray, bi
     num_spots, num_genes = spot_expression.shape    
     num_bins, _ = bin_coordinates.shape
     
-    bin_expression = np.zeros((num_bins, num_genes))
-    bin_assignments = csr_array((num_bins, num_spots), dtype=np.int32)
+    if indices is None:
+        neigh = NearestNeighbors(n_neighbors=1, n_jobs=num_jobs)
+        neigh.fit(bin_coordinates)
+        indices = neigh.kneighbors(spot_coordinates, return_distance=False)
     
-    neigh = NearestNeighbors(n_neighbors=1, n_jobs=num_jobs)
-    neigh.fit(bin_coordinates)
-    indices = neigh.kneighbors(spot_coordinates, return_distance=False)
-    
-    bin_to_spots = defaultdict(list)
-    for i in range(num_spots):
-        bin_to_spots[indices[i].item()].append(i)
-        
-    for i in range(num_bins):
-        bin_spots = bin_to_spots[i]
-        bin_assignments[i, bin_spots] = 1
-        bin_expression[i] = np.sum(spot_expression[bin_spots], axis=0)
+    bin_assignments = csr_array((np.ones(num_spots, dtype=np.int32), (indices.ravel(), np.arange(num_spots))),
+            shape=(num_bins, num_spots))
+
+    if not BackedExpression.is_backed(spot_expression):
+        return bin_assignments @ spot_expression, bin_assignments
+
+    spot_assignments = bin_assignments.tocsc()
+    chunk_size = max(1, 2**22 // num_genes)
+    bin_expression = 0
+    for start in range(0, num_spots, chunk_size):
+        stop = min(start + chunk_size, num_spots)
+        bin_expression = bin_expression + spot_assignments[:, start:stop] @ spot_expression[start:stop]
     
     return bin_expression, bin_assignments
 
@@ -773,15 +1821,13 @@ def compute_nll(model, level: int = 0, use_spatial=False):
             prior_x = parameter_optimizer.prior_xs[dataset_index]
                 
             # Precomputing quantities
-            MTM = M.T @ M / (sigma_yx ** 2)
-            YM = Y.to(M.device) @ M / (sigma_yx ** 2)
-            Ynorm = torch.linalg.norm(Y, ord='fro').item() ** 2 / (sigma_yx ** 2)
+            statistics = embedding_optimizer.sufficient_statistics[dataset.name]
             S = torch.linalg.norm(X, dim=1, ord=1, keepdim=True)
 
             Z = X / S
             N, G = Y.shape
             
-            loss = ((X @ MTM) * X).sum() / 2 - (X * YM).sum() + Ynorm / 2
+            loss = statistics.squared_error(Y, X, M) / (sigma_yx ** 2) / 2
 
             logZ_i_Y = torch.full((N,), G/2 * np.log((2 * np.pi * sigma_yx**2)), **model.context)
             if not use_spatial:
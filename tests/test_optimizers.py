@@ -0,0 +1,265 @@
+from popari.model import Popari
+from popari.components import PopariDataset
+
+import pytest
+import torch
+import numpy as np
+import anndata as ad
+
+from popari.util import GraphColoringScheduler
+
+context = dict(device="cpu", dtype=torch.float64)
+
+def make_dataset(name, side=15, K=4, num_genes=30, seed=0):
+    rng = np.random.default_rng(seed)
+    coordinates = np.stack(np.meshgrid(np.arange(side), np.arange(side)), axis=-1).reshape(-1, 2).astype(float)
+    M = rng.gamma(1, 1, size=(num_genes, K))
+    M /= M.sum(axis=0)
+    labels = (coordinates[:, 0] // 5).astype(int) % K
+    X = np.eye(K)[labels] * 10 + rng.uniform(0, 1, size=(len(coordinates), K))
+
+    dataset = ad.AnnData(X=rng.poisson(X @ M.T * 20).astype(np.float64))
+    dataset.obsm["spatial"] = coordinates
+    dataset = PopariDataset(dataset, name)
+    dataset.compute_spatial_neighbors()
+
+    return dataset
+
+def make_model(num_replicates=2, sides=None, **kwargs):
+    sides = [15] * num_replicates if sides is None else sides
+    datasets = [make_dataset(f"{index}", side=side, seed=index) for index, side in enumerate(sides)]
+    model = Popari(K=4, datasets=datasets, replicate_names=[dataset.name for dataset in datasets],
+            initialization_method="svd", torch_context=context, initial_context=context, **kwargs)
+    model.estimate_parameters(update_spatial_affinities=False)
+    model.estimate_weights(use_neighbors=False)
+
+    return model
+
+@pytest.fixture(scope="module")
+def shared_model():
+    return make_model(spatial_affinity_centering=True)
+
+@pytest.fixture(scope="module")
+def differential_model():
+    return make_model(num_replicates=3, spatial_affinity_mode="differential lookup", spatial_affinity_batched=True, lambda_Sigma_bar=1e-1)
+
+@pytest.fixture(scope="module")
+def unbalanced_model():
+    return make_model(sides=[15, 10], betas=np.array([0.7, 0.3]))
+
+@pytest.fixture(scope="module")
+def embedding_model():
+    model = make_model(num_replicates=1)
+    model.estimate_parameters()
+    return model
+
+def estimate_weights_wnbr(model, **kwargs):
+    """Update the embeddings of the first replicate with neighbors, starting from (and not modifying) the current ones."""
+    embedding_optimizer = model.base_view.embedding_optimizer
+    parameter_optimizer = model.base_view.parameter_optimizer
+    dataset = embedding_optimizer.datasets[0]
+    X = embedding_optimizer.embedding_state[dataset.name].clone()
+    args = (embedding_optimizer.Ys[0], parameter_optimizer.metagene_state[dataset.name], X, parameter_optimizer.sigma_yxs[0],
+            parameter_optimizer.prior_x_modes[0], parameter_optimizer.prior_xs[0], dataset)
+
+    initial_loss = embedding_optimizer.nll_weight_wnbr(*args)
+    loss, X = embedding_optimizer.estimate_weight_wnbr(*args, **kwargs)
+
+    return initial_loss, loss, X
+
+def test_invalid_spatial_affinity_solver():
+    with pytest.raises(ValueError, match="spatial_affinity_solver"):
+        make_model(spatial_affinity_solver="LBFGS")
+
+    with pytest.raises(ValueError, match="spatial_affinity_constraint"):
+        make_model(spatial_affinity_solver="lbfgs", spatial_affinity_constraint="clamp")
+
+    with pytest.raises(ValueError, match="spatial_affinity_batched"):
+        make_model(spatial_affinity_mode="differential lookup", spatial_affinity_solver="lbfgs", spatial_affinity_batched=True)
+
+def test_invalid_metagene_solver():
+    with pytest.raises(ValueError, match="metagene_solver"):
+        make_model(metagene_solver="FISTA")
+
+def test_lbfgs_spatial_affinities(shared_model):
+    parameter_optimizer = shared_model.base_view.parameter_optimizer
+    initial_Sigma_x_inv = parameter_optimizer.spatial_affinity_state["0"].detach().clone()
+    replicate_mask = [True, True]
+
+    solutions = {}
+    for solver in ["adam", "lbfgs"]:
+        parameter_optimizer.spatial_affinity_solver = solver
+        Sigma_x_inv = initial_Sigma_x_inv.clone()
+        optimizer = torch.optim.Adam([Sigma_x_inv], lr=1e-1)
+        solutions[solver] = parameter_optimizer.estimate_Sigma_x_inv(Sigma_x_inv, replicate_mask, optimizer, tol=1e-6, n_epochs=5000)
+    parameter_optimizer.spatial_affinity_solver = "adam"
+
+    (adam_Sigma_x_inv, adam_loss), (lbfgs_Sigma_x_inv, lbfgs_loss) = solutions["adam"], solutions["lbfgs"]
+    # Centering is part of the L-BFGS parameterization, so both solvers reach the same constrained optimum
+    assert abs(lbfgs_Sigma_x_inv.mean().item()) < 1e-10
+    assert torch.allclose(adam_Sigma_x_inv, lbfgs_Sigma_x_inv, atol=1e-2)
+    assert np.isclose(float(adam_loss), float(lbfgs_loss), rtol=1e-6)
+
+def test_batched_differential_spatial_affinities(differential_model):
+    parameter_optimizer = differential_model.base_view.parameter_optimizer
+    spatial_affinity_state = parameter_optimizer.spatial_affinity_state
+
+    # Batched updates are opt-in and own the only Adam state of the replicates
+    assert spatial_affinity_state.optimizers == {}
+    with pytest.raises(ValueError, match="subsample_rate"):
+        parameter_optimizer.update_spatial_affinity(subsample_rate=0.5)
+    initial_Sigma_x_invs = spatial_affinity_state.Sigma_x_invs.detach().clone()
+    Sigma_x_inv_bars = {group_name: bar.detach().clone() for group_name, bar in spatial_affinity_state.spatial_affinity_bar.items()}
+
+    Sigma_x_invs = initial_Sigma_x_invs.clone()
+    optimizer = torch.optim.Adam([Sigma_x_invs], lr=spatial_affinity_state.lr, betas=(.5, .9))
+    batched_Sigma_x_invs, _ = parameter_optimizer.estimate_Sigma_x_invs_batched(Sigma_x_invs, optimizer, Sigma_x_inv_bars=Sigma_x_inv_bars)
+
+    num_replicates = len(parameter_optimizer.datasets)
+    for index, dataset in enumerate(parameter_optimizer.datasets):
+        replicate_mask = [other_index == index for other_index in range(num_replicates)]
+        replicate_bars = [Sigma_x_inv_bars[group_name] for group_name in parameter_optimizer.spatial_affinity_tags[dataset.name]]
+
+        Sigma_x_inv = initial_Sigma_x_invs[index].clone()
+        optimizer = torch.optim.Adam([Sigma_x_inv], lr=spatial_affinity_state.lr, betas=(.5, .9))
+        looped_Sigma_x_inv, _ = parameter_optimizer.estimate_Sigma_x_inv(Sigma_x_inv, replicate_mask, optimizer, Sigma_x_inv_bar=replicate_bars)
+
+        # Trajectories agree up to the summation order of the log-partition functions, which Adam slowly amplifies
+        assert not torch.allclose(looped_Sigma_x_inv, initial_Sigma_x_invs[index], atol=1e-1)
+        assert torch.allclose(batched_Sigma_x_invs[index], looped_Sigma_x_inv, atol=1e-2)
+
+        batched_loss = parameter_optimizer.nll_Sigma_x_inv(batched_Sigma_x_invs[index], replicate_mask, Sigma_x_inv_bar=replicate_bars)
+        looped_loss = parameter_optimizer.nll_Sigma_x_inv(looped_Sigma_x_inv, replicate_mask, Sigma_x_inv_bar=replicate_bars)
+        assert np.isclose(float(batched_loss), float(looped_loss), rtol=1e-5)
+
+@pytest.mark.parametrize("replicate_mask", [[True, True], [False, True]])
+def test_subsampled_spatial_affinities(unbalanced_model, replicate_mask):
+    parameter_optimizer = unbalanced_model.base_view.parameter_optimizer
+    initial_Sigma_x_inv = parameter_optimizer.spatial_affinity_state["0"].detach().clone()
+
+    # Each replicate is subsampled from its own neighbor sums and weighted by its own (renormalized) beta, so
+    # the exact loss of the subsampled solution matches the full-batch optimum even for replicates of
+    # different sizes and weights
+    torch.manual_seed(0)
+    solutions = {}
+    for subsample_rate in [None, 0.25]:
+        Sigma_x_inv = initial_Sigma_x_inv.clone()
+        optimizer = torch.optim.Adam([Sigma_x_inv], lr=1e-2)
+        solutions[subsample_rate] = parameter_optimizer.estimate_Sigma_x_inv(Sigma_x_inv, replicate_mask, optimizer, subsample_rate=subsample_rate)
+
+    (Sigma_x_inv, loss), (subsampled_Sigma_x_inv, subsampled_loss) = solutions[None], solutions[0.25]
+    assert np.isclose(float(subsampled_loss), float(loss), rtol=1e-4)
+    assert torch.allclose(subsampled_Sigma_x_inv, Sigma_x_inv, atol=5e-2)
+
+def test_subsampled_spatial_affinities_betas(unbalanced_model):
+    parameter_optimizer = unbalanced_model.base_view.parameter_optimizer
+    initial_Sigma_x_inv = parameter_optimizer.spatial_affinity_state["0"].detach().clone()
+    original_betas = parameter_optimizer.betas
+
+    # Only the renormalized betas of the selected replicates enter the objective
+    losses = []
+    for betas in [np.array([0.7, 0.3]), np.array([0.2, 0.8])]:
+        parameter_optimizer.betas = betas
+        torch.manual_seed(0)
+        Sigma_x_inv = initial_Sigma_x_inv.clone()
+        optimizer = torch.optim.Adam([Sigma_x_inv], lr=1e-2)
+        _, loss = parameter_optimizer.estimate_Sigma_x_inv(Sigma_x_inv, [False, True], optimizer, subsample_rate=0.25, n_epochs=100)
+        losses.append(float(loss))
+    parameter_optimizer.betas = original_betas
+
+    assert np.isclose(*losses, rtol=1e-10)
+
+@pytest.mark.parametrize("embedding_frontier_scheduling", [False, True])
+def test_jacobi_embeddings(embedding_model, embedding_frontier_scheduling):
+    embedding_optimizer = embedding_model.base_view.embedding_optimizer
+    embedding_optimizer.embedding_frontier_scheduling = embedding_frontier_scheduling
+    initial_loss, nesterov_loss, nesterov_X = estimate_weights_wnbr(embedding_model, update_alg="nesterov", tol=1e-6)
+    _, jacobi_loss, jacobi_X = estimate_weights_wnbr(embedding_model, update_alg="jacobi", tol=1e-6)
+    embedding_optimizer.embedding_frontier_scheduling = False
+
+    assert jacobi_loss < initial_loss
+    assert np.isclose(jacobi_loss, nesterov_loss, rtol=1e-8)
+    assert torch.allclose(jacobi_X, nesterov_X, atol=1e-3)
+
+def test_jacobi_embeddings_update_mask(embedding_model):
+    X = embedding_model.base_view.embedding_optimizer.embedding_state["0"]
+    update_mask = torch.zeros(len(X), dtype=torch.bool)
+    update_mask[::3] = True
+
+    # Cells outside of the frontier keep their proportions; only their size factors are refreshed
+    initial_loss, loss, jacobi_X = estimate_weights_wnbr(embedding_model, update_alg="jacobi", update_mask=update_mask)
+    Z, jacobi_Z = X / X.sum(dim=1, keepdim=True), jacobi_X / jacobi_X.sum(dim=1, keepdim=True)
+    assert loss < initial_loss
+    assert torch.allclose(jacobi_Z[~update_mask], Z[~update_mask])
+    assert not torch.allclose(jacobi_Z[update_mask], Z[update_mask])
+
+@pytest.mark.parametrize("update_alg", ["gd", "nesterov", "active set"])
+def test_threaded_embeddings(embedding_model, update_alg, monkeypatch):
+    # Shrink the batches so that every color class of the grid is split across several threads
+    class_batches = GraphColoringScheduler.class_batches
+    class_sizes = []
+    def small_class_batches(self, batch_size=None, mask=None):
+        for batches in class_batches(self, batch_size=16, mask=mask):
+            class_sizes.append(len(batches))
+            yield batches
+    monkeypatch.setattr(GraphColoringScheduler, "class_batches", small_class_batches)
+
+    embedding_optimizer = embedding_model.base_view.embedding_optimizer
+    results = {}
+    for num_threads in [1, 4]:
+        embedding_optimizer.embedding_num_threads = num_threads
+        # The scheduler shuffles the order of color classes
+        torch.manual_seed(0)
+        results[num_threads] = estimate_weights_wnbr(embedding_model, update_alg=update_alg, n_epochs=20)
+    embedding_optimizer.embedding_num_threads = 1
+
+    (_, loss, X), (_, threaded_loss, threaded_X) = results[1], results[4]
+    assert max(class_sizes) > 1
+    assert np.isclose(threaded_loss, loss, rtol=1e-10)
+    assert torch.allclose(threaded_X, X, atol=1e-10)
+
+def test_tiled_embeddings():
+    model = make_model(num_replicates=1, embedding_tile_size=60)
+    model.estimate_parameters()
+    embedding_optimizer = model.base_view.embedding_optimizer
+    parameter_optimizer = model.base_view.parameter_optimizer
+    dataset = embedding_optimizer.datasets[0]
+
+    # Expression stays on the host, and tiles are only built once
+    assert model.base_view.expression_context["device"] == "cpu"
+    tiles = embedding_optimizer.get_tiling(dataset)
+    assert len(tiles) > 1
+
+    _, loss, X = estimate_weights_wnbr(model, update_alg="nesterov", tol=1e-8)
+    args = (embedding_optimizer.Ys[0], parameter_optimizer.metagene_state[dataset.name], embedding_optimizer.embedding_state[dataset.name],
+            parameter_optimizer.sigma_yxs[0], parameter_optimizer.prior_x_modes[0], parameter_optimizer.prior_xs[0], dataset)
+    tiled_loss, tiled_X = embedding_optimizer.estimate_weight_wnbr_tiled(*args, tol=1e-8, update_alg="nesterov")
+
+    assert embedding_optimizer.get_tiling(dataset) is tiles
+    assert np.isclose(tiled_loss, loss, rtol=1e-8)
+    assert torch.allclose(tiled_X, X, atol=1e-5)
+
+def test_batched_coreset_spatial_affinities(differential_model, capsys):
+    parameter_optimizer = differential_model.base_view.parameter_optimizer
+    spatial_affinity_state = parameter_optimizer.spatial_affinity_state
+    Sigma_x_inv_bars = {group_name: bar.detach().clone() for group_name, bar in spatial_affinity_state.spatial_affinity_bar.items()}
+
+    parameter_optimizer.spatial_affinity_coreset_resolution = 1.0
+    parameter_optimizer.verbose = 1
+    Sigma_x_invs = spatial_affinity_state.Sigma_x_invs.detach().clone()
+    optimizer = torch.optim.Adam([Sigma_x_invs], lr=spatial_affinity_state.lr, betas=(.5, .9))
+    Sigma_x_invs, losses = parameter_optimizer.estimate_Sigma_x_invs_batched(Sigma_x_invs, optimizer, Sigma_x_inv_bars=Sigma_x_inv_bars)
+    parameter_optimizer.spatial_affinity_coreset_resolution = None
+    parameter_optimizer.verbose = 0
+
+    # The coreset solve reports its approximate loss next to the exact one, and returns the latter
+    reported_losses = [line.split("): ")[1].split("; exact loss: ") for line in capsys.readouterr().out.splitlines() if "approximate loss" in line]
+    assert len(reported_losses) == len(parameter_optimizer.datasets)
+    assert any(not np.isclose(float(approximate_loss), float(exact_loss), rtol=1e-8) for approximate_loss, exact_loss in reported_losses)
+
+    for index, dataset in enumerate(parameter_optimizer.datasets):
+        replicate_mask = [other_index == index for other_index in range(len(parameter_optimizer.datasets))]
+        replicate_bars = [Sigma_x_inv_bars[group_name] for group_name in parameter_optimizer.spatial_affinity_tags[dataset.name]]
+        num_edges = sum(map(len, parameter_optimizer.adjacency_lists[dataset.name]))
+        exact_loss = parameter_optimizer.nll_Sigma_x_inv(Sigma_x_invs[index], replicate_mask, Sigma_x_inv_bar=replicate_bars).item() * num_edges
+        assert np.isclose(losses[index].item(), exact_loss, rtol=1e-10)
@@ -1,8 +1,26 @@
 import pytest
 import torch
 import numpy as np
+import anndata as ad
+from scipy.sparse import csr_matrix, issparse, random as sparse_random
+
+from popari.sample_for_integral import integrate_of_exponential_over_simplex
+from popari.util import project2simplex, project2simplex_, color_graph, GraphColoringScheduler, NeighborSumBuffer, SpatialTiling, solve_simplex_qp, solve_nnls, solve_projected_fista, compress_rows, compute_log_partition_function, StochasticLogPartitionFunction, SufficientStatistics, index_rows, convert_scipy_to_pytorch_sparse_csr, BackedExpression, OptimizationLoop, bin_expression, assign_to_grid, chunked_downsample_on_grid, index_chunks, chunked_coordinates
+
+@pytest.fixture(scope="module")
+def grid_graph():
+    side = 20
+    grid_indices = np.arange(side * side).reshape(side, side)
+    edges = np.vstack([
+        np.stack([grid_indices[:, :-1].ravel(), grid_indices[:, 1:].ravel()], axis=1),
+        np.stack([grid_indices[:-1, :].ravel(), grid_indices[1:, :].ravel()], axis=1),
+        np.stack([grid_indices[:-1, :-1].ravel(), grid_indices[1:, 1:].ravel()], axis=1),
+    ])
+    edges = np.vstack([edges, edges[:, ::-1]])
+    adjacency_matrix = csr_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(side * side, side * side))
+
+    return adjacency_matrix
 
-from spicemix.util import project2simplex, project2simplex_
 def test_project2simplex():
     data = np.load("tests/test_data/util/projection_input.npy").astype(np.float32)
     projection_input = torch.from_numpy(data)
@@ -22,3 +40,393 @@ def test_project2simplex_():
     expected_output = np.load("tests/test_data/util/projection_output.npy")
     assert np.allclose(expected_output, projection_output)
 
+@pytest.mark.parametrize("method", ["greedy", "dsatur"])
+def test_color_graph(grid_graph, method):
+    colors = color_graph(grid_graph, method=method)
+    rows, columns = grid_graph.nonzero()
+
+    assert (colors >= 0).all()
+    assert (colors[rows] != colors[columns]).all()
+
+def test_graph_coloring_scheduler(grid_graph):
+    scheduler = GraphColoringScheduler(grid_graph, device="cpu", batch_size=16)
+    dense_adjacency = grid_graph.toarray()
+
+    visited = []
+    for batch in scheduler:
+        assert len(batch) <= 16
+        assert dense_adjacency[np.ix_(batch.numpy(), batch.numpy())].sum() == 0
+        visited.append(batch)
+
+    visited = torch.cat(visited)
+    assert len(visited) == grid_graph.shape[0]
+    assert len(torch.unique(visited)) == grid_graph.shape[0]
+
+def test_graph_coloring_scheduler_mask(grid_graph):
+    num_nodes, _ = grid_graph.shape
+    mask = torch.zeros(num_nodes, dtype=torch.bool)
+    mask[::7] = True
+
+    for contiguous in [False, True]:
+        scheduler = GraphColoringScheduler(grid_graph, device="cpu", batch_size=16, contiguous=contiguous)
+        layout_mask = mask[scheduler.permutation] if contiguous else mask
+        visited = torch.cat(list(scheduler.batches(mask=layout_mask)))
+        assert len(visited) == mask.sum()
+        assert layout_mask[visited].all()
+
+def test_neighbor_sum_buffer(grid_graph):
+    context = {"device": "cpu", "dtype": torch.float64}
+    num_nodes, _ = grid_graph.shape
+    Z = torch.rand(num_nodes, 5, **context)
+
+    neighbor_sum = NeighborSumBuffer(grid_graph, context)
+    neighbor_sum.reset(Z)
+    scheduler = GraphColoringScheduler(grid_graph, device="cpu", batch_size=32)
+    for batch in scheduler:
+        Z_batch = torch.rand(len(batch), 5, **context)
+        neighbor_sum.update(batch, Z_batch - Z[batch])
+        Z[batch] = Z_batch
+
+    expected_nu = torch.from_numpy(grid_graph @ Z.numpy())
+    assert torch.allclose(neighbor_sum.nu, expected_nu)
+
+def test_contiguous_layout(grid_graph):
+    context = {"device": "cpu", "dtype": torch.float64}
+    num_nodes, _ = grid_graph.shape
+    scheduler = GraphColoringScheduler(grid_graph, device="cpu", batch_size=32, contiguous=True)
+    permuted_graph = scheduler.permute_adjacency_matrix(grid_graph)
+    dense_adjacency = permuted_graph.toarray()
+
+    Z = torch.rand(num_nodes, 5, **context)[scheduler.permutation]
+    neighbor_sum = NeighborSumBuffer(permuted_graph, context)
+    neighbor_sum.reset(Z)
+
+    visited = []
+    for batch in scheduler:
+        assert isinstance(batch, slice)
+        assert dense_adjacency[batch, batch].sum() == 0
+        visited.extend(range(batch.start, batch.stop))
+
+        Z_batch = torch.rand(batch.stop - batch.start, 5, **context)
+        neighbor_sum.update(batch, Z_batch - Z[batch])
+        Z[batch] = Z_batch
+
+    assert sorted(visited) == list(range(num_nodes))
+    assert torch.allclose(neighbor_sum.nu, torch.from_numpy(permuted_graph @ Z.numpy()))
+
+    # Undoing the permutation recovers the original graph's neighbor sums
+    original_Z = Z[scheduler.inverse_permutation]
+    assert torch.allclose(neighbor_sum.nu[scheduler.inverse_permutation], torch.from_numpy(grid_graph @ original_Z.numpy()))
+
+def test_spatial_tiling(grid_graph):
+    num_nodes, _ = grid_graph.shape
+    side = int(np.sqrt(num_nodes))
+    coordinates = np.stack(np.unravel_index(np.arange(num_nodes), (side, side)), axis=1).astype(float)
+    tiling = SpatialTiling(coordinates, grid_graph, tile_size=50)
+
+    assert len(tiling) > 1
+    interiors = np.concatenate([cells[:num_interior] for cells, num_interior, _ in tiling])
+    assert np.array_equal(np.sort(interiors), np.arange(num_nodes))
+
+    for cells, num_interior, adjacency_matrix in tiling:
+        # Every neighbor of an interior node is part of the tile
+        assert np.array_equal(adjacency_matrix[:num_interior].sum(axis=1), grid_graph[cells[:num_interior]].sum(axis=1))
+
+def test_solve_simplex_qp():
+    generator = torch.Generator().manual_seed(0)
+    num_problems, K = 64, 8
+    M = torch.rand((30, K), generator=generator, dtype=torch.float64)
+    Q = M.T @ M
+    c = torch.randn((num_problems, K), generator=generator, dtype=torch.float64) * 10
+    z = torch.full((num_problems, K), 1 / K, dtype=torch.float64)
+
+    solution = solve_simplex_qp(Q, c, z)
+    assert torch.allclose(solution.sum(dim=1), torch.ones(num_problems, dtype=torch.float64))
+    assert (solution >= 0).all()
+
+    # Compare against long-run projected gradient descent
+    step_size = 1 / torch.linalg.eigvalsh(Q).max()
+    reference = z.clone()
+    for _ in range(20000):
+        reference = project2simplex(reference - step_size * (reference @ Q - c), dim=1)
+
+    def objective(z):
+        return ((z @ Q) * z).sum(dim=1) / 2 - (c * z).sum(dim=1)
+
+    assert torch.allclose(solution, reference, atol=1e-6)
+    assert (objective(solution) <= objective(reference) + 1e-6).all()
+
+def test_solve_nnls():
+    generator = torch.Generator().manual_seed(0)
+    num_problems, K = 256, 10
+    M = torch.rand((40, K), generator=generator, dtype=torch.float64)
+    Q = M.T @ M
+    c = torch.randn((num_problems, K), generator=generator, dtype=torch.float64) * 5
+
+    solution = solve_nnls(Q, c, batch_size=100)
+    assert (solution >= 0).all()
+
+    # KKT conditions: gradient vanishes on the support and is non-negative elsewhere
+    gradient = solution @ Q - c
+    assert torch.allclose(gradient[solution > 0], torch.zeros(1, dtype=torch.float64), atol=1e-8)
+    assert (gradient[solution == 0] >= -1e-8).all()
+
+    warm_started_solution = solve_nnls(Q, c, passive=solution > 0)
+    assert torch.allclose(solution, warm_started_solution)
+
+def test_solve_projected_fista():
+    generator = torch.Generator().manual_seed(0)
+    num_problems, G, K = 3, 15, 4
+    A = torch.rand((num_problems, 40, K), generator=generator, dtype=torch.float64)
+    Q = A.transpose(1, 2) @ A
+    c = torch.randn((num_problems, G, K), generator=generator, dtype=torch.float64) * 5
+    M = torch.full((num_problems, G, K), 1 / G, dtype=torch.float64)
+
+    def project(M):
+        return project2simplex(M, dim=1)
+
+    solution, num_epochs = solve_projected_fista(Q, c, M, project, tol=1e-12)
+    assert num_epochs < 10000
+    assert torch.allclose(solution.sum(dim=1), torch.ones((num_problems, K), dtype=torch.float64))
+
+    # Optimality: a projected gradient step leaves the solution in place
+    step_sizes = 1 / torch.linalg.eigvalsh(Q)[:, -1, None, None]
+    assert torch.allclose(project(solution - step_sizes * (solution @ Q - c)), solution, atol=1e-8)
+
+def test_optimization_loop():
+    deltas = torch.tensor([1e-1, 1e-2, 1e-3, 1e-4, 1e-5, 1e-6, 1e-7])
+
+    loop = OptimizationLoop(100, tol=2e-5, check_every=3)
+    for epoch in loop:
+        loop.record(deltas[min(epoch, 6)], deltas[min(epoch, 6)])
+
+    # The criteria are tested after epoch 0 and then every 3 epochs; the one met at epoch 4 is found at epoch 6
+    assert loop.converged and loop.epoch == 6
+    assert loop.deltas == pytest.approx(deltas[:7].tolist())
+    assert loop.epoch_best == 6
+
+    # The loss stops improving after epoch 1
+    loop = OptimizationLoop(100, check_every=4, patience=3)
+    for epoch in loop:
+        loop.record(torch.tensor(abs(epoch - 1.0)))
+
+    assert loop.converged and loop.epoch == 8 and loop.epoch_best == 1
+
+    # Solvers that converge in a single step stop right away
+    loop = OptimizationLoop(100, tol=1, check_every=10)
+    for epoch in loop:
+        loop.record(torch.tensor(0.0), torch.tensor(0.0))
+
+    assert loop.converged and loop.epoch == 0 and len(loop.losses) == 1
+
+    loop = OptimizationLoop(5, tol=1, check_every=3, min_epochs=5)
+    for epoch in loop:
+        loop.record(0.0, torch.tensor(0.0))
+
+    assert loop.epoch == 4 and len(loop.losses) == 5
+
+def test_integrate_of_exponential_over_simplex():
+    generator = torch.Generator().manual_seed(0)
+    eta = torch.randn((50, 2), generator=generator, dtype=torch.float64)
+
+    # Closed form for K = 2: integral of exp(-(a t + b (1 - t))) over t in [0, 1]
+    a, b = eta.T
+    expected = torch.log((torch.exp(-b) - torch.exp(-a)) / (a - b))
+    assert torch.allclose(integrate_of_exponential_over_simplex(eta), expected)
+
+    eta = torch.randn((20, 5), generator=generator, dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(lambda eta: integrate_of_exponential_over_simplex(eta, chunk_size=7), (eta,))
+
+    # Shifting eta by a constant shifts logZ by that constant, so gradients sum to -1
+    gradient, = torch.autograd.grad(integrate_of_exponential_over_simplex(eta).sum(), eta)
+    assert torch.allclose(gradient.sum(dim=1), -torch.ones(20, dtype=torch.float64))
+
+def test_compress_rows():
+    generator = torch.Generator().manual_seed(0)
+    rows = torch.rand((1000, 3), generator=generator, dtype=torch.float64)
+    resolution = 0.25
+
+    representatives, weights = compress_rows(rows, resolution)
+    assert len(representatives) < len(rows)
+    assert weights.sum() == len(rows)
+
+    # Weighted representatives preserve the column sums, and each one lies in its grid cell
+    assert torch.allclose((representatives * weights[:, None]).sum(dim=0), rows.sum(dim=0))
+    keys = torch.round(rows / resolution)
+    assert torch.equal(torch.unique(keys, dim=0), torch.unique(torch.round(representatives / resolution), dim=0))
+
+def test_stochastic_log_partition_function():
+    torch.manual_seed(0)
+    K = 4
+    nus = [torch.rand((300, K), dtype=torch.float64) * 6, None, torch.rand((120, K), dtype=torch.float64) * 6]
+    betas = [0.5, 0.3, 0.2]
+    Sigma_x_inv_snapshot = torch.randn((K, K), dtype=torch.float64)
+    Sigma_x_inv_snapshot = (Sigma_x_inv_snapshot + Sigma_x_inv_snapshot.T) / 2
+    Sigma_x_inv = Sigma_x_inv_snapshot + 0.3 * torch.randn((K, K), dtype=torch.float64)
+    exact = compute_log_partition_function(Sigma_x_inv, nus, betas).item()
+
+    num_draws = 2000
+    estimate_log_partition_function = StochasticLogPartitionFunction(nus, betas, subsample_rate=0.1, snapshot_frequency=num_draws + 1)
+
+    # At the snapshot the control variate cancels the mini-batch exactly
+    snapshot_estimate = estimate_log_partition_function(Sigma_x_inv_snapshot)
+    assert np.isclose(snapshot_estimate.item(), compute_log_partition_function(Sigma_x_inv_snapshot, nus, betas).item())
+
+    estimates = torch.stack([estimate_log_partition_function(Sigma_x_inv) for _ in range(num_draws)])
+    assert torch.equal(estimate_log_partition_function.Sigma_x_inv_snapshot, Sigma_x_inv_snapshot)
+
+    # Unbiased, and with a smaller variance than the plain mini-batch estimate
+    standard_error = estimates.std().item() / np.sqrt(num_draws)
+    assert abs(estimates.mean().item() - exact) < 4 * standard_error
+    batch_estimates = torch.stack([compute_log_partition_function(Sigma_x_inv, nus, betas, samples=estimate_log_partition_function.sample())
+        for _ in range(num_draws)])
+    assert abs(batch_estimates.mean().item() - exact) < 4 * batch_estimates.std().item() / np.sqrt(num_draws)
+    assert estimates.std() < batch_estimates.std() / 2
+
+def test_sufficient_statistics():
+    generator = torch.Generator().manual_seed(0)
+    Y = torch.rand((50, 20), generator=generator, dtype=torch.float64)
+    X = torch.rand((50, 4), generator=generator, dtype=torch.float64)
+    M = torch.rand((20, 4), generator=generator, dtype=torch.float64)
+    statistics = SufficientStatistics()
+
+    YM = statistics.YM(Y, M)
+    assert torch.allclose(YM, Y @ M)
+    assert statistics.YM(Y, M) is YM
+    assert np.isclose(statistics.Y_norm(Y), (Y ** 2).sum().item())
+
+    # In-place writes invalidate exactly the statistics that depend on the written tensor
+    XTX, MTM = statistics.XTX(X), statistics.MTM(M)
+    X[:] = torch.rand((50, 4), generator=generator, dtype=torch.float64)
+    assert statistics.MTM(M) is MTM
+    assert statistics.YM(Y, M) is YM
+    assert torch.allclose(statistics.XTX(X), X.T @ X)
+    assert torch.allclose(statistics.YTX(Y, X), Y.T @ X)
+
+    M.mul_(2)
+    assert torch.allclose(statistics.YM(Y, M), Y @ M)
+    assert np.isclose(statistics.MTM_max_eigenvalue(M), torch.linalg.eigvalsh(M.T @ M).max().item())
+
+    # A different tensor with the same version is not mistaken for a cached input
+    assert torch.allclose(statistics.YM(Y.clone(), M), Y @ M)
+
+def test_squared_error():
+    generator = torch.Generator().manual_seed(0)
+    X = torch.rand((60, 4), generator=generator, dtype=torch.float64)
+    M = torch.rand((30, 4), generator=generator, dtype=torch.float64)
+    Y = X @ M.T + 0.1 * torch.rand((60, 30), generator=generator, dtype=torch.float64)
+    statistics = SufficientStatistics()
+
+    assert np.isclose(statistics.squared_error(Y, X, M), torch.linalg.norm(Y - X @ M.T).item() ** 2)
+
+    # A near-exact fit cancels the identity, so the residual is evaluated in chunks
+    Y = X @ M.T + 1e-9 * torch.rand((60, 30), generator=generator, dtype=torch.float64)
+    expected = torch.linalg.norm(Y - X @ M.T).item() ** 2
+    assert np.isclose(SufficientStatistics().squared_error(Y, X, M, chunk_size=7), expected, rtol=1e-6)
+
+def test_sparse_expression():
+    generator = torch.Generator().manual_seed(0)
+    Y_scipy = sparse_random(60, 30, density=0.1, format="csr", random_state=0)
+    Y_dense = torch.from_numpy(Y_scipy.toarray())
+    Y = convert_scipy_to_pytorch_sparse_csr(Y_scipy, {"dtype": torch.float64})
+    X = torch.rand((60, 4), generator=generator, dtype=torch.float64)
+    M = torch.rand((30, 4), generator=generator, dtype=torch.float64)
+
+    rows = torch.tensor([5, 0, 17, 5, 59])
+    assert torch.equal(index_rows(Y, rows).to_dense(), Y_dense[rows])
+    assert torch.equal(index_rows(Y, slice(10, 20)).to_dense(), Y_dense[10:20])
+
+    # Sparse and dense expression yield the same statistics
+    sparse_statistics, dense_statistics = SufficientStatistics(), SufficientStatistics()
+    assert torch.allclose(sparse_statistics.YM(Y, M), dense_statistics.YM(Y_dense, M))
+    assert torch.allclose(sparse_statistics.YTX(Y, X), dense_statistics.YTX(Y_dense, X))
+    assert np.isclose(sparse_statistics.Y_norm(Y), dense_statistics.Y_norm(Y_dense))
+    assert np.isclose(sparse_statistics.squared_error(Y, X, M), dense_statistics.squared_error(Y_dense, X, M))
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_backed_expression(tmp_path, sparse):
+    generator = torch.Generator().manual_seed(0)
+    Y_scipy = sparse_random(60, 30, density=0.2, format="csr", random_state=0)
+    path = tmp_path / "expression.h5ad"
+    ad.AnnData(X=Y_scipy if sparse else Y_scipy.toarray()).write_h5ad(path)
+    backed_dataset = ad.read_h5ad(path, backed="r")
+
+    context = {"dtype": torch.float64}
+    Y = BackedExpression(backed_dataset.X, context, chunk_size=7) * 2
+    Y_dense = torch.from_numpy(Y_scipy.toarray()) * 2
+    X = torch.rand((60, 4), generator=generator, dtype=torch.float64)
+    M = torch.rand((30, 4), generator=generator, dtype=torch.float64)
+    B = convert_scipy_to_pytorch_sparse_csr(sparse_random(10, 60, density=0.1, format="csr", random_state=1), context)
+
+    assert BackedExpression.is_backed(backed_dataset.X)
+    assert not any(BackedExpression.is_backed(X) for X in (Y_scipy, Y_scipy.toarray(), np.asmatrix(Y_scipy.toarray()), Y_dense))
+    assert torch.allclose(Y @ M, Y_dense @ M)
+    assert torch.allclose(Y.transpose_matmul(X), Y_dense.T @ X)
+    assert np.isclose(Y.squared_norm(), (Y_dense ** 2).sum().item())
+    assert torch.allclose((B @ Y).to_dense(), B.to_dense() @ Y_dense)
+
+    rows = torch.tensor([17, 3, 42])
+    selected = index_rows(Y, rows)
+    assert torch.allclose(selected.to_dense() if sparse else selected, Y_dense[rows])
+
+    statistics = SufficientStatistics()
+    assert np.isclose(statistics.squared_error(Y, X, M), torch.linalg.norm(Y_dense - X @ M.T).item() ** 2)
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_bin_expression(sparse):
+    rng = np.random.default_rng(0)
+    spot_coordinates = rng.uniform(0, 10, size=(200, 2))
+    bin_coordinates = np.stack(np.meshgrid(np.arange(0.5, 10, 2), np.arange(0.5, 10, 2)), axis=-1).reshape(-1, 2)
+    spot_expression = sparse_random(200, 15, density=0.3, format="csr", random_state=0)
+
+    binned_expression, bin_assignments = bin_expression(spot_expression if sparse else spot_expression.toarray(),
+            spot_coordinates, bin_coordinates, num_jobs=1)
+
+    nearest_bins = np.linalg.norm(spot_coordinates[:, None] - bin_coordinates[None], axis=-1).argmin(axis=1)
+    assert np.array_equal(bin_assignments.toarray(), (nearest_bins[None] == np.arange(len(bin_coordinates))[:, None]))
+    assert issparse(binned_expression) == sparse
+    expected = np.stack([spot_expression.toarray()[nearest_bins == i].sum(axis=0) for i in range(len(bin_coordinates))])
+    assert np.allclose(binned_expression.toarray() if sparse else binned_expression, expected)
+
+def test_assign_to_grid():
+    rng = np.random.default_rng(0)
+    spot_coordinates = np.vstack([rng.uniform(0, 30, size=(2000, 2)), rng.uniform(60, 100, size=(3000, 2))])
+    grid_coordinates, chunk_size, chunk_1d_density = chunked_downsample_on_grid(spot_coordinates, downsample_rate=0.2, chunks=8)
+
+    def nearest_distances(grid_coordinates):
+        return np.linalg.norm(spot_coordinates[:, None] - grid_coordinates[None], axis=-1).min(axis=1)
+
+    indices = assign_to_grid(spot_coordinates, grid_coordinates, origin=spot_coordinates.min(axis=0),
+            spacing=chunk_size / chunk_1d_density)
+    distances = np.linalg.norm(spot_coordinates - grid_coordinates[indices], axis=1)
+    assert np.allclose(distances, nearest_distances(grid_coordinates))
+
+    # Irregular grids fall back to nearest neighbor queries
+    irregular_coordinates = grid_coordinates + rng.normal(scale=0.1, size=grid_coordinates.shape)
+    indices = assign_to_grid(spot_coordinates, irregular_coordinates, origin=spot_coordinates.min(axis=0),
+            spacing=chunk_size / chunk_1d_density)
+    distances = np.linalg.norm(spot_coordinates - irregular_coordinates[indices], axis=1)
+    assert np.allclose(distances, nearest_distances(irregular_coordinates))
+
+    # Far from the origin, the jitter must not be hidden by a tolerance relative to the coordinates
+    offset = 1e6
+    indices = assign_to_grid(spot_coordinates + offset, irregular_coordinates + offset, origin=spot_coordinates.min(axis=0) + offset,
+            spacing=chunk_size / chunk_1d_density)
+    distances = np.linalg.norm(spot_coordinates - irregular_coordinates[indices], axis=1)
+    assert np.allclose(distances, nearest_distances(irregular_coordinates))
+
+def test_index_chunks():
+    rng = np.random.default_rng(0)
+    coordinates = np.vstack([rng.uniform(0, 40, size=(500, 2)), rng.uniform(70, 100, size=(500, 2))])
+
+    horizontal_borders, vertical_borders, step_size, chunk_indices, counts = index_chunks(coordinates, chunks=5)
+    for i in range(len(horizontal_borders) - 1):
+        for j in range(len(vertical_borders) - 1):
+            mask = (coordinates[:, 0] > horizontal_borders[i]) & (coordinates[:, 0] <= horizontal_borders[i + 1]) & \
+                   (coordinates[:, 1] > vertical_borders[j]) & (coordinates[:, 1] <= vertical_borders[j + 1])
+            chunk_index = i * (len(vertical_borders) - 1) + j
+            assert np.array_equal(np.flatnonzero(chunk_indices == chunk_index), np.flatnonzero(mask))
+            assert counts[i, j] == mask.sum()
+
+    chunk_sizes = [len(chunk_data["chunk_coordinates"]) for chunk_data in chunked_coordinates(coordinates, step_size=step_size)]
+    assert chunk_sizes == counts.ravel().tolist()